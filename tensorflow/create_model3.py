@@ -20,9 +20,11 @@ import datetime
 from tensorflow import keras
 import matplotlib
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import MinMaxScaler
 
 import data
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from scalers import MinMax, power_scale
+from cubes import open_cube
 
 tf.config.set_visible_devices([], 'GPU')
 
@@ -52,31 +54,11 @@ def create_output_dir():
 def data_preproc(data_table, lin=True):
     global scale_exp
     trgt_params = ('potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)')
-
-    def get_param_exp(col_vals):
-        ''' get exponent of the parameter's mean value for scaling. '''
-        mean_exp = round(np.log10(col_vals.mean()), 0) - 1.0
-        # return 0 if mean_exp is less than zero to avoid blowing up small values
-        if mean_exp >=  0.0:
-            return mean_exp
-        else:
-            return 0.0
-
-
-    for col_n,(col_name,col_vals) in enumerate(data_table.iteritems(), start=1):
-        if col_name in trgt_params:
-            if lin:
-                # get exponent for scaling
-                exponent = get_param_exp(col_vals)
-                scale_exp.append(exponent)            
-                tmp_col = col_vals.values.reshape(-1,1)/(10**exponent)  # scale by dividing
-            else:
-                tmp_col = np.log10(col_vals.values.reshape(-1,1))
-        else:
-            tmp_col = col_vals.values.reshape(-1,1)
-        proced_table = tmp_col if col_n==1 else np.hstack([proced_table,tmp_col])
+    values, exponents = power_scale(data_table.to_numpy(), np.isin(data_table.columns, trgt_params), lin)
+    if lin:
+        scale_exp.extend(exponents)
     
-    proced_table = pd.DataFrame(proced_table, columns=data_table.columns)
+    proced_table = pd.DataFrame(values, columns=data_table.columns)
     proced_table = proced_table.replace([np.inf,-np.inf], np.nan)
     proced_table = proced_table.dropna(how='any')
     
@@ -84,22 +66,12 @@ def data_preproc(data_table, lin=True):
 
 
 def scale_all(data_table, x_or_y, out_dir=None):
-    data_table = data_table.copy()
-    for n,column in enumerate(data_table.columns, start=1):
-        scaler = MinMaxScaler()
-        data_col = data_table[column].values.reshape(-1,1)
-        scaler.fit(data_col)
-        scaled_data = scaler.transform(data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-        
-        if out_dir is not None:
-            pickle_file = out_dir / f'{x_or_y}scaler_{n:02d}.pkl'
-            with open(pickle_file, mode='wb') as pf:
-                pickle.dump(scaler, pf, protocol=4)
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
+    values = np.array(data_table, dtype=np.float64, order='F')
+    scaler = MinMax.fit(values)  # all columns at once (see torch/scalers.py)
+    if out_dir is not None:
+        scaler.save(out_dir, x_or_y)  # {x_or_y}scaler.json
     
-    return scaled_data_table
+    return pd.DataFrame(scaler.transform(values, inplace=True), columns=data_table.columns)
 
 
 def create_model_old(num_descriptors, num_obj_vars):
@@ -275,7 +247,7 @@ def get_augmentation_data(data_used, xy: bool, vp: bool):
     """
     if xy:  # xy augmentation
         xyfile = Path(root/'data'/'interpolation_datasets'/'rec-interpolation2.nc')
-        xydf = xr.open_dataset(xyfile).to_dataframe().reset_index().dropna()
+        xydf = open_cube(xyfile).to_dataframe().reset_index().dropna()
     else: xydf = None
 
     if vp:  # vp augmentation
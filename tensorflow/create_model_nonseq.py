@@ -17,7 +17,6 @@ import matplotlib.pyplot as plt
 from matplotlib import mathtext
 
 import sklearn
-from sklearn.preprocessing import MinMaxScaler
 import tensorflow as tf
 
 tf.config.set_visible_devices([], 'GPU')
@@ -28,6 +27,8 @@ from tensorflow.python.client import device_lib
 from sklearn.model_selection import train_test_split
 
 import data
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'torch'))
+from scalers import MinMax, power_scale
 
 
 def create_output_dir():
@@ -46,22 +47,12 @@ def create_output_dir():
 
 def data_preproc(data_table, lin=True):
     global scale_exp
-    scale_exp = []
     trgt_params = ('potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)')
-
-    for col_n,(col_name,col_vals) in enumerate(data_table.iteritems(), start=1):
-        if col_name in trgt_params:
-            if lin:
-                exponent = round(np.log10(col_vals.mean()), 0) - 1.0  # get exponent for scaling
-                scale_exp.append(exponent)            
-                tmp_col = col_vals.values.reshape(-1,1)/(10**exponent)  # scale by dividing
-            else:
-                tmp_col = np.log10(col_vals.values.reshape(-1,1))
-        else:
-            tmp_col = col_vals.values.reshape(-1,1)
-        proced_table = tmp_col if col_n==1 else np.hstack([proced_table,tmp_col])
+    # exponents are not limited to >= 0 here
+    values, scale_exp = power_scale(data_table.to_numpy(), np.isin(data_table.columns, trgt_params), lin, floor=None)
+    scale_exp = scale_exp if lin else []
     
-    proced_table = pd.DataFrame(proced_table, columns=data_table.columns)
+    proced_table = pd.DataFrame(values, columns=data_table.columns)
     proced_table = proced_table.replace([np.inf,-np.inf], np.nan)
     proced_table = proced_table.dropna(how='any')
     
@@ -101,21 +92,12 @@ def create_descriptor_table(data_table, pows, out_dir=None):
 
 
 def scale_all(data_table, x_or_y, out_dir=None):
-    for n,column in enumerate(data_table.columns, start=1):
-        scaler = MinMaxScaler()
-        data_col = data_table[column].values.reshape(-1,1)
-        scaler.fit(data_col)
-        scaled_data = scaler.transform(data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-        
-        if out_dir is not None:
-            pickle_file = posixpath.join(out_dir, '{0:s}scaler_{1:02d}.pkl'.format(x_or_y,n))
-            with open(pickle_file, mode='wb') as pf:
-                pickle.dump(scaler, pf, protocol=4)
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
-    
-    return scaled_data_table
+    values = np.array(data_table, dtype=np.float64, order='F')
+    scaler = MinMax.fit(values)  # all columns at once (see torch/scalers.py)
+    if out_dir is not None:
+        scaler.save(out_dir, x_or_y)  # {x_or_y}scaler.json
+    
+    return pd.DataFrame(scaler.transform(values, inplace=True), columns=data_table.columns)
 
 
 def create_model(num_descriptors, num_obj_vars):
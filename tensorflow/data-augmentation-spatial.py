@@ -5,12 +5,15 @@ Create datasets of linear interpolation from the simulation data's
 mesh grid to a fine linear grid. step controls the size of the grid points.
 Data is imported from .dat files and output as a single NetCDF file containing
 variable names and coordinate labels: https://docs.xarray.dev/en/stable/user-guide/data-structures.html.
+The file is chunked per (V, P) and in blocks of rows (see torch/cubes.py), so that
+readers can read a single (V, P) or crop window.
 
 @author: jarl
 Created on Thu 15 Dec 2022
 """
 
 import os
+import sys
 import pandas as pd
 from pathlib import Path
 import numpy as np
@@ -19,25 +22,9 @@ import xarray as xr
 from scipy import interpolate
 from tqdm import tqdm
 
-# borrowed from data.py
-import re
-
-def read_file(file_path):
-    with open(file_path, 'r') as f:
-        data = []
-        for n,line in enumerate(f,1):
-            if n==1:
-                line = line.strip()
-                line = re.findall(r'"[^"]*"', line) # get ['"var_name1"', '"var_name2"', ...]
-                column_labels = [var_name.replace('"','') for var_name in line]
-            elif n==2:
-                continue
-            else:
-                data_line = [eval(data) for data in line.split()]
-                if len(data_line)==4:
-                    break
-                data.append(data_line)
-    return pd.DataFrame(data, columns=column_labels)
+from data import read_file
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from cubes import write_cube
 
 
 def create_mask(X, Y):
@@ -164,12 +151,9 @@ ds = xr.combine_by_coords(ds_list)
 name = 'rec-interpolation'
 out_file = out_dir/f'{name}.nc'
 
-# write the file in chunks
-write_job = ds.to_netcdf(out_file, compute=False)
-from dask.diagnostics import ProgressBar
-with ProgressBar():
-    print(f"Writing to {out_file}")
-    write_job.compute()
+# write the file in chunks of a (V, P) and CHUNK_ROWS rows
+print(f"Writing to {out_file}")
+write_cube(ds, out_file)
 
 metadata = {'dataset excluded': excluded,
             'grid spacing (m)' : step,
@@ -3,47 +3,16 @@
 import posixpath
 import pandas as pd
 import numpy as np
-import re
-import os
+import sys
+from pathlib import Path
 import matplotlib.pyplot as plt
 import matplotlib
 from matplotlib.colors import Normalize
 from scipy import interpolate
 
-
-def read_all_data(fldr_path, voltages, pressures):
-    file_count = 0
-    for voltage in voltages:
-        for pressure in pressures:
-            file_name = '{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage,pressure)
-            file_path = posixpath.join(fldr_path, file_name)
-            if os.path.exists(file_path):
-                data = read_file(file_path)
-                file_count += 1
-            else:
-                continue
-            
-            data = attach_VP_columns(data, voltage, pressure)
-            data_table = data if file_count==1 else pd.concat([data_table,data], ignore_index=True)
-    return data_table
-
-
-def read_file(file_path):
-    with open(file_path, 'r') as f:
-        data = []
-        for n,line in enumerate(f,1):
-            if n==1:
-                line = line.strip()
-                line = re.findall(r'"[^"]*"', line) # get ['"var_name1"', '"var_name2"', ...]
-                column_labels = [var_name.replace('"','') for var_name in line]
-            elif n==2:
-                continue
-            else:
-                data_line = [eval(data) for data in line.split()]
-                if len(data_line)==4:
-                    break
-                data.append(data_line)
-    return pd.DataFrame(data, columns=column_labels)
+# node files are parsed by the same reader as the torch models (torch/node_files.py only needs pandas)
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from node_files import read_all_data, read_file, attach_VP_columns
 
 
 def data_preproc(data_line): # ! obsolete !
@@ -59,13 +28,6 @@ def data_preproc(data_line): # ! obsolete !
     return ret_data_line
 
 
-def attach_VP_columns(data, voltage, pressure):
-    num_data_points = len(data)
-    vp_columns = [[voltage, pressure] for n in range(num_data_points)]
-    vp_columns = pd.DataFrame(vp_columns, columns=['Vpp [V]', 'P [Pa]'])
-    return vp_columns.join(data)
-
-
 def get_cbar_range(param_col_label):
     if param_col_label=='potential (V)':
         cmin = 0.0
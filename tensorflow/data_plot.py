@@ -19,44 +19,12 @@ from matplotlib import gridspec
 from mpl_toolkits.axes_grid1 import ImageGrid
 from matplotlib import colors
 from sklearn.preprocessing import MinMaxScaler
-# import data
+from data import read_file
 import numpy as np
 
 matplotlib.rcParams['font.family'] = 'Arial'
 file_path = '/Users/jarl/2d-discharge-nn/data/avg_data/300Vpp_060Pa_node.dat'
 
-def read_file(file_path):
-    """
-    Import .dat file into a DataFrame.
-
-    Parameters
-    ----------
-    file_path : string
-        Path to the file.
-
-    Returns
-    -------
-    DataFrame
-        Dataframe containing the data.
-
-    """
-    with open(file_path, 'r') as f:
-        data = []
-        for n,line in enumerate(f,1):
-            if n==1:
-                line = line.strip()
-                line = re.findall(r'"[^"]*"', line) # get ['"var_name1"', '"var_name2"', ...]
-                column_labels = [var_name.replace('"','') for var_name in line]
-            elif n==2:
-                continue
-            else:
-                data_line = [eval(data) for data in line.split()]
-                if len(data_line)==4:
-                    break
-                data.append(data_line)
-    return pd.DataFrame(data, columns=column_labels)
-
-
 def draw_a_2D_graph(avg_data, param_col_label, triangles, file_path=None, set_cbar_range=True,   
                     on_grid=False, lin=False, X_mesh=None, Y_mesh=None):          
     """
@@ -29,6 +29,10 @@ import data
 import data_plot
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+# minmax scaling is shared with the torch models (torch/scalers.py only needs numpy)
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from scalers import MinMax
+
 parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
 parser.add_argument('-m', '--mesh', action='store_false', help='Interpolate on mesh.')
 args = vars(parser.parse_args())
@@ -118,31 +122,16 @@ def get_scale_exp():
 
 
 def scale_for_regr(data_table, model_dir):
-    for n,column in enumerate(data_table.columns, start=1):
-        one_data_col = data_table[column].values.reshape(-1,1)
-        scaler_file = model_dir / 'scalers' / 'xscaler_{0:02d}.pkl'.format(n)
-        with open(scaler_file, 'rb') as sf:
-            xscaler = pickle.load(sf)
-            xscaler.clip = False
-            scaled_data = xscaler.transform(one_data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
+    # the scaler files are read once per model, and applied to the whole table
+    xscaler = MinMax.load(model_dir / 'scalers', 'x')
+    scaled_data_table = pd.DataFrame(xscaler.transform(data_table.to_numpy()), columns=data_table.columns)
     
     return scaled_data_table
 
 
 def inv_scale(scaled_data, columns, model_dir):
-    num_columns = len(columns)
-    for n in range(num_columns):
-        scaler_file = model_dir / 'scalers' / 'yscaler_{0:02d}.pkl'.format(n+1)
-        with open(scaler_file, 'rb') as sf:
-            yscaler = pickle.load(sf)
-            yscaler.clip = False
-            inv_scaled_data = yscaler.inverse_transform(scaled_data[:,n].reshape(-1,1))
-        inv_scaled_data_table = inv_scaled_data if n==0 else np.hstack([inv_scaled_data_table,inv_scaled_data])
-    
-    inv_scaled_data_table = pd.DataFrame(inv_scaled_data_table, columns=columns)
+    yscaler = MinMax.load(model_dir / 'scalers', 'y')
+    inv_scaled_data_table = pd.DataFrame(yscaler.inverse_transform(scaled_data), columns=columns)
     
     return inv_scaled_data_table
 
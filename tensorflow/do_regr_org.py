@@ -13,6 +13,7 @@ import datetime
 import pickle
 import posixpath
 import shutil
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
@@ -26,6 +27,10 @@ from tensorflow import keras
 import data
 import data_plot
 
+# minmax scaling is shared with the torch models (torch/scalers.py only needs numpy)
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from scalers import MinMax
+
 
 def get_data_table(data_dir, voltage, pressure):
     file_name = '{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage,pressure)
@@ -94,31 +99,16 @@ def create_descriptors_for_regr(data_table, model_dir):
 
 
 def scale_for_regr(data_table, model_dir):
-    for n,column in enumerate(data_table.columns, start=1):
-        one_data_col = data_table[column].values.reshape(-1,1)
-        scaler_file = posixpath.join(model_dir+'/scalers', 'xscaler_{0:02d}.pkl'.format(n))
-        with open(scaler_file, 'rb') as sf:
-            xscaler = pickle.load(sf)
-            xscaler.clip = False
-            scaled_data = xscaler.transform(one_data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
+    # scalers/xscaler.json, or the xscaler_NN.pkl files of older models
+    xscaler = MinMax.load(Path(model_dir)/'scalers', 'x')
+    scaled_data_table = pd.DataFrame(xscaler.transform(data_table.to_numpy()), columns=data_table.columns)
     
     return scaled_data_table
 
 
 def inv_scale(scaled_data, columns, model_dir):
-    num_columns = len(columns)
-    for n in range(num_columns):
-        scaler_file = posixpath.join(model_dir+'/scalers', 'yscaler_{0:02d}.pkl'.format(n+1))
-        with open(scaler_file, 'rb') as sf:
-            yscaler = pickle.load(sf)
-            yscaler.clip = False
-            inv_scaled_data = yscaler.inverse_transform(scaled_data[:,n].reshape(-1,1))
-        inv_scaled_data_table = inv_scaled_data if n==0 else np.hstack([inv_scaled_data_table,inv_scaled_data])
-    
-    inv_scaled_data_table = pd.DataFrame(inv_scaled_data_table, columns=columns)
+    yscaler = MinMax.load(Path(model_dir)/'scalers', 'y')
+    inv_scaled_data_table = pd.DataFrame(yscaler.inverse_transform(scaled_data), columns=columns)
     
     return inv_scaled_data_table
 
@@ -21,9 +21,10 @@ from pathlib import Path
 import numpy as np
 from sklearn.model_selection import KFold
 
-from sklearn.preprocessing import MinMaxScaler
 
 import data
+sys.path.append(str(Path(__file__).resolve().parents[1]/'torch'))
+from scalers import MinMax, power_scale
 
 
 def create_output_dir():
@@ -130,21 +131,12 @@ def create_model(num_descriptors, num_obj_vars):
 
 
 def scale_all(data_table, x_or_y, out_dir=None):
-    for n,column in enumerate(data_table.columns, start=1):
-        scaler = MinMaxScaler()
-        data_col = data_table[column].values.reshape(-1,1)
-        scaler.fit(data_col)
-        scaled_data = scaler.transform(data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-        
-        if out_dir is not None:
-            pickle_file = posixpath.join(out_dir, '{0:s}scaler_{1:02d}.pkl'.format(x_or_y,n))
-            with open(pickle_file, mode='wb') as pf:
-                pickle.dump(scaler, pf, protocol=4)
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
+    values = np.array(data_table, dtype=np.float64, order='F')
+    scaler = MinMax.fit(values)  # all columns at once (see torch/scalers.py)
+    if out_dir is not None:
+        scaler.save(out_dir, x_or_y)  # {x_or_y}scaler.json
     
-    return scaled_data_table
+    return pd.DataFrame(scaler.transform(values, inplace=True), columns=data_table.columns)
 
 
 def draw_line():
@@ -11,24 +11,30 @@ import time
 import datetime
 import ast
 import pickle
+import shutil
 from tqdm import tqdm
 from pathlib import Path
+from argparse import ArgumentParser
 
 
 import numpy as np
 import pandas as pd
-from scipy.spatial import cKDTree
+import scipy.sparse as sp
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import TensorDataset, DataLoader
 
 import data_helpers as data
 import plot
+from mesh import get_mesh
+from scalers import Scaling
+from train_helpers import set_precision, autocast, TensorBatchLoader
+from train_helpers import scale_learning_rate, get_optimizer, train_step, time_to_target
+from train_helpers import Checkpointer, load_checkpoint_config, validation_indices, EarlyStopping, Telemetry
+from train_helpers import Profiler, ShardDataset, dataset_loss
 
-torch.set_default_dtype(torch.float64)
 class MLP(nn.Module):
     """Neural network model for grid-wise prediction of 2D-profiles.
 
@@ -81,53 +87,37 @@ class MLP(nn.Module):
 
 
 ####### neighbor regularization #######
-def process_batch(chunk: torch.Tensor, model: MLP, tree:cKDTree, sdf: pd.DataFrame, k=4) -> torch.Tensor: 
+def process_batch(chunk: torch.Tensor, index: torch.Tensor, model: MLP, knn: sp.csr_matrix, 
+                  sdf: pd.DataFrame) -> torch.Tensor: 
     """Batch-wise processing of the input tensor.
 
-    Takes a batch of points as an input, along with the current model, and a DataFrame of 
-    grid coordinates. The cKDTree is also created from this df.
+    Takes a batch of points as an input, along with their mesh node indices, the current model,
+    the mesh's k-NN adjacency and a DataFrame of grid coordinates. Every neighbor of the batch
+    is passed through the model in a single forward pass, and the neighbor means are the
+    product of the adjacency rows with the model outputs.
     Args:
-        chunk (torch.Tensor): batch of input tensors whose neighbor means will be calculated.
+        chunk (torch.Tensor): batch of (V, P, x, y) inputs whose neighbor means will be calculated.
+        index (torch.Tensor): mesh node index of each input.
         model (MLP): model being trained.
-        tree: kd-tree of (unscaled) grid coordinates
+        knn (sp.csr_matrix): row-normalized k-NN adjacency of the mesh (see Mesh.knn_adjacency)
         sdf (pd.DataFrame): DataFrame of scaled nodes (grid points)
-        k: number of nearest neighbors to query. default is 4.
 
     Returns:
         torch.Tensor: Tensor of size (chunk_size, 5) containing neighbor means of the input chunk.
     """
-
-    def neighbor_mean(point: torch.Tensor, k):
-        # get a point's neighbors
-        a, b, v, p = point.numpy() # -> np.ndarray
-        x, y = gridUnscale(a, b, nodes)  # to properly enforce the distance upper bound in tree.query()
-        v = np.atleast_1d(v)  # converts to arrays with at least one dimension
-        p = np.atleast_1d(p)
-        _, ii = tree.query([x, y], k, distance_upper_bound=1e-3)  # get indices of k neighbors of the point (max: 1e-3m)
-        
-        neighbor_xy = [sdf.iloc[i-1].to_numpy() for i in ii]  # size: (k, 5 vars)
-        neighbors = [np.concatenate((xy, v, p)) for xy in neighbor_xy]  # list of input vectors x
-        neighbors = [torch.tensor(neighbor).expand(1, -1) for neighbor in neighbors]  # expand to match sizes (i forgot why)
-
-        # concat neighbors and get the mean for each variable
-        mean_tensors = torch.cat([model(neighbor) for neighbor in neighbors], dim=0)
-        return torch.mean(mean_tensors, dim=0)
-
     with torch.no_grad():
-        results = [neighbor_mean(x, 4) for x in chunk]
-    results = torch.stack(results, dim=0)
-    return results
+        points = chunk.numpy()
+        rows = knn[index.numpy()].tocoo()  # (chunk_size, num_nodes), weights 1/num_neighbors
 
+        # neighbor inputs (V, P, x, y): the point's V and P with the neighbor's grid coordinates
+        neighbors = np.concatenate((points[rows.row, :2], sdf.to_numpy()[rows.col]), axis=1)
+        outputs = model(torch.tensor(neighbors, dtype=chunk.dtype))
 
-def worker(queue, results, model, df, k):
-    # function to be executed by each process
-    # runs in an infinite loop until a batch is added to the queue
-    while True:
-        chunk = queue.get()  # retrieve data if a batch is added
-        if chunk is None:  # worker is active until a None is added to the queue
-            break  # terminate the process
-        output = process_batch(chunk, model, df, k)
-        results.put(output)  # add output to the results queue
+        # sparse product (chunk_size, num_neighbors) @ (num_neighbors, 5)
+        weights = torch.tensor(rows.data, dtype=outputs.dtype).unsqueeze(1)
+        results = torch.zeros(len(chunk), outputs.shape[1], dtype=outputs.dtype)
+        results.index_add_(0, torch.from_numpy(rows.row.astype(np.int64)), weights*outputs)
+    return results
 
 
 def c_e(epoch, c=0.2, r=25, which='sigmoid'):
@@ -176,56 +166,56 @@ def save_metadata(out_dir: Path):
     with open(out_dir / 'train_metadata.txt', 'w') as f:
             f.write(f'Model name: {name}\n')
             f.write(f'Lin scaling: {lin}\n')
-            f.write(f'Number of points: {len(data_used)}\n')
+            f.write(f'Number of points: {num_points}\n')
             f.write(f'Target scaling: {minmax_y}\n')
             f.write(f'Parameter exponents: {scale_exp}\n')
+            f.write(f'Precision: {precision}\n')
             f.write(f'Execution time: {(train_end-train_start):.2f} s\n')
             f.write(f'Average time per epoch: {np.array(epoch_times).mean():.2f} s\n')
             f.write(f'\nUser-specified hyperparameters\n')
+            f.write(f'Optimizer: {optimizer_name}\n')
             f.write(f'Batch size: {batch_size}\n')
-            f.write(f'Learning rate: {learning_rate}\n')
-            f.write(f'Validation split: currently not used\n')
+            f.write(f'Learning rate: {learning_rate} (scaling: {lr_scaling}, used: {scaled_lr:g})\n')
+            if target_loss is not None:
+                f.write(f'Time to target loss {target_loss:g}: {target_time} s ({target_epochs} epochs)\n')
+            f.write(f'Validation split: {validation_split}\n')
             f.write(f'Epochs: {epochs}\n')
+            if early_stopping is not None:
+                best = 'none' if early_stopping.best_epoch is None else \
+                    f'{early_stopping.best_epoch+1} (val loss {early_stopping.best_loss:.3e})'
+                f.write(f'Early stopping: patience = {patience}, trained {len(epoch_times)} epochs, best epoch {best}\n')
             f.write(f'Grid augmentation: {xy}\n')
             f.write(f'VP augmentation: {vp}\n')
+            if out_of_core:
+                f.write(f'Out-of-core: {len(trainloader.shards)} shards, shuffle buffer {trainloader.buffer_size} rows\n')
             if neighbor_regularization:
                 f.write(f'Neighbor regularization: k = {k}, lambda = {c} \n')
             else:
                 f.write(f'Neighbor regularization: none\n')
             f.write('\n***end of file***\n')
 
-def gridUnscale(x, y, df):
-    """Unscale a previously minmax-scaled point (x, y)
-
-    Args:
-        x (float): x-coordinate (scaled) 
-        y (float): y-coordinate (scaled)
-        df (pd.DataFrame): df of unscaled x and y
-
-    Returns:
-        x, y: unscaled x, y
-    """
-    xmin = df['X'].min()
-    xmax = df['X'].max()
-    ymin = df['Y'].min()
-    ymax = df['Y'].max()
-
-    # unscale (assuming minmax)
-    x = x*(xmax-xmin) + xmin
-    y = y*(ymax-ymin) + ymin
-
-    return x, y
-
 if __name__ == '__main__':
     # --------------- Model hyperparameters -----------------
 
     root = Path.cwd() 
     data_fldr_path = root/'data'/'avg_data'
-    inputFile = root/'torch'/'conf_dicts.txt'
 
-    # read input file for list of configurations
-    with open(inputFile, 'r') as i:
-        config_list = ast.literal_eval(i.read())
+    parser = ArgumentParser()
+    parser.add_argument('configs', nargs='?', default='conf_dicts.txt', help='config file in torch/')
+    parser.add_argument('--resume', type=Path, default=None,
+                        help='output directory of an interrupted run, continued from its last checkpoint')
+    parser.add_argument('--profile', nargs='?', type=int, const=5, default=None, metavar='STEPS',
+                        help='profile STEPS training steps (default 5) with torch.profiler')
+    args = parser.parse_args()
+
+    if args.resume is not None:
+        # the config is saved with the checkpoints
+        config_list = [dict(load_checkpoint_config(args.resume/'checkpoints'), out_dir=str(args.resume))]
+    else:
+        # read input file for list of configurations
+        inputFile = root/'torch'/args.configs
+        with open(inputFile, 'r') as i:
+            config_list = ast.literal_eval(i.read())
 
     for config in config_list:
 
@@ -240,7 +230,18 @@ if __name__ == '__main__':
         epochs = config['epochs']
         xy = config['xy']
         vp = config['vp']
+        precision = config.get('precision', 'float32')  # float64, float32 or bfloat16
+        telemetry_on = config.get('telemetry', False)  # per-phase timing in telemetry.jsonl
+        patience = config.get('patience')  # epochs without validation improvement before stopping, None to disable
+        optimizer_name = config.get('optimizer', 'adam')  # adam or lbfgs
+        lr_scaling = config.get('lr_scaling')  # None, linear or sqrt (for large batches)
+        target_loss = config.get('target_loss')  # report the time to reach this training loss
         k = config['k']  # number of neighbors, 0 to disable
+        out_of_core = config.get('out_of_core', False)  # train from shards on disk (see data_helpers.write_shards)
+        if config.get('seed') is None:
+            # draw a seed for the validation split and batch order, kept in the config saved with the
+            # checkpoints so that --resume continues on the same split
+            config['seed'] = int(np.random.SeedSequence().entropy % 2**32)
 
         if k == 0:
             neighbor_regularization = False
@@ -260,7 +261,13 @@ if __name__ == '__main__':
         # -------------------------------------------------------
         
         ########## data prep ##########
-        if ((name=='test') & (root/'created_models'/'test_dir_torch').exists()):
+        np_dtype = set_precision(precision)
+        if 'num_threads' in config:  # set by sweep.py to share the cores between runs
+            torch.set_num_threads(config['num_threads'])
+        if 'out_dir' in config:  # set by sweep.py or --resume
+            out_dir = Path(config['out_dir'])
+            out_dir.mkdir(parents=True, exist_ok=True)
+        elif ((name=='test') & (root/'created_models'/'test_dir_torch').exists()):
             out_dir = root/'created_models'/'test_dir_torch'  
         elif ((name=='test') & (not (root/'created_models'/'test_dir_torch').exists())): 
             os.mkdir(root/'created_models'/'test_dir_torch')
@@ -274,45 +281,100 @@ if __name__ == '__main__':
         feature_names = ['V', 'P', 'x', 'y']
         label_names = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
 
-        data_used, data_excluded = data.get_data(root, voltages, pressures, 
-                                                (voltage_excluded, pressure_excluded),
-                                                xy=xy, vp=vp)
-        # sanity check
-        assert list(data_used.columns) == feature_names + label_names
-
-        # set threshold to make very small values zero
-        pd.set_option('display.chop_threshold', 1e-10)
-
-        # scale features and labels
-        scale_exp = []
-        features = data.scale_all(data_used[feature_names], 'x', scaler_dir).astype('float64')
-        labels = data.data_preproc(data_used[label_names], scale_exp).astype('float64')
-
-        if minmax_y:  # if applying minmax to target data
-            labels = data.scale_all(labels, 'y', scaler_dir)
-
-        alldf = pd.concat([features, labels], axis=1)  # TODO: consider removing this
-        dataset_size = len(alldf)
+        if out_of_core:
+            # one pass over the data for the scaling and one to write the scaled shards, a case at a time
+            if batch_size == 'full':
+                raise Exception('full-batch training needs the whole dataset in memory: set out_of_core to False')
+            sources = data.training_sources(root, voltages, pressures, (voltage_excluded, pressure_excluded),
+                                            xy=xy, vp=vp)
+            scaling = Scaling.from_stats(*data.scaling_stats(sources, feature_names, label_names, lin), lin,
+                                         is_target_scaled=minmax_y, dtype=np_dtype,
+                                         feature_names=feature_names, target_names=label_names)
+            scaling.save(out_dir)
+            scaling.features.save(scaler_dir, 'x')
+            if minmax_y:
+                scaling.targets.save(scaler_dir, 'y')
+            scale_exp = scaling.exponents.tolist()
+
+            shard_dir = out_dir/'shards'
+            if (args.resume is None) or not (shard_dir/'shards.json').exists():
+                print('writing training shards...')
+                data.write_shards(sources, scaling, shard_dir, feature_names, label_names, np_dtype,
+                                  config.get('shard_rows', 2**20), validation_split, config.get('seed'))
+            data_excluded = data.get_case(root, voltage_excluded, pressure_excluded)
+
+            # shuffled batches from a buffer of shuffle_buffer rows, the next shard loaded in the background
+            trainloader = ShardDataset(shard_dir, 'train', batch_size, config.get('shuffle_buffer', 2**20),
+                                       drop_last=config.get('drop_last', False), seed=config.get('seed'))
+            # one batch per shard for the loss over a whole split
+            valset = ShardDataset(shard_dir, 'val', config.get('shard_rows', 2**20), shuffle=False)
+            fullset = ShardDataset(shard_dir, 'train', config.get('shard_rows', 2**20), shuffle=False)
+            num_val = valset.num_rows
+            num_points = trainloader.num_rows + num_val
+
+            # every row of the shards has the row of its (x, y) in positions.npy
+            nodes = data_excluded[['X', 'Y']]
+            if neighbor_regularization:
+                knn = get_mesh(nodes).knn_query(np.load(shard_dir/'positions.npy'), k, distance_upper_bound=1e-3)
+            scaledNodes = data.scale_all(data_excluded[['X', 'Y']], 'x', dtype=np_dtype)
+        else:
+            data_used, data_excluded = data.get_data(root, voltages, pressures, 
+                                                    (voltage_excluded, pressure_excluded),
+                                                    xy=xy, vp=vp)
+            # sanity check
+            assert list(data_used.columns) == feature_names + label_names
+            num_points = len(data_used)
+
+            # set threshold to make very small values zero
+            pd.set_option('display.chop_threshold', 1e-10)
+
+            # scale features and labels (the column selections are copies, so they are scaled in place)
+            scale_exp = []
+            features = data.scale_all(data_used[feature_names], 'x', scaler_dir, dtype=np_dtype, inplace=True)
+            labels = data.data_preproc(data_used[label_names], scale_exp, dtype=np_dtype, inplace=True)
+
+            if minmax_y:  # if applying minmax to target data
+                labels = data.scale_all(labels, 'y', scaler_dir, dtype=np_dtype, inplace=True)
+
+            # all of the scaling in one file, for inference (see scalers.Scaling)
+            Scaling.from_scaler_dir(scaler_dir, scale_exp, minmax_y, lin, feature_names, label_names).save(out_dir)
+
+            alldf = pd.concat([features, labels], axis=1)  # TODO: consider removing this
+            dataset_size = len(alldf)
+
+            # k-NN adjacency for neighbor regularization (cached per mesh), with the row of every
+            # training point in it (augmentation points are not mesh nodes, see Mesh.knn_rows)
+            nodes = data_excluded[['X', 'Y']]
+            node_index = np.zeros(len(data_used), dtype=np.int64)
+            if neighbor_regularization:
+                knn, node_index = get_mesh(nodes).knn_rows(data_used[['x', 'y']].to_numpy(), k, distance_upper_bound=1e-3)
+            node_index = torch.tensor(node_index)
+            scaledNodes = data.scale_all(data_excluded[['X', 'Y']], 'x', dtype=np_dtype)
 
-        # kD tree for neighbor regularization (converted to tree later)
-        nodes = data_excluded[['X', 'Y']]
-        tree = cKDTree(np.c_[nodes['X'].to_numpy(), nodes['Y'].to_numpy()])
-        scaledNodes = data.scale_all(data_excluded[['X', 'Y']], 'x') 
+            features = torch.tensor(features.to_numpy())
+            labels = torch.tensor(labels.to_numpy())
 
-        # create dataset object and shuffle it()  # TODO: train/val split
-        features = torch.tensor(features.to_numpy())
-        labels = torch.tensor(labels.to_numpy())
-        dataset = TensorDataset(features, labels)
+            # hold out a random validation set, kept as tensors for a single no_grad forward pass per epoch
+            train_index, val_index = validation_indices(len(features), validation_split, config.get('seed'))
+            val_features, val_labels = features[val_index], labels[val_index]
+            num_val = len(val_features)
+            features, labels, node_index = features[train_index], labels[train_index], node_index[train_index]
 
-        trainloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+            # shuffled batches: one permutation per epoch, batches are slices
+            if batch_size == 'full':  # full-batch training (e.g. with L-BFGS)
+                batch_size = len(features)
+            trainloader = TensorBatchLoader(features, labels, node_index, batch_size=batch_size,
+                                            drop_last=config.get('drop_last', False), seed=config.get('seed'))
 
         model = MLP(name, len(feature_names), len(label_names)) 
         model.share_memory()
         criterion = nn.MSELoss()
-        optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+        scaled_lr = scale_learning_rate(learning_rate, batch_size, config.get('base_batch_size', 128), lr_scaling)
+        optimizer = get_optimizer(optimizer_name, model.parameters(), scaled_lr)
 
         # train the model
         print('begin model training...')
+        print(f'optimizer = {optimizer_name}, batch_size = {batch_size}, learning_rate = {scaled_lr:g}')
         print(f'neighbor_regularization = {neighbor_regularization}')
         if neighbor_regularization:
             print(f'lambda = {c}, k = {k}')
@@ -322,60 +384,109 @@ if __name__ == '__main__':
         epoch_loss = []
         train_losses = []
         neighbor_losses = []
+        full_losses = []  # training loss on the full dataset, if target_loss is set
+        val_losses = []
+        val_times = []
+        early_stopping = EarlyStopping(patience, config.get('min_delta', 0.0)) if patience else None
+        stopped_epoch = None
+
+        # periodic checkpoints, written in the background
+        checkpoint_every = config.get('checkpoint_every', 10)  # epochs
+        checkpointer = Checkpointer(out_dir/'checkpoints', keep=config.get('keep_checkpoints', 3))
+        start_epoch = 0
+        if args.resume is not None:
+            start_epoch, history = checkpointer.load(model, optimizer, trainloader.generator)
+            epoch_times, epoch_loss, train_losses, neighbor_losses, full_losses, val_losses, val_times = (
+                history[key] for key in ('epoch_times', 'epoch_loss', 'train_losses', 'neighbor_losses', 'full_losses',
+                                         'val_losses', 'val_times'))
+            c = history['c']
+            if early_stopping is not None:
+                early_stopping.load_state_dict(history['early_stopping'])
+
+        telemetry = Telemetry(out_dir/'telemetry.jsonl', enabled=telemetry_on)
+        profiler = Profiler(out_dir, enabled=args.profile is not None, steps=args.profile)
+        profiler.start()
 
         model.train()
         # model training loop
-        for epoch in tqdm(range(epochs), desc='Training...', colour='#7dc4e4'):
+        epoch_bar = tqdm(range(start_epoch, epochs), desc='Training...', colour='#7dc4e4',
+                         initial=start_epoch, total=epochs)
+        for epoch in epoch_bar:
             # record time per epoch
             epoch_start = time.time()
-            loop = tqdm(trainloader, unit='batch', colour='#f5a97f')
-
-            for i, batch_data in enumerate(loop):
-                # get the inputs; data is a list of [inputs, labels]
-                inputs, labels = batch_data
 
+            for inputs, targets, index in telemetry.iterate(trainloader):
                 if neighbor_regularization:
                     # means not calculated if regularization is disabled
                     c = c_e(epoch, c=c)
-                    neighbor_means = process_batch(inputs, model, tree, scaledNodes)
+                    with telemetry.phase('regularization'):
+                        neighbor_means = process_batch(inputs, index, model, knn, scaledNodes)
                 else:
-                    neighbor_means = 0
+                    neighbor_means = None
                 
-                # zero the parameter gradients
-                optimizer.zero_grad()
-
-                # record losses
-                running_loss = 0.0
-
-                outputs = model(inputs)  # forward pass
-                train_loss = criterion(outputs, labels)
-                if neighbor_regularization:
-                    neighbor_loss = criterion(outputs, neighbor_means)
-                    loss = train_loss + c*neighbor_loss  # second term 0 if neighbor_regularization turned off
-                else: loss = train_loss
-                loss.backward()  # compute gradients
-                optimizer.step()  # apply changes to network
-
-                # print statistics
-                running_loss += loss.item()
-                loop.set_description(f"Epoch {epoch+1}/{epochs}")
-                loop.set_postfix(loss=running_loss)
-                running_loss = 0.0
+                loss, train_loss, neighbor_loss = train_step(model, optimizer, criterion, inputs, targets,
+                                                             neighbor_means, c, precision, telemetry)
+                telemetry.end_batch(len(inputs))
+                profiler.step()
 
             epoch_end = time.time()
             epoch_times.append(epoch_end - epoch_start)
             epoch_loss.append(loss.item())
+            epoch_bar.set_postfix(loss=epoch_loss[-1])
             train_losses.append(train_loss.item())
             if neighbor_regularization: neighbor_losses.append(neighbor_loss.item()) 
-
-            if (epoch+1) % epochs == 0:
-                # save model every 10 epochs (so i dont lose all training progress in case i do something dumb)
-                torch.save(model.state_dict(), out_dir/f'{name}')
-                plot.save_history_graph(epoch_loss, out_dir)
-
-
+            if target_loss is not None:
+                # mini-batch losses are too noisy to compare against full-batch training
+                with torch.no_grad(), autocast(precision):
+                    if out_of_core:
+                        full_losses.append(dataset_loss(model, criterion, fullset))
+                    else:
+                        full_losses.append(criterion(model(features), labels).item())
+
+            stop = False
+            if num_val > 0:
+                val_start = time.time()
+                model.eval()
+                with torch.no_grad(), autocast(precision):
+                    if out_of_core:
+                        val_losses.append(dataset_loss(model, criterion, valset))
+                    else:
+                        val_losses.append(criterion(model(val_features), val_labels).item())
+                model.train()
+                val_times.append(time.time() - val_start)
+                epoch_bar.set_postfix(loss=epoch_loss[-1], val_loss=val_losses[-1])
+                if early_stopping is not None:
+                    stop = early_stopping.step(val_losses[-1], model, epoch)
+
+            telemetry.end_epoch(epoch, loss=epoch_loss[-1], train_loss=train_losses[-1],
+                                neighbor_loss=neighbor_losses[-1] if neighbor_regularization else None,
+                                val_loss=val_losses[-1] if val_losses else None)
+
+            if (epoch+1) % checkpoint_every == 0 or epoch+1 == epochs or stop:
+                # checkpoint every few epochs (so i dont lose all training progress in case i do something dumb)
+                history = {'epoch_times': epoch_times, 'epoch_loss': epoch_loss, 'train_losses': train_losses,
+                           'neighbor_losses': neighbor_losses, 'full_losses': full_losses, 
+                           'val_losses': val_losses, 'val_times': val_times, 'c': c,
+                           'early_stopping': None if early_stopping is None else early_stopping.state_dict()}
+                checkpointer.save(epoch, model, optimizer, history, config, trainloader.generator)
+
+            if stop:
+                stopped_epoch = epoch + 1
+                print(f'\nearly stopping after epoch {stopped_epoch}: no improvement in {patience} epochs')
+                break
+
+        profiler.stop()
+        checkpointer.close()
+        telemetry.close()
+        if out_of_core and not config.get('keep_shards', False):
+            shutil.rmtree(shard_dir)
+        if early_stopping is not None:
+            early_stopping.restore(model)  # best weights
         print('Finished training')
         train_end = time.time()
+        if target_loss is not None:
+            target_time, target_epochs = time_to_target(epoch_times, full_losses, target_loss)
+            print(f'time to target loss {target_loss:g}: {target_time} s ({target_epochs} epochs)')
 
         # save the model and loss
         torch.save(model.state_dict(), out_dir/f'{name}')
@@ -387,7 +498,22 @@ if __name__ == '__main__':
         metadata = {'name' : name,  # str
                     'scaling' : lin,  # bool
                     'is_target_scaled': minmax_y,  # bool
-                    'parameter_exponents': scale_exp}  # list of float
+                    'parameter_exponents': scale_exp,  # list of float
+                    'precision': precision,  # str
+                    'out_of_core': out_of_core,  # bool
+                    'optimizer': optimizer_name,  # str
+                    'loss': epoch_loss[-1],  # float, last batch
+                    'train_loss': train_losses[-1],  # float, last batch
+                    'neighbor_loss': neighbor_losses[-1] if neighbor_regularization else None,  # float
+                    'execution_time': train_end - train_start,  # float, s
+                    'val_loss': min(val_losses) if val_losses else None,  # float, best epoch
+                    'validation_time': sum(val_times),  # float, s
+                    'epochs_trained': len(epoch_times),  # int
+                    'stopped_epoch': stopped_epoch,  # int, None if not stopped early
+                    'best_epoch': None if (early_stopping is None or early_stopping.best_epoch is None)
+                                  else early_stopping.best_epoch + 1}  # int
+        if target_loss is not None:
+            metadata['time_to_target'] = target_time  # float, s (None if not reached)
 
         with open(out_dir / 'train_metadata.pkl', 'wb') as f:
             pickle.dump(metadata, f)
@@ -395,9 +521,12 @@ if __name__ == '__main__':
         # record time per epoch
         with open(out_dir / 'times.txt', 'w') as f:
             f.write('Train times per epoch\n')
-            for i, time in enumerate(epoch_times):
-                time = round(time, 2)
-                f.write(f'Epoch {i+1}: {time} s\n')
+            for i, epoch_time in enumerate(epoch_times):
+                epoch_time = round(epoch_time, 2)
+                if val_times:
+                    f.write(f'Epoch {i+1}: {epoch_time} s (validation: {val_times[i]*1e3:.1f} ms)\n')
+                else:
+                    f.write(f'Epoch {i+1}: {epoch_time} s\n')
 
         d = datetime.datetime.today()
         print('finished on', d.strftime('%Y-%m-%d %H:%M:%S'))
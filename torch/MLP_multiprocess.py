@@ -7,28 +7,34 @@ author @jarl
 
 import os
 import sys
+import copy
 import time
+import queue
 import datetime
 import shutil
 import pickle
+import traceback
 from tqdm import tqdm
 from pathlib import Path
 import torch.multiprocessing as mp
 
 import numpy as np
 import pandas as pd
-from scipy.spatial import cKDTree
+import scipy.sparse as sp
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import TensorDataset, DataLoader
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 
-import data
+import data_helpers as data
 import plot
+from mesh import get_mesh
+from scalers import Scaling
+from MLP import process_batch
+from train_helpers import set_precision, autocast, TensorBatchLoader
 
-torch.set_default_dtype(torch.float64)
 class MLP(nn.Module):
     """Neural network momdel for grid-wise prediction of 2D-profiles.
 
@@ -79,52 +85,98 @@ class MLP(nn.Module):
 
 
 ####### neighbor regularization #######
-def process_chunk(chunk: torch.Tensor, model: MLP, df: pd.DataFrame, k=4) -> torch.Tensor: 
-    """Per-chunk processing of the input tensor.
+def worker(tasks, results, model, weights, version, knn, sdf):
+    """Neighbor-mean worker, run by each process of a NeighborPool.
 
-    Takes a chunk of a batch as an input, along with the current model, and a DataFrame of 
-    grid coordinates. The cKDTree is also created from this df.
-    Args:
-        chunk (torch.Tensor): _description_
-        model (MLP): _description_
-        df (pd.DataFrame): _description_
-
-    Returns:
-        torch.Tensor: Tensor of size (chunk_size, 5) containing neighbor means of the input chunk.
+    Runs in a loop until a None is added to the task queue. Every task is tagged with the
+    offset of its chunk in the batch and the version of the weights it must be evaluated
+    with; the weights are reloaded from shared memory whenever the version changes.
+    Errors are sent back to the parent instead of dropping the chunk.
     """
-
-    def neighbor_mean(point: torch.Tensor, k):
-        # get a point's neighbors
-        x, y, v, p = point.numpy() # -> np.ndarray
-        v = np.atleast_1d(v)
-        p = np.atleast_1d(p)
-        _, ii = tree.query([x, y], k)  # get indices of k neighbors of the point
-        
-        neighbor_xy = [df[['X', 'Y']].iloc[i].to_numpy() for i in ii]  # size: (k, 5)
-        neighbors = [np.concatenate((xy, v, p)) for xy in neighbor_xy]  # list of input vectors x
-        neighbors = [torch.tensor(neighbor).expand(1, -1) for neighbor in neighbors]
-
-        # concat neighbors and get the mean for each variable
-        mean_tensors = torch.cat([model(neighbor) for neighbor in neighbors], dim=0)
-        return torch.mean(mean_tensors, dim=0)
-    
-    tree = cKDTree(np.c_[df['X'].to_numpy(), df['Y'].to_numpy()])
-
-    with torch.no_grad():
-        results = [neighbor_mean(x, 4) for x in chunk]
-    results = torch.stack(results, dim=0)
-    return results
-
-
-def worker(queue, results, model, df, k):
-    # function to be executed by each process
-    # runs in an infinite loop until a batch is added to the queue
+    torch.set_num_threads(1)  # one thread per process, the pool provides the parallelism
+    loaded = -1  # version of the weights in the local model
     while True:
-        chunk = queue.get()  # retrieve data if a batch is added
-        if chunk is None:  # worker is active until a None is added to the queue
+        task = tasks.get()  # retrieve data if a chunk is added
+        if task is None:  # worker is active until a None is added to the queue
             break  # terminate the process
-        output = process_chunk(chunk, model, df, k)
-        results.put(output)  # add output to the results queue
+        offset, task_version, chunk, index = task
+        try:
+            if task_version != loaded:
+                if task_version != version.value:
+                    raise Exception(f'chunk expects weights v{task_version}, shared weights are v{version.value}')
+                vector_to_parameters(weights, model.parameters())
+                loaded = task_version
+            results.put((offset, process_batch(chunk, index, model, knn, sdf)))
+        except Exception:
+            results.put((offset, traceback.format_exc()))
+
+
+class NeighborPool:
+    """Persistent pool of processes computing the neighbor means of a batch.
+
+    The model weights are kept in a shared-memory vector with a version counter, which
+    is bumped by publish() after every optimizer step. Batches are split into chunks tagged
+    with their offset and reassembled in order, and a missing or failed chunk raises an
+    exception instead of being dropped.
+
+    Args:
+        model (MLP): Model being trained (copied to the workers).
+        knn (sp.csr_matrix): Row-normalized k-NN adjacency of the mesh.
+        sdf (pd.DataFrame): DataFrame of scaled nodes (grid points).
+        num_processes (int, optional): Number of workers. Defaults to the number of cores.
+        timeout (float, optional): Time (s) to wait for a chunk before failing. Defaults to 60.
+    """
+    def __init__(self, model: MLP, knn: sp.csr_matrix, sdf: pd.DataFrame, num_processes=None, timeout=60) -> None:
+        self.num_processes = num_processes or mp.cpu_count()
+        self.timeout = timeout
+        self.weights = parameters_to_vector(model.parameters()).detach().clone().share_memory_()
+        self.version = mp.Value('i', 0)
+        self.tasks = mp.Queue()
+        self.results = mp.Queue()
+        self.processes = [mp.Process(target=worker, daemon=True,
+                                     args=(self.tasks, self.results, copy.deepcopy(model), 
+                                           self.weights, self.version, knn, sdf))
+                          for _ in range(self.num_processes)]
+        for p in self.processes:
+            p.start()
+
+    def publish(self, model: MLP) -> None:
+        """Copy the current weights of model to shared memory and bump the version."""
+        with torch.no_grad():
+            self.weights.copy_(parameters_to_vector(model.parameters()))
+        with self.version.get_lock():
+            self.version.value += 1
+
+    def neighbor_means(self, inputs: torch.Tensor, index: torch.Tensor) -> torch.Tensor:
+        """Neighbor means of a batch, in the order of inputs (see process_batch)."""
+        chunk_size = -(-len(inputs) // self.num_processes)  # ceil
+        offsets = range(0, len(inputs), chunk_size)
+        for offset in offsets:
+            self.tasks.put((offset, self.version.value,
+                            inputs[offset:offset+chunk_size], index[offset:offset+chunk_size]))
+
+        outputs = {}
+        for _ in offsets:
+            try:
+                offset, output = self.results.get(timeout=self.timeout)
+            except queue.Empty:
+                exitcodes = [p.exitcode for p in self.processes]
+                raise Exception(f'no neighbor means received for {self.timeout} s '
+                                f'({len(outputs)}/{len(offsets)} chunks done, worker exit codes: {exitcodes})')
+            outputs[offset] = output
+
+        # collect every chunk before failing, so that no stale results are left in the queue
+        for offset, output in outputs.items():
+            if isinstance(output, str):  # traceback of a failed chunk
+                raise Exception(f'neighbor mean worker failed on chunk at offset {offset}:\n{output}')
+        return torch.cat([outputs[offset] for offset in offsets], dim=0)
+
+    def close(self) -> None:
+        """Add a sentinel value for each worker and wait for them to terminate."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join()
 
 
 def c_e(epoch, c=0.2, r=25, which='sigmoid'):
@@ -177,6 +229,7 @@ def save_metadata(out_dir: Path):
             f.write(f'Number of points: {len(data_used)}\n')
             f.write(f'Target scaling: {minmax_y}\n')
             f.write(f'Parameter exponents: {scale_exp}\n')
+            f.write(f'Precision: {precision}\n')
             f.write(f'Execution time: {(train_end-train_start):.2f} s\n')
             f.write(f'Average time per epoch: {np.array(epoch_times).mean():.2f} s\n')
             f.write(f'\nUser-specified hyperparameters\n')
@@ -211,6 +264,8 @@ if __name__ == '__main__':
     xy = eval(lines[5])
     vp = eval(lines[6])
     k = eval(lines[7])
+    precision = lines[8] if len(lines) > 8 else 'float32'  # float64, float32 or bfloat16
+    np_dtype = set_precision(precision)
     minmax_y = True  # apply minmax scaling to targets 
     lin = True  # scale the targets linearly
 
@@ -252,45 +307,40 @@ if __name__ == '__main__':
     # set threshold to make very small values zero
     pd.set_option('display.chop_threshold', 1e-10)
 
-    # scale features and labels
+    # scale features and labels (the column selections are copies, so they are scaled in place)
     scale_exp = []
-    features = data.scale_all(data_used[feature_names], 'x', scaler_dir).astype('float64')
-    labels = data.data_preproc(data_used[label_names], scale_exp).astype('float64')
+    features = data.scale_all(data_used[feature_names], 'x', scaler_dir, dtype=np_dtype, inplace=True)
+    labels = data.data_preproc(data_used[label_names], scale_exp, dtype=np_dtype, inplace=True)
 
     if minmax_y:  # if applying minmax to target data
-        labels = data.scale_all(labels, 'y', scaler_dir)
+        labels = data.scale_all(labels, 'y', scaler_dir, dtype=np_dtype, inplace=True)
+
+    # all of the scaling in one file, for inference (see scalers.Scaling)
+    Scaling.from_scaler_dir(scaler_dir, scale_exp, minmax_y, lin, feature_names, label_names).save(out_dir)
 
     alldf = pd.concat([features, labels], axis=1)  # TODO: consider removing this
     dataset_size = len(alldf)
 
-    # kD tree for neighbor regularization
-    nodes_df = data.scale_all(data_excluded[['X', 'Y']], 'x') 
+    # k-NN adjacency for neighbor regularization (cached per mesh), with the row of every
+    # training point in it (augmentation points are not mesh nodes, see Mesh.knn_rows)
+    nodes = data_excluded[['X', 'Y']]
+    knn, node_index = get_mesh(nodes).knn_rows(data_used[['x', 'y']].to_numpy(), k, distance_upper_bound=1e-3)
+    node_index = torch.tensor(node_index)
+    nodes_df = data.scale_all(nodes, 'x', dtype=np_dtype)
 
-    # create dataset object and shuffle it()  # TODO: train/val split
+    # shuffled batches: one permutation per epoch, batches are slices  # TODO: train/val split
     features = torch.tensor(features.to_numpy())
     labels = torch.tensor(labels.to_numpy())
-    dataset = TensorDataset(features, labels)
-
-    trainloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    trainloader = TensorBatchLoader(features, labels, node_index, batch_size=batch_size)
 
     model = MLP(name, len(feature_names), len(label_names)) 
-    model.share_memory()
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
     # initialize multiprocessing for neighbor mean
     num_processes = mp.cpu_count()
-    chunk_size = int(batch_size/num_processes)
-    queue = mp.Queue()
-    results = mp.Queue()
-    processes = [mp.Process(target=worker, args=(queue, results, model, nodes_df, k)) for _ in range(num_processes)]
-    
-    # signal each worker to start if not already started
-    print(f'Multicore neighbor mean processing ({num_processes} cores):')
-    for i, p in enumerate(processes):
-        if not p.is_alive():
-            p.start()
-            print(f'spawned process {i+1}/{num_processes}')
+    pool = NeighborPool(model, knn, nodes_df, num_processes)
+    print(f'Multicore neighbor mean processing ({num_processes} cores)')
 
     # train the model
     print('begin model training...')
@@ -301,60 +351,32 @@ if __name__ == '__main__':
 
     model.train()
     # model training loop
-    for epoch in tqdm(range(epochs)):
+    epoch_bar = tqdm(range(epochs))
+    for epoch in epoch_bar:
         # record time per epoch
         epoch_start = time.time()
-        loop = tqdm(trainloader)
 
-        for i, batch_data in enumerate(loop):
-            # get the inputs; data is a list of [inputs, labels]
-            inputs, labels = batch_data
-            doubleLoader = DataLoader(inputs, batch_size=chunk_size)
+        for inputs, labels, index in trainloader:
             c = c_e(epoch)
-
-            # load data into queue
-            for chunk in doubleLoader:
-                queue.put(chunk)
-
-            # retrieve processed data from the results queue
-            worker_outputs = []
-            for _ in range(num_processes):
-                try:
-                    output = results.get(timeout=2)
-                    worker_outputs.append(output)
-                except:
-                    pass
-
-            neighbor_means = torch.cat(worker_outputs, dim=0)
+            neighbor_means = pool.neighbor_means(inputs, index)
             
             # zero the parameter gradients
             optimizer.zero_grad()
 
-            # record losses
-            running_loss = 0.0
-
-            outputs = model(inputs)  # forward pass
-            loss = criterion(outputs, labels) + c*criterion(outputs, neighbor_means)
+            with autocast(precision):  # no-op unless precision is bfloat16
+                outputs = model(inputs)  # forward pass
+                loss = criterion(outputs, labels) + c*criterion(outputs, neighbor_means)
             loss.backward()  # compute gradients
             optimizer.step()  # apply changes to network
-
-            # print statistics
-            running_loss += loss.item()
-            loop.set_description(f"Epoch {epoch+1}/{epochs}")
-            loop.set_postfix(loss=running_loss)
-            running_loss = 0.0
+            pool.publish(model)  # workers pick up the new weights for the next batch
 
         epoch_end = time.time()
         epoch_times.append(epoch_end - epoch_start)
         epoch_loss.append(loss.item())
+        epoch_bar.set_postfix(loss=epoch_loss[-1])
 
-    # when finished, add a sentinel value to the queue to signal termination
-    for _ in range(num_processes):
-        queue.put(None)
-
-    # wait for all processes to terminate
-    for p in processes:
-        p.join()
+    # when finished, terminate the workers
+    pool.close()
 
     print('Finished training')
     train_end = time.time()
@@ -369,7 +391,8 @@ if __name__ == '__main__':
     metadata = {'name' : name,  # str
                 'scaling' : lin,  # bool
                 'is_target_scaled': minmax_y,  # bool
-                'parameter_exponents': scale_exp}  # list of float
+                'parameter_exponents': scale_exp,  # list of float
+                'precision': precision}  # str
 
     with open(out_dir / 'train_metadata.pkl', 'wb') as f:
         pickle.dump(metadata, f)
@@ -7,6 +7,7 @@ import os
 import time
 import pickle
 from pathlib import Path
+from argparse import ArgumentParser
 
 import matplotlib.pyplot as plt
 
@@ -29,6 +30,7 @@ from autoencoder_classes import A300, A64_7, A64_6s, A300s
 from data_helpers import ImageDataset, train2db
 from plot import plot_comparison_ae, save_history_graph, ae_correlation
 from image_data_helpers import get_data
+from train_helpers import Checkpointer, EarlyStopping, Profiler
 
 
 def plot_train_loss(losses, validation_losses=None):  # TODO: move to plot module
@@ -65,9 +67,15 @@ def write_metadata(out_dir):  # TODO: move to data module
         print("\n", file=f)
         print(model, file=f)
         f.write(f'\nEpochs: {epochs}\n')
+        if early_stopping is not None:
+            best = 'none' if early_stopping.best_epoch is None else \
+                f'{early_stopping.best_epoch+1} (val loss {early_stopping.best_loss:.3e})'
+            f.write(f'Early stopping: patience = {patience}, trained {len(epoch_loss)} epochs, best epoch {best}\n')
         f.write(f'Learning rate: {learning_rate}\n')
         f.write(f'Resolution: {resolution}\n')
         f.write(f'Train time: {(train_end-train_start):.2f} s\n')
+        f.write(f'Validation time: {sum(validation_times):.2f} s '
+                f'({np.mean(validation_times)*1e3:.1f} ms per epoch)\n')
         # f.write(
         #     f'Average time per epoch: {np.array(epoch_times).mean():.2f} s\n')
         f.write(f'Evaluation time: {(eval_time):.2f} ms\n')
@@ -77,6 +85,14 @@ def write_metadata(out_dir):  # TODO: move to data module
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of the model')
+    parser.add_argument('--profile', nargs='?', type=int, const=5, default=None, metavar='STEPS',
+                        help='profile STEPS training steps (default 5) with torch.profiler')
+    parser.add_argument('--patience', type=int, default=None,
+                        help='stop after PATIENCE epochs without validation improvement (default: train all epochs)')
+    args = parser.parse_args()
+
     # set metal backend (apple socs)
     device = torch.device(
         'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -98,18 +114,36 @@ if __name__ == '__main__':
 
     dataset = TensorDataset(torch.tensor(train, device=device, dtype=torch.float32))
     trainloader = DataLoader(dataset, batch_size=1, shuffle=True)
+    val = torch.tensor(val, device=device, dtype=torch.float32)  # held-out (V, P), evaluated every epoch
 
     # hyperparameters (class property?)
     epochs = 500
     learning_rate = 1e-3
+    patience = args.patience  # epochs without validation improvement before stopping, None to disable
     model = A64_7().to(device)  # move model to gpu
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
     epoch_loss = []
     epoch_validation = []
-    loop = tqdm(range(epochs), desc='Training...', unit='epoch', colour='#7dc4e4')
-
+    validation_times = []
+    early_stopping = EarlyStopping(patience) if patience else None
+
+    # periodic checkpoints, written in the background
+    checkpointer = Checkpointer(out_dir/'checkpoints', keep=3)
+    start_epoch = 0
+    if args.resume:
+        start_epoch, history = checkpointer.load(model, optimizer)
+        epoch_loss, epoch_validation = history['epoch_loss'], history['epoch_validation']
+        validation_times = history['validation_times']
+        if early_stopping is not None:
+            early_stopping.load_state_dict(history['early_stopping'])
+
+    loop = tqdm(range(start_epoch, epochs), desc='Training...', unit='epoch', colour='#7dc4e4',
+                initial=start_epoch, total=epochs)
+
+    profiler = Profiler(out_dir, enabled=args.profile is not None, steps=args.profile)
+    profiler.start()
     train_start = time.time()
     for epoch in loop:
         for i, batch_data in enumerate(trainloader):
@@ -127,18 +161,31 @@ if __name__ == '__main__':
 
             running_loss += loss.item()
             loop.set_description(f"Epoch {epoch+1}/{epochs}")
+            profiler.step()
 
+        val_start = time.time()
         with torch.no_grad():
             val_loss = criterion(model(val), val).item()
+        validation_times.append(time.time() - val_start)
 
         epoch_validation.append(val_loss)
         epoch_loss.append(running_loss)
-
-        if (epoch+1) % epochs == 0:
-            # save model every 10 epochs (so i dont lose all training progress in case i do something unwise)
-            torch.save(model.state_dict(), out_dir/f'{name}')
-            save_history_graph(epoch_loss, out_dir)
-
+        stop = early_stopping is not None and early_stopping.step(val_loss, model, epoch)
+
+        if (epoch+1) % 10 == 0 or stop:
+            # checkpoint every 10 epochs (so i dont lose all training progress in case i do something unwise)
+            checkpointer.save(epoch, model, optimizer,
+                              {'epoch_loss': epoch_loss, 'epoch_validation': epoch_validation,
+                               'validation_times': validation_times,
+                               'early_stopping': None if early_stopping is None else early_stopping.state_dict()})
+        if stop:
+            print(f'\nearly stopping after epoch {epoch+1}: no improvement in {patience} epochs')
+            break
+
+    profiler.stop()
+    checkpointer.close()
+    if early_stopping is not None:
+        early_stopping.restore(model)  # best weights
     train_end = time.time()
 
     with torch.no_grad():
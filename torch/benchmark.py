@@ -0,0 +1,418 @@
+"""
+Benchmarks for the data loading and training hot paths.
+
+Compares the vectorized read_file against the original line-by-line parser, which
+called eval() on every number of every node line, and (with --neighbors) the
+single-process neighbor means of MLP.py against the worker pool of MLP_multiprocess.py.
+
+With --suite, every hot path (parsing, preprocessing, scaling, neighbor means, regression
+scaling, image downscaling and the forward pass of every model class) is timed on CPU with
+synthetic data. Each benchmark runs in its own process, so that its peak memory can be
+measured. The median and p95 times and the peak memory are saved to a json file (named
+after the current commit), which can be compared against a baseline with --compare.
+
+usage: python torch/benchmark.py [files ...] [-r REPEAT]
+       python torch/benchmark.py --neighbors [-b BATCH_SIZE ...] [-p PROCESSES ...] [-r REPEAT]
+       python torch/benchmark.py --suite [-n NODES] [-r REPEAT] [-o OUT] [--compare BASELINE]
+
+created: @jarl
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import inspect
+import resource
+import tempfile
+import platform
+import subprocess
+import multiprocessing as mp
+from pathlib import Path
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+import pandas as pd
+import torch
+
+import data_helpers
+
+
+def read_file_eval(file_path):
+    """Original read_file (per-token eval), kept as the benchmark reference."""
+    with open(file_path, 'r') as f:
+        data = []
+        for n,line in enumerate(f,1):
+            if n==1:
+                line = line.strip()
+                line = re.findall(r'"[^"]*"', line) # get ['"var_name1"', '"var_name2"', ...]
+                column_labels = [var_name.replace('"','') for var_name in line]
+            elif n==2:
+                continue
+            else:
+                data_line = [eval(data) for data in line.split()]
+                if len(data_line)==4:
+                    break
+                data.append(data_line)
+    return pd.DataFrame(data, columns=column_labels)
+
+
+def time_call(func, *args, repeat=5, **kwargs):
+    """Call func repeatedly and return the list of wall times (s) and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def bench_read_file(file_path: Path, repeat=5):
+    """Compare the old and new .dat parsers on a single file.
+
+    Args:
+        file_path (Path): Path to a {V}Vpp_{P}Pa_node.dat file.
+        repeat (int, optional): Number of timed calls per parser. Defaults to 5.
+
+    Returns:
+        dict: Median times (s) for each parser and the speedup.
+    """
+    eval_times, reference = time_call(read_file_eval, file_path, repeat=repeat)
+    fast_times, result = time_call(data_helpers.read_file, file_path, repeat=repeat)
+    proj_times, _ = time_call(data_helpers.read_file, file_path, repeat=repeat,
+                              columns=data_helpers.not_efield)
+
+    # both parsers have to agree before the timings mean anything
+    assert list(result.columns) == list(reference.columns)
+    assert np.allclose(result.to_numpy(), reference.to_numpy(dtype=np.float64), rtol=1e-12)
+
+    return {'file': file_path.name,
+            'nodes': len(result),
+            'eval (s)': np.median(eval_times),
+            'read_file (s)': np.median(fast_times),
+            'read_file, no Ex/Ey (s)': np.median(proj_times),
+            'speedup': np.median(eval_times)/np.median(fast_times)}
+
+
+def bench_neighbor_means(batch_size, num_processes, k=4, repeat=5):
+    """Compare the single-process neighbor means against a NeighborPool.
+
+    Uses a synthetic 100x300 grid with 0.5 mm spacing, so that every node has k neighbors
+    within the 1 mm bound, and an untrained model in float32.
+
+    Args:
+        batch_size (int): Number of points per batch.
+        num_processes (int): Number of pool workers.
+        k (int, optional): Number of neighbors. Defaults to 4.
+        repeat (int, optional): Number of timed calls per path. Defaults to 5.
+
+    Returns:
+        dict: Median times (s) for each path and the speedup of the pool.
+    """
+    from mesh import Mesh
+    from MLP import MLP, process_batch
+    from MLP_multiprocess import NeighborPool
+
+    torch.set_default_dtype(torch.float32)
+    x, y = np.meshgrid(np.arange(100)*5e-4, np.arange(300)*5e-4)
+    nodes = np.c_[x.ravel(), y.ravel()]
+    knn = Mesh(nodes).knn_adjacency(k, cache_dir=Path(tempfile.mkdtemp()))
+    sdf = pd.DataFrame((nodes - nodes.min(axis=0))/np.ptp(nodes, axis=0), columns=['X', 'Y'], dtype=np.float32)
+
+    rng = np.random.default_rng(0)
+    index = torch.tensor(rng.integers(0, len(nodes), batch_size))
+    inputs = torch.tensor(np.c_[sdf.to_numpy()[index.numpy()], rng.random((batch_size, 2), dtype=np.float32)])
+    model = MLP('bench', 4, 5)
+
+    serial_times, reference = time_call(process_batch, inputs, index, model, knn, sdf, repeat=repeat)
+    pool = NeighborPool(model, knn, sdf, num_processes)
+    try:
+        pool.neighbor_means(inputs, index)  # warm up the workers
+        pool_times, result = time_call(pool.neighbor_means, inputs, index, repeat=repeat)
+    finally:
+        pool.close()
+
+    # the pool has to return the same means, in the same order
+    assert torch.allclose(result, reference, rtol=1e-5, atol=1e-6)
+
+    return {'batch size': batch_size,
+            'processes': num_processes,
+            'single process (s)': np.median(serial_times),
+            'pool (s)': np.median(pool_times),
+            'speedup': np.median(serial_times)/np.median(pool_times)}
+
+
+####### benchmark suite #######
+voltages  = [200, 300, 400, 500] # V
+pressures = [  5,  10,  30,  45, 60, 80, 100, 120] # Pa
+feature_names = ['V', 'P', 'x', 'y']
+label_names = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
+
+# input shape (channels, height, width) of each model class, by the resolution it was built for
+ae_inputs = {'A212': (5, 32, 32), 'A300': (5, 32, 32), 'A300s': (5, 32, 32),
+             'A64_7': (5, 64, 64), 'A64_6': (5, 64, 64), 'A64_6s': (5, 64, 64),
+             'SquareAE64': (5, 64, 64), 'Autoencoder': (5, 707, 200)}
+mlp_outputs = {'MLP': 20*4*4, 'MLP1': 20*4*4, 'MLP64': 40*8*8}  # encoding sizes
+
+
+def write_node_files(data_dir: Path, num_nodes: int, seed=0):
+    """Write a synthetic {V}Vpp_{P}Pa_node.dat file for every case of the suite.
+
+    Uses the fields of synthetic_data.py on a regular grid with 0.5 mm spacing, 100 nodes
+    wide, so that every node has neighbors within the 1 mm bound of the k-NN adjacency.
+    """
+    from synthetic_data import write_cases
+    width = 100
+    height = max(2, num_nodes // width)
+    x, y = np.meshgrid(np.arange(width)*5e-4, np.arange(height)*5e-4)
+    ix, iy = np.meshgrid(np.arange(width-1), np.arange(height-1))
+    corner = (iy*width + ix).ravel()
+    elements = np.c_[corner, corner+1, corner+width+1, corner+width]
+    write_cases(data_dir, np.c_[x.ravel(), y.ravel()], elements, voltages, pressures, seed)
+
+
+def suite(fixture_dir: Path) -> dict:
+    """Benchmarks of the suite, by name.
+
+    Every entry is a setup function that prepares its inputs (untimed) and returns the
+    function to time.
+    """
+    node_file = fixture_dir/'300Vpp_060Pa_node.dat'
+
+    def read_all():
+        return data_helpers.read_all_data(fixture_dir, voltages, pressures, columns=data_helpers.not_efield)
+
+    def training_table():
+        table = read_all().rename(columns={'Vpp [V]': 'V', 'P [Pa]': 'P', 'X': 'x', 'Y': 'y'})
+        return table[feature_names + label_names]
+
+    def setup_preproc():
+        labels = training_table()[label_names]
+        return lambda: data_helpers.data_preproc(labels, [])
+
+    def setup_scale_all():
+        features = training_table()[feature_names]
+        return lambda: data_helpers.scale_all(features, 'x')
+
+    def setup_process_batch():
+        from mesh import Mesh
+        from MLP import MLP, process_batch
+        torch.set_default_dtype(torch.float32)
+        nodes = data_helpers.read_file(node_file, columns=['X', 'Y'])
+        knn = Mesh(nodes.to_numpy()).knn_adjacency(4, cache_dir=fixture_dir)
+        sdf = data_helpers.scale_all(nodes, 'x', dtype=np.float32)
+        rng = np.random.default_rng(0)
+        index = torch.tensor(rng.integers(0, len(nodes), 4096))
+        inputs = torch.tensor(np.c_[sdf.to_numpy()[index.numpy()], rng.random((4096, 2), dtype=np.float32)])
+        model = MLP('bench', 4, 5)
+        return lambda: process_batch(inputs, index, model, knn, sdf)
+
+    def regression_case():
+        # scalers of a model trained on the suite's cases, and the held-out case
+        from do_regr import scale_targets
+        model_dir = Path(tempfile.mkdtemp(dir=fixture_dir))
+        (model_dir/'scalers').mkdir()
+        table = training_table()
+        data_helpers.scale_all(table[feature_names], 'x', model_dir/'scalers')
+        scale_exp = []
+        labels = data_helpers.data_preproc(table[label_names], scale_exp)
+        data_helpers.scale_all(labels, 'y', model_dir/'scalers')
+        case = data_helpers.read_file(node_file, columns=data_helpers.not_efield)
+        features = pd.DataFrame({'V': 300.0, 'P': 60.0, 'x': case['X'], 'y': case['Y']})[feature_names]
+        return model_dir, features, scale_targets(case[label_names], scale_exp)
+
+    def setup_scale_features():
+        from do_regr import scale_features
+        model_dir, features, _ = regression_case()
+        return lambda: scale_features(features, model_dir)
+
+    def setup_reverse_minmax():
+        from do_regr import reverse_minmax
+        model_dir, _, targets = regression_case()
+        return lambda: reverse_minmax(targets, model_dir)
+
+    def setup_downscale():
+        from image_data_helpers import downscale
+        images = np.random.default_rng(0).random((32, 5, 707, 200), dtype=np.float32)
+        return lambda: downscale(images, 64)
+
+    def setup_forward(cls, inputs):
+        def setup():
+            torch.set_default_dtype(torch.float32)
+            model = cls() if not mlp_outputs.get(cls.__name__) else cls(2, mlp_outputs[cls.__name__], 0.5)
+            model.eval()
+            x = torch.rand(inputs)
+            def forward():
+                with torch.no_grad():
+                    return model(x)
+            return forward
+        return setup
+
+    benchmarks = {'read_file': lambda: (lambda: data_helpers.read_file(node_file, columns=data_helpers.not_efield)),
+                  'read_all_data': lambda: read_all,
+                  'data_preproc': setup_preproc,
+                  'scale_all': setup_scale_all,
+                  'process_batch (4096)': setup_process_batch,
+                  'do_regr.scale_features': setup_scale_features,
+                  'do_regr.reverse_minmax': setup_reverse_minmax,
+                  'image_data_helpers.downscale (32x5x707x200 -> 64)': setup_downscale}
+
+    import autoencoder_classes
+    import mlp_classes
+    for module, batch_shapes in ((autoencoder_classes, {name: (32,) + shape for name, shape in ae_inputs.items()}),
+                                 (mlp_classes, {name: (32, 2) for name in mlp_outputs})):
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__ or not issubclass(cls, torch.nn.Module):
+                continue
+            if name not in batch_shapes:
+                raise Exception(f'no benchmark input for {module.__name__}.{name}, add it to ae_inputs/mlp_outputs')
+            benchmarks[f'forward {module.__name__}.{name} {tuple(batch_shapes[name])}'] = setup_forward(cls, batch_shapes[name])
+    return benchmarks
+
+
+def max_rss() -> int:
+    """Peak resident memory of this process so far (bytes)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024  # bytes on macOS, kB on linux
+
+
+def _run_benchmark(name, fixture_dir, repeat, num_threads, connection):
+    """Run a single benchmark of the suite (in its own process) and send back its results."""
+    try:
+        torch.set_num_threads(num_threads)
+        func = suite(fixture_dir)[name]()
+        func()  # warm-up, also excludes one-time allocations from the peak
+        baseline = max_rss()
+        times, _ = time_call(func, repeat=repeat)
+        connection.send({'benchmark': name,
+                         'median (ms)': np.median(times)*1e3,
+                         'p95 (ms)': np.percentile(times, 95)*1e3,
+                         'peak memory (MB)': max_rss()/2**20,
+                         'peak increase (MB)': (max_rss() - baseline)/2**20})
+    except Exception as e:
+        connection.send({'benchmark': name, 'error': repr(e)})
+    finally:
+        connection.close()
+
+
+def run_suite(num_nodes=10000, repeat=10, num_threads=1, names=None):
+    """Run the benchmark suite on CPU with synthetic data.
+
+    Args:
+        num_nodes (int, optional): Number of mesh nodes of each synthetic case. Defaults to 10000.
+        repeat (int, optional): Number of timed calls per benchmark. Defaults to 10.
+        num_threads (int, optional): Number of torch threads. Defaults to 1.
+        names (list, optional): Substrings of the benchmarks to run. Defaults to None (all).
+
+    Returns:
+        pd.DataFrame: Median and p95 times (ms) and peak memory (MB) of every benchmark.
+    """
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        fixture_dir = Path(fixture_dir)
+        write_node_files(fixture_dir, num_nodes)
+
+        rows = []
+        for name in suite(fixture_dir):
+            if names and not any(substring in name for substring in names):
+                continue
+            receiver, sender = mp.Pipe(duplex=False)
+            process = mp.Process(target=_run_benchmark, args=(name, fixture_dir, repeat, num_threads, sender))
+            process.start()
+            sender.close()
+            try:
+                row = receiver.recv()
+            except EOFError:
+                row = {'benchmark': name, 'error': 'benchmark process died'}
+            process.join()
+            rows.append(row)
+            print(f"{name}: {row.get('error') or format(row['median (ms)'], '.3f') + ' ms'}")
+    return pd.DataFrame(rows)
+
+
+def environment() -> dict:
+    """Commit and machine of a suite run, saved with its results."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit or 'unknown',
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'torch': torch.__version__}
+
+
+def compare(results: pd.DataFrame, baseline_file: Path, threshold=0.2) -> pd.DataFrame:
+    """Compare suite results against a saved run.
+
+    Args:
+        results (pd.DataFrame): Results of run_suite.
+        baseline_file (Path): json file of an earlier run.
+        threshold (float, optional): Relative slowdown flagged as a regression. Defaults to 0.2.
+
+    Returns:
+        pd.DataFrame: Median times of both runs, their ratio and the regressions.
+    """
+    with open(baseline_file, 'r') as f:
+        baseline = pd.DataFrame(json.load(f)['results'])
+    table = results[['benchmark', 'median (ms)']].merge(baseline[['benchmark', 'median (ms)']],
+                                                        on='benchmark', suffixes=('', ' baseline'))
+    table['ratio'] = table['median (ms)']/table['median (ms) baseline']
+    table['regression'] = table['ratio'] > 1 + threshold
+    return table
+
+
+if __name__ == '__main__':
+    root = Path.cwd()
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('files', nargs='*', type=Path,
+                        default=[root/'data'/'avg_data'/'300Vpp_060Pa_node.dat'],
+                        help='.dat files to parse.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timed calls per parser.')
+    parser.add_argument('--neighbors', action='store_true',
+                        help='Benchmark the neighbor means instead of the parsers.')
+    parser.add_argument('-b', '--batch-size', type=int, nargs='+', default=[512, 4096, 32768],
+                        help='Batch sizes for --neighbors.')
+    parser.add_argument('-p', '--processes', type=int, nargs='+', default=[2, os.cpu_count()],
+                        help='Pool sizes for --neighbors.')
+    parser.add_argument('--suite', action='store_true',
+                        help='Run the benchmark suite on synthetic data and save the results.')
+    parser.add_argument('-n', '--nodes', type=int, default=10000, help='Mesh nodes per case for --suite.')
+    parser.add_argument('-k', '--select', nargs='+', default=None,
+                        help='Only run the suite benchmarks whose names contain one of these.')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='torch threads for --suite.')
+    parser.add_argument('-o', '--out', type=Path, default=None,
+                        help='Results of --suite (default: created_models/benchmarks/<commit>.json).')
+    parser.add_argument('--compare', type=Path, default=None,
+                        help='Results of an earlier --suite run to compare against.')
+    args = parser.parse_args()
+
+    if args.suite:
+        info = environment()
+        results = run_suite(args.nodes, args.repeat, args.threads, args.select)
+        out = args.out or root/'created_models'/'benchmarks'/f"{info['commit']}.json"
+        out.parent.mkdir(parents=True, exist_ok=True)
+        with open(out, 'w') as f:
+            json.dump({**info, 'nodes': args.nodes, 'repeat': args.repeat, 'threads': args.threads,
+                       'results': results.to_dict('records')}, f, indent=2)
+        with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 160,
+                               'display.max_colwidth', 60):
+            print(results.to_string(index=False))
+            print(f'\nresults saved to {out}')
+            if args.compare is not None:
+                print(compare(results, args.compare).to_string(index=False))
+        sys.exit()
+
+    if args.neighbors:
+        results = pd.DataFrame([bench_neighbor_means(batch_size, processes, repeat=args.repeat)
+                                for batch_size in args.batch_size for processes in args.processes])
+    else:
+        results = pd.DataFrame([bench_read_file(file, args.repeat) for file in args.files])
+    with pd.option_context('display.float_format', '{:.4f}'.format, 'display.width', 120):
+        print(results.to_string(index=False))
@@ -7,6 +7,7 @@ import os
 import time
 import pickle
 from pathlib import Path
+from argparse import ArgumentParser
 
 import matplotlib.pyplot as plt
 
@@ -32,6 +33,7 @@ from data_helpers import ImageDataset
 from plot import plot_comparison_ae, save_history_graph, ae_correlation
 import autoencoder_classes
 import mlp_classes
+from train_helpers import Profiler
 
 # define model TODO: construct following input file/specification list
 
@@ -65,6 +67,11 @@ def normalize_test(dataset:np.ndarray, scalers:dict()):
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the inference with torch.profiler (saved in the model directory)')
+    args = parser.parse_args()
+
     # set metal backend (apple socs)
     device = torch.device(
         'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -111,7 +118,7 @@ if __name__ == '__main__':
     model.eval()
     mlp.eval()
 
-    with torch.no_grad():
+    with torch.no_grad(), Profiler(out_dir, enabled=args.profile, steps=None):
         fake_encoding = mlp(torch.tensor(scaled_labels_test, device=device, dtype=torch.float32))  # mps does not support float64
         fake_encoding = fake_encoding.reshape(1, encodedx, encodedy, encodedz)
         decoded = model.decoder(fake_encoding)
@@ -10,6 +10,7 @@ import os
 import time
 import pickle
 from pathlib import Path
+from argparse import ArgumentParser
 
 import matplotlib.pyplot as plt
 
@@ -35,6 +36,7 @@ from data_helpers import ImageDataset, train2db
 from plot import plot_comparison_ae, save_history_graph
 import autoencoder_classes
 from mlp_classes import MLP, MLP1
+from train_helpers import Checkpointer, Profiler
 
 
 def resize(data: np.ndarray, scale=64) -> np.ndarray:
@@ -94,6 +96,12 @@ def write_metadata_ae(out_dir):  # TODO: move to data module
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of the model')
+    parser.add_argument('--profile', nargs='?', type=int, const=5, default=None, metavar='STEPS',
+                        help='profile STEPS training steps (default 5) with torch.profiler')
+    args = parser.parse_args()
+
     # set metal backend (apple socs)
     device = torch.device(
         'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -177,11 +185,21 @@ if __name__ == '__main__':
     criterion = nn.MSELoss()
     epoch_loss = []
 
+    # periodic checkpoints of the MLP, written in the background
+    checkpointer = Checkpointer(out_dir/'checkpoints', keep=3)
+    start_epoch = 0
+    if args.resume:
+        start_epoch, history = checkpointer.load(mlp, optimizer)
+        epoch_loss = history['epoch_loss']
+
     # begin training MLP
     print("Training MLP...\r", end="")
     train_start = time.time()
-    loop = tqdm(range(epochs), desc='Training...', unit='epoch', colour='#7dc4e4')
+    loop = tqdm(range(start_epoch, epochs), desc='Training...', unit='epoch', colour='#7dc4e4',
+                initial=start_epoch, total=epochs)
 
+    profiler = Profiler(out_dir, enabled=args.profile is not None, steps=args.profile)
+    profiler.start()
     for epoch in loop:
         running_loss = 0.0  # record losses
 
@@ -199,13 +217,15 @@ if __name__ == '__main__':
             # print statistics
             loop.set_description(f"Epoch {epoch+1}/{epochs}")
             running_loss += loss.item()
+            profiler.step()
 
         epoch_loss.append(loss.item())
         if (epoch+1) % 10 == 0:
-            # save model every 10 epochs (so i dont lose all training progress in case i do something unwise)
-            torch.save(model.state_dict(), out_dir/f'{name}')
-            save_history_graph(epoch_loss, out_dir)
+            # checkpoint every 10 epochs (so i dont lose all training progress in case i do something unwise)
+            checkpointer.save(epoch, mlp, optimizer, {'epoch_loss': epoch_loss})
 
+    profiler.stop()
+    checkpointer.close()
     print("\33[2KMLP training complete!")
     train_end = time.time()
     torch.save(mlp.state_dict(), out_dir/f'{name}')
@@ -4,13 +4,14 @@ created by: jarl (28 Jul 2023)
 
 xarray is nice, but I have no way of easily selecting train and test sets."""
 
-import xarray as xr
 import numpy as np
 from pathlib import Path
 from numpy import savez_compressed
 from datetime import datetime as dt
 from tqdm import tqdm
 
+from cubes import open_cube, read_images
+
 if __name__ == '__main__':
     # get list of v and p
     voltages = [200., 300., 400., 500.]
@@ -20,8 +21,7 @@ if __name__ == '__main__':
     root = Path.cwd()/'data'
     # root = Path('/Users/jarl/2d-discharge-nn/data/')
     data = root/'interpolation_datasets'/'full_interpolation.nc'
-    ds = xr.open_dataset(data)
-    variables = list(ds.keys())
+    ds = open_cube(data)
 
     out_dir = root/'image_datasets'
     if not out_dir.exists():
@@ -29,7 +29,7 @@ if __name__ == '__main__':
 
     for p in tqdm(pressures):
         for v in voltages:
-            array = np.nan_to_num(np.stack([ds[var].sel(V=v, P=p).values for var in variables]))
+            array = np.nan_to_num(read_images(ds, v, p))  # reads this (V, P) only
             v_name = f'{v:0>3}'
             p_name = f'{p:0>3}'
             filename = f'{v_name}_{p_name}.npz'  # format is VVV_PPP.npz
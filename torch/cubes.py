@@ -0,0 +1,151 @@
+""" Chunked storage of the interpolation datasets (rec-interpolation2.nc, full_interpolation.nc, ...).
+
+The interpolation datasets are cubes of every variable over (V, P, y, x). Consumers only
+need a single (V, P), often only the 200x200 crop at row 350 of the square image models,
+so the cubes are written as NetCDF4 with one chunk per (V, P) and block of CHUNK_ROWS
+rows (compressed with blosc lz4, which decompresses about as fast as the disk reads).
+Selecting a (V, P) and a window before reading the values (see read_images) then only
+reads the chunks that overlap it.
+
+HDF5 does not allow '/' in variable names (e.g. 'Ne (#/m^-3)'), so the variables are
+stored with '/' replaced by '_' and their name in the 'original_name' attribute.
+open_cube restores the names, and also opens the older unchunked (NetCDF3) files.
+Cubes too large for memory are written one (V, P) at a time with a CubeWriter.
+Existing files are converted with:
+
+usage: python torch/cubes.py FILE [FILE ...]
+
+created: @jarl
+"""
+
+import os
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+import xarray as xr
+
+CHUNK_ROWS = 50  # rows (y) per chunk, the square crop is chunks 7 to 10
+SQUARE_WINDOW = (slice(350, 550), slice(0, 200))  # (rows, columns) of the 200x200 square crop
+
+
+def _codec() -> dict:
+    import netCDF4  # the engine of chunked cubes
+    if getattr(netCDF4, '__has_blosc_support__', False):
+        return {'compression': 'blosc_lz4', 'complevel': 5, 'blosc_shuffle': 1}
+    return {'zlib': True, 'complevel': 1, 'shuffle': True}
+
+
+def write_cube(ds: xr.Dataset, out_file: Path, chunk_rows=CHUNK_ROWS) -> Path:
+    """Write an interpolation dataset as a chunked NetCDF4 file.
+
+    Every variable is chunked per (V, P) and in blocks of chunk_rows rows of y, with the
+    whole width of x in every chunk.
+
+    Args:
+        ds (xr.Dataset): Dataset with variables over (V, P, y, x).
+        out_file (Path): Output .nc file.
+        chunk_rows (int, optional): Rows per chunk. Defaults to CHUNK_ROWS.
+
+    Returns:
+        Path: out_file.
+    """
+    names = {var: var.replace('/', '_') for var in ds.data_vars}
+    ds = ds.rename(names)
+    encoding = {}
+    for var, name in names.items():
+        ds[name] = ds[name].assign_attrs(original_name=var)
+        chunks = [1 if dim in ('V', 'P') else min(chunk_rows, size) if dim == 'y' else size
+                  for dim, size in ds[name].sizes.items()]
+        encoding[name] = {'chunksizes': chunks, **_codec()}
+    ds.to_netcdf(out_file, format='NETCDF4', engine='netcdf4', encoding=encoding)
+    return Path(out_file)
+
+
+class CubeWriter:
+    """Write an interpolation dataset one (V, P) at a time, in the layout of write_cube.
+
+    The file is created empty (NaN) and every write() fills the chunks of a single case,
+    so only the images of one case are in memory, whatever the size of the cube.
+
+    Args:
+        out_file (Path): Output .nc file.
+        coords (dict): 1D coordinates 'V', 'P', 'y' and 'x'.
+        variables (list): Variable names (e.g. 'Ne (#/m^-3)').
+        chunk_rows (int, optional): Rows per chunk. Defaults to CHUNK_ROWS.
+    """
+    def __init__(self, out_file: Path, coords: dict, variables: list, chunk_rows=CHUNK_ROWS) -> None:
+        import netCDF4
+        self.ds = netCDF4.Dataset(out_file, 'w', format='NETCDF4')
+        for dim in ('V', 'P', 'y', 'x'):
+            values = np.asarray(coords[dim], dtype=np.float64)
+            self.ds.createDimension(dim, len(values))
+            self.ds.createVariable(dim, 'f8', (dim,))[:] = values
+
+        self.names = {var: var.replace('/', '_') for var in variables}
+        chunks = (1, 1, min(chunk_rows, len(coords['y'])), len(coords['x']))
+        for var, name in self.names.items():
+            self.ds.createVariable(name, 'f8', ('V', 'P', 'y', 'x'), fill_value=np.nan, chunksizes=chunks,
+                                   **_codec()).original_name = var
+
+    def write(self, i: int, j: int, images: dict) -> None:
+        """Write the (y, x) images {variable: image} of the case at index i of V and j of P."""
+        for var, image in images.items():
+            self.ds[self.names[var]][i, j] = image
+
+    def close(self) -> None:
+        self.ds.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def open_cube(file: Path) -> xr.Dataset:
+    """Open an interpolation dataset lazily, with its original variable names.
+
+    Nothing is read until values are requested, so select a (V, P) and a window first
+    (see read_images).
+    """
+    ds = xr.open_dataset(file)
+    names = {var: ds[var].attrs['original_name'] for var in ds.data_vars if 'original_name' in ds[var].attrs}
+    if not names:
+        return ds
+    renamed = ds.rename(names)
+    renamed.set_close(ds.close)  # rename drops the file handle
+    return renamed
+
+
+def read_images(ds: xr.Dataset, voltage, pressure, window=None, variables=None) -> np.ndarray:
+    """Read the images of a single (V, P), reading only the window.
+
+    Args:
+        ds (xr.Dataset): Dataset from open_cube.
+        voltage (float): Voltage (V).
+        pressure (float): Pressure (Pa).
+        window (tuple, optional): (rows, columns) slices, e.g. SQUARE_WINDOW. Defaults to None
+            (the whole image).
+        variables (list, optional): Variables to read. Defaults to None (all of them).
+
+    Returns:
+        np.ndarray: Images with shape (channels, height, width), NaN in the electrodes.
+    """
+    rows, columns = window or (slice(None), slice(None))
+    return np.stack([ds[var].sel(V=voltage, P=pressure).isel(y=rows, x=columns).values
+                     for var in (variables or list(ds.data_vars))])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Rewrite interpolation datasets as chunked NetCDF4 files.')
+    parser.add_argument('files', type=Path, nargs='+', help='.nc files, rewritten in place.')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows per chunk')
+    args = parser.parse_args()
+
+    for file in args.files:
+        tmp_file = file.with_suffix('.tmp.nc')
+        with open_cube(file) as ds:
+            write_cube(ds, tmp_file, args.chunk_rows)
+        os.replace(tmp_file, file)
+        print(f'wrote {file} ({os.path.getsize(file)/1e6:.1f} MB)')
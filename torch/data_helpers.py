@@ -2,128 +2,389 @@
 # TODO: add type hinting
 
 import os
-import re
 import time
+import json
 import pickle
+import hashlib
+import multiprocessing as mp
 import xarray as xr
 import torch
 from torchvision.transforms.functional import crop
-import posixpath
 from pathlib import Path
+from functools import partial
 import pandas as pd
 import numpy as np
+import pyarrow.feather as feather
 from datetime import datetime
-from sklearn.preprocessing import MinMaxScaler
+
+from mesh import Mesh, mesh_key
+from scalers import MinMax, ColumnStats, power_scale, valid_rows
+from cubes import open_cube, read_images, SQUARE_WINDOW
+from node_files import CONNECTIVITY_LINE, read_all_data, find_cases, read_cases, read_file, attach_VP_columns
 
 # original data functions
-def read_all_data(fldr_path, voltages, pressures):
-    file_count = 0
-    data_table = None
-    for voltage in voltages:
-        for pressure in pressures:
-            file_name = '{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage,pressure)
-            file_path = posixpath.join(fldr_path, file_name)
-            if os.path.exists(file_path):
-                data = read_file(file_path)
-                file_count += 1
-            else:
-                continue
-            
-            data = attach_VP_columns(data, voltage, pressure)
-            data_table = data if file_count==1 else pd.concat([data_table,data], ignore_index=True)
-    return data_table
-
-
-def read_file(file_path):
-    with open(file_path, 'r') as f:
-        data = []
-        for n,line in enumerate(f,1):
-            if n==1:
-                line = line.strip()
-                line = re.findall(r'"[^"]*"', line) # get ['"var_name1"', '"var_name2"', ...]
-                column_labels = [var_name.replace('"','') for var_name in line]
-            elif n==2:
-                continue
+def not_efield(col_name):
+    """Column filter for read_file that skips the electric field components."""
+    return col_name not in ('Ex (V/m)', 'Ey (V/m)')
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class NodeDataCache:
+    """Incremental, content-hashed cache of the simulation node data.
+
+    Each (V, P) case is stored as its own feather shard in cache_dir. manifest.json
+    records the size, mtime and sha256 of the .dat file that each shard was parsed from,
+    so update() only re-parses files that were added or changed. The combined table is
+    assembled from the shards on first access of self.table. The mesh connectivity is
+    saved to cache_dir/mesh (see mesh.get_mesh).
+
+    Args:
+        data_dir (Path): Folder containing the {V}Vpp_{P}Pa_node.dat files.
+        cache_dir (Path): Folder for the shards and the manifest.
+        columns (list or callable, optional): Variables to parse, see read_file.
+            Defaults to not_efield.
+    """
+    version = 1
+
+    def __init__(self, data_dir: Path, cache_dir: Path, columns=not_efield):
+        self.data_dir = Path(data_dir)
+        self.cache_dir = Path(cache_dir)
+        self.columns = columns
+        self.cases = []  # (V, P) pairs selected by the last update()
+        self._table = None
+        self.manifest = self._load_manifest()
+
+    @property
+    def _columns_key(self):
+        """JSON-friendly description of self.columns, stored to invalidate shards parsed differently."""
+        if callable(self.columns):
+            return f'{self.columns.__module__}.{self.columns.__qualname__}'
+        return None if self.columns is None else list(self.columns)
+
+    def _load_manifest(self) -> dict:
+        manifest_file = self.cache_dir/'manifest.json'
+        if manifest_file.exists():
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            if (manifest.get('version') == self.version) and (manifest.get('columns') == self._columns_key):
+                return manifest
+        return {'version': self.version, 'columns': self._columns_key, 'files': {}}
+
+    def _save_manifest(self):
+        # write-then-rename so an interrupted run never leaves a half-written manifest
+        # (through a file of this process, so that concurrent runs never replace each other's)
+        tmp_file = self.cache_dir/f'manifest.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.cache_dir/'manifest.json')
+
+    def update(self, voltages, pressures, processes=None) -> list:
+        """Bring the cache up to date with the node files of a (V, P) grid.
+
+        Unchanged files (same size and mtime) are skipped without hashing, and touched
+        files whose hash still matches only get their mtime refreshed.
+
+        Args:
+            voltages (list): Voltages to include (V).
+            pressures (list): Pressures to include (Pa).
+            processes (int, optional): Worker processes for parsing, all cores if None.
+
+        Returns:
+            list: (V, P) pairs that were (re-)parsed.
+        """
+        files = self.manifest['files']
+        cases = find_cases(self.data_dir, voltages, pressures)
+
+        stale = []
+        refreshed = False
+        for voltage, pressure, file_path in cases:
+            stat = os.stat(file_path)
+            entry = files.get(Path(file_path).name)
+            if (entry is None) or (not (self.cache_dir/entry['shard']).exists()):
+                stale.append((voltage, pressure, file_path, stat, file_digest(file_path)))
+            elif (entry['size'], entry['mtime']) != (stat.st_size, stat.st_mtime_ns):
+                digest = file_digest(file_path)
+                if digest == entry['sha256']:
+                    entry['mtime'] = stat.st_mtime_ns
+                    refreshed = True
+                else:
+                    stale.append((voltage, pressure, file_path, stat, digest))
+
+        # forget cases whose source file has been removed
+        removed = [name for name in files if not (self.data_dir/name).exists()]
+        for name in removed:
+            (self.cache_dir/files.pop(name)['shard']).unlink(missing_ok=True)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        results = read_cases([file_path for _, _, file_path, _, _ in stale], self.columns, processes, elements=True)
+        for (voltage, pressure, file_path, stat, digest), (labels, values, elements) in zip(stale, results):
+            shard = '{0:d}Vpp_{1:03d}Pa.feather'.format(voltage, pressure)
+            data = pd.DataFrame(values, columns=labels)
+            data.insert(0, 'Vpp [V]', float(voltage))
+            data.insert(1, 'P [Pa]', float(pressure))
+            data.to_feather(self.cache_dir/shard)
+
+            # keep the connectivity, shared by all cases simulated on the same mesh
+            if ('X' in labels) and ('Y' in labels):
+                nodes = values[:, [labels.index('X'), labels.index('Y')]]
+                if not (self.cache_dir/'mesh'/f'{mesh_key(nodes)}.npz').exists():
+                    Mesh(nodes, elements).save(self.cache_dir/'mesh')
+
+            files[Path(file_path).name] = {'V': voltage, 'P': pressure, 'size': stat.st_size,
+                                           'mtime': stat.st_mtime_ns, 'sha256': digest, 'shard': shard}
+        if stale or removed or refreshed:  # an up-to-date cache is only read, e.g. by parallel runs
+            self._save_manifest()
+
+        self.cases = [(voltage, pressure) for voltage, pressure, _ in cases]
+        self._table = None
+        return [(voltage, pressure) for voltage, pressure, _, _, _ in stale]
+
+    def shard(self, voltage, pressure) -> pd.DataFrame:
+        """Load the cached node data of a single (V, P) case."""
+        file_name = '{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage, pressure)
+        return pd.read_feather(self.cache_dir/self.manifest['files'][file_name]['shard'])
+
+    @property
+    def store(self) -> 'CaseStore':
+        """CaseStore of the cases selected by the last update(), rebuilt from the shards if stale."""
+        sources = [[voltage, pressure, self.manifest['files']['{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage, pressure)]['sha256']]
+                   for voltage, pressure in self.cases]
+        store_dir = self.cache_dir/'store'
+        if (store_dir/'index.json').exists():
+            store = CaseStore(store_dir)
+            if store.sources == sources:
+                return store
+
+        shards = ((voltage, pressure, self.shard(voltage, pressure)) for voltage, pressure in self.cases)
+        return CaseStore.build(store_dir, shards, sources)
+
+    @property
+    def table(self) -> pd.DataFrame:
+        """Node data of all cases selected by the last update(), in the same layout as read_all_data."""
+        if self._table is None:
+            shards = [self.shard(voltage, pressure) for voltage, pressure in self.cases]
+            if len(shards) == 0:
+                return pd.DataFrame(columns=['Vpp [V]', 'P [Pa]'])
+            self._table = pd.concat(shards, ignore_index=True)
+        return self._table
+
+
+class CaseStore:
+    """Case-indexed columnar store of node data.
+
+    All cases are kept in one memory-mapped (rows, variables) .npy array, contiguous
+    per case, with an index from (V, P) to its row range. V and P are not stored per
+    row. Selecting a case is a zero-copy slice, and excluding one leaves at most two
+    contiguous slices.
+
+    Args:
+        store_dir (Path): Folder containing nodes.npy and index.json (see CaseStore.build).
+    """
+    def __init__(self, store_dir: Path):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir/'index.json', 'r') as f:
+            index = json.load(f)
+        self.columns = index['columns']
+        self.sources = index['sources']
+        self.index = {(voltage, pressure): (start, stop) for voltage, pressure, start, stop in index['cases']}
+        self.values = np.load(self.store_dir/'nodes.npy', mmap_mode='r')
+
+    @classmethod
+    def build(cls, store_dir: Path, cases, sources=None):
+        """Write a new store.
+
+        Args:
+            store_dir (Path): Output folder.
+            cases (iterable): (voltage, pressure, DataFrame) for each case, where the DataFrame
+                has the layout of read_all_data.
+            sources (list, optional): Identifiers of the data the store was built from,
+                stored with the index so that stale stores can be detected. Defaults to None.
+
+        Returns:
+            CaseStore: The new store.
+        """
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        (store_dir/'index.json').unlink(missing_ok=True)  # an index never outlives its array
+
+        arrays = []
+        for voltage, pressure, data in cases:
+            data = data.drop(columns=['Vpp [V]', 'P [Pa]'], errors='ignore')
+            columns = list(data.columns)
+            arrays.append((voltage, pressure, data.to_numpy(dtype=np.float64)))
+
+        num_rows = sum(len(values) for _, _, values in arrays)
+        nodes = np.lib.format.open_memmap(store_dir/'nodes.npy', mode='w+', dtype=np.float64,
+                                          shape=(num_rows, len(columns) if arrays else 0))
+        index = []
+        start = 0
+        for voltage, pressure, values in arrays:
+            nodes[start:start+len(values)] = values
+            index.append([voltage, pressure, start, start+len(values)])
+            start += len(values)
+        nodes.flush()
+        del nodes
+
+        with open(store_dir/'index.json', 'w') as f:
+            json.dump({'columns': columns if arrays else [], 'sources': sources, 'cases': index}, f)
+
+        return cls(store_dir)
+
+    @property
+    def cases(self) -> list:
+        """(V, P) pairs in storage order."""
+        return list(self.index)
+
+    def case(self, voltage, pressure) -> np.ndarray:
+        """Zero-copy (nodes, variables) view of a single case."""
+        start, stop = self.index[(voltage, pressure)]
+        return self.values[start:stop]
+
+    def ranges(self, cases=None, exclude=()) -> list:
+        """Row ranges of the selected cases, with neighbouring ranges merged.
+
+        Args:
+            cases (list, optional): (V, P) pairs to select. Defaults to None (all cases).
+            exclude (list, optional): (V, P) pairs to leave out. Defaults to ().
+
+        Returns:
+            list: (start, stop, [(V, P, num_rows), ...]) for each contiguous block of rows.
+        """
+        exclude = set(exclude)
+        selected = [vp for vp in (self.cases if cases is None else cases) if vp not in exclude]
+
+        blocks = []
+        for vp in selected:
+            start, stop = self.index[vp]
+            if blocks and (blocks[-1][1] == start):
+                blocks[-1][1] = stop
+                blocks[-1][2].append((*vp, stop-start))
             else:
-                data_line = [eval(data) for data in line.split()]
-                if len(data_line)==4:
-                    break
-                data.append(data_line)
-    return pd.DataFrame(data, columns=column_labels)
+                blocks.append([start, stop, [(*vp, stop-start)]])
+        return [tuple(block) for block in blocks]
+
+    def views(self, cases=None, exclude=()) -> list:
+        """Zero-copy views of the selected cases, one per contiguous block of rows."""
+        return [self.values[start:stop] for start, stop, _ in self.ranges(cases, exclude)]
 
+    def frame(self, cases=None, exclude=()) -> pd.DataFrame:
+        """Copy the selected cases into a DataFrame with the layout of read_all_data.
 
-def attach_VP_columns(data, voltage, pressure):
-    num_data_points = len(data)
-    vp_columns = [[voltage, pressure] for n in range(num_data_points)]
-    vp_columns = pd.DataFrame(vp_columns, columns=['Vpp [V]', 'P [Pa]'])
-    return vp_columns.join(data)
+        The rows are copied once into a preallocated array and the 'Vpp [V]' and 'P [Pa]'
+        columns are filled by broadcasting from the index.
+        """
+        blocks = self.ranges(cases, exclude)
+        num_rows = sum(stop-start for start, stop, _ in blocks)
+        data_table = np.empty((num_rows, len(self.columns)+2), dtype=np.float64)
 
+        row = 0
+        for start, stop, members in blocks:
+            data_table[row:row+stop-start, 2:] = self.values[start:stop]
+            for voltage, pressure, num_nodes in members:
+                data_table[row:row+num_nodes, 0] = voltage
+                data_table[row:row+num_nodes, 1] = pressure
+                row += num_nodes
 
-def create_output_dir(root):
+        return pd.DataFrame(data_table, columns=['Vpp [V]', 'P [Pa]'] + self.columns, copy=False)
+
+
+def create_output_dir(root, name=None):
+    """Create a new output directory in root/created_models.
+
+    The directory is named after the current date and time (and name, if given). A
+    numbered suffix is added if it already exists, so that runs started in the same
+    minute, e.g. by a parallel sweep, never share a directory.
+
+    Args:
+        root (Path): Repository root.
+        name (str, optional): Name appended to the directory name. Defaults to None.
+
+    Returns:
+        Path: Path to the new directory.
+    """
     rslt_dir = root / 'created_models'
-    if not os.path.exists(rslt_dir):
-        os.mkdir(rslt_dir)
+    os.makedirs(rslt_dir, exist_ok=True)
     
     date_str = datetime.today().strftime('%Y-%m-%d_%H%M')
+    if name is not None:
+        date_str = f'{date_str}_{name}'
     out_dir = rslt_dir / date_str
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+    n = 1
+    while True:
+        try:
+            os.mkdir(out_dir)  # fails if another run already created it
+            break
+        except FileExistsError:
+            n += 1
+            out_dir = rslt_dir / f'{date_str}_{n}'
     print('directory', out_dir, 'has been created.\n')
     
     return out_dir
 
 
 # more stuff from elsewhere
-def data_preproc(data_table, scale_exp, lin=True):
+def data_preproc(data_table, scale_exp, lin=True, dtype=np.float64, inplace=False):
+    """Scale the target columns of a table by powers of ten (or log10).
+
+    The whole table is processed at once (see scalers.power_scale). Rows with values that
+    are not finite after scaling are dropped.
+
+    Args:
+        data_table (pd.DataFrame): Table of features and/or targets.
+        scale_exp (list): The exponent of every target column is appended to it (if lin).
+        lin (bool, optional): Divide by powers of ten, else take log10. Defaults to True.
+        dtype (optional): dtype of the result. Defaults to np.float64.
+        inplace (bool, optional): Reuse the table's memory if it already has dtype. The
+            table must not be used afterwards. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Scaled table.
+    """
     trgt_params = ('potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)')
+    targets = np.isin(data_table.columns, trgt_params)
+    values, exponents = power_scale(data_table.to_numpy(), targets, lin, dtype=dtype, inplace=inplace)
+    if lin:
+        scale_exp.extend(exponents)
 
-    def get_param_exp(col_vals):
-        ''' get exponent of the parameter's mean value for scaling. '''
-        mean_exp = round(np.log10(col_vals.mean()), 0) - 1.0
-        # return 0 if mean_exp is less than zero to avoid blowing up small values
-        if mean_exp >=  0.0:
-            return mean_exp
-        else:
-            return 0.0
+    finite = np.isfinite(values).all(axis=1)
+    if finite.all():
+        return pd.DataFrame(values, columns=data_table.columns)
+    return pd.DataFrame(values[finite], index=np.flatnonzero(finite), columns=data_table.columns)
 
 
-    for col_n,(col_name,col_vals) in enumerate(data_table.iteritems(), start=1):
-        if col_name in trgt_params:
-            if lin:
-                # get exponent for scaling
-                exponent = get_param_exp(col_vals)
-                scale_exp.append(exponent)            
-                tmp_col = col_vals.values.reshape(-1,1)/(10**exponent)  # scale by dividing
-            else:
-                tmp_col = np.log10(col_vals.values.reshape(-1,1))
-        else:
-            tmp_col = col_vals.values.reshape(-1,1)
-        proced_table = tmp_col if col_n==1 else np.hstack([proced_table,tmp_col])
-    
-    proced_table = pd.DataFrame(proced_table, columns=data_table.columns)
-    proced_table = proced_table.replace([np.inf,-np.inf], np.nan)
-    proced_table = proced_table.dropna(how='any')
-    
-    return proced_table
+def scale_all(data_table, x_or_y, out_dir=None, dtype=np.float64, inplace=False):
+    """Minmax-scale every column of a table to [0, 1], as a whole array.
 
+    Args:
+        data_table (pd.DataFrame): Table to scale.
+        x_or_y (str): 'x' for features, 'y' for targets.
+        out_dir (Path, optional): Scaler directory, where the scaling is saved as
+            {x_or_y}scaler.json (see scalers.MinMax). Defaults to None.
+        dtype (optional): dtype of the result. Defaults to np.float64.
+        inplace (bool, optional): Scale the table's own float array. The table must not
+            be used afterwards. Defaults to False.
 
-def scale_all(data_table, x_or_y, out_dir=None):
-    data_table = data_table.copy()
-    for n,column in enumerate(data_table.columns, start=1):
-        scaler = MinMaxScaler()
-        data_col = data_table[column].values.reshape(-1,1)
-        scaler.fit(data_col)
-        scaled_data = scaler.transform(data_col)
-        scaled_data_table = scaled_data if n==1 else np.hstack([scaled_data_table,scaled_data])
-        
-        if out_dir is not None:
-            pickle_file = out_dir / f'{x_or_y}scaler_{n:02d}.pkl'
-            with open(pickle_file, mode='wb') as pf:
-                pickle.dump(scaler, pf, protocol=4)
-    
-    scaled_data_table = pd.DataFrame(scaled_data_table, columns=data_table.columns)
-    
-    return scaled_data_table
+    Returns:
+        pd.DataFrame: Scaled table.
+    """
+    values = data_table.to_numpy()
+    if not inplace or values.dtype not in (np.float32, np.float64):
+        # MinMaxScaler works in float32 or float64
+        values = np.array(values, dtype=np.float32 if values.dtype == np.float32 else np.float64, order='F')
+    scaler = MinMax.fit(values)
+    values = scaler.transform(values, inplace=True)
+    if out_dir is not None:
+        scaler.save(out_dir, x_or_y)
+
+    return pd.DataFrame(values.astype(dtype, copy=False), columns=data_table.columns)
 
 def read_aug_data(file):
     """Read data file and return a DataFrame.
@@ -142,34 +403,40 @@ def read_aug_data(file):
 def get_augmentation_data(data_used, root, xy: bool, vp: bool):
     """Get augmentation data for training.
 
+    The augmentation data is read one piece at a time (a (V, P) of the xy dataset or a vp
+    file, see augmentation_sources) and copied into a single preallocated table after
+    data_used. A first pass counts the rows of every piece. Peak memory is the final table
+    plus data_used and a single piece, instead of several copies of the whole table.
+
     Args:
+        data_used (pd.DataFrame): Training data, with the columns of get_data.
         xy (bool): Include xy grid augmented data
         vp (bool): Inclde vp augmentation data
+
+    Returns:
+        pd.DataFrame: data_used followed by the augmentation data, with the columns of data_used.
     """
-    if xy:  # xy augmentation
-        xyfile = Path(root/'data'/'interpolation_datasets'/'rec-interpolation2.nc')
-        xydf = xr.open_dataset(xyfile).to_dataframe().reset_index().dropna()
-    else: xydf = None
-
-    if vp:  # vp augmentation
-        vpfolder = Path(root/'data'/'interpolation_feather'/'20221209')
-        # read all files and combine into a single df
-        vpdf = [read_aug_data(file) for file in vpfolder.glob('*.feather')]
-        vpdf = pd.concat(vpdf).rename(columns={'Vpp [V]' : 'V', 
-                                               'P [Pa]'  : 'P',
-                                               'X'       : 'x',
-                                               'Y'       : 'y'}, inplace=True)
-    else: vpdf = None
-
-    # make sure that the data follows the correct format before returning
-    return pd.concat([data_used, xydf, vpdf], ignore_index=True)
+    sources = augmentation_sources(root, xy, vp)
+    num_rows = [source_rows(source) for source in sources]
+
+    columns = list(data_used.columns)
+    table = np.empty((len(data_used) + sum(num_rows), len(columns)), dtype=np.float64)
+    table[:len(data_used)] = data_used.to_numpy(dtype=np.float64)
+    row = len(data_used)
+    for source, rows in zip(sources, num_rows):
+        table[row:row+rows] = source().reindex(columns=columns).to_numpy(dtype=np.float64)
+        row += rows
+
+    return pd.DataFrame(table, columns=columns, copy=False)
     
 
 def get_data(root, voltages, pressures, excluded, xy=False, vp=False):
     """Get dataset
 
-    Assumes the DataFrame has previously been saved as a .feather file. If not,
-    a new .feather file is created in the root/data folder.
+    Node data is read through a NodeDataCache in root/data/avg_data_cache, which only
+    re-parses .dat files in root/data/avg_data that were added or changed, and the
+    train/test split is taken from its case-indexed CaseStore. If no .dat files are
+    available, the combined root/data/avg_data.feather is used instead.
 
     Args:
         xy (bool, optional): Include xy augmentation. Defaults to False.
@@ -183,29 +450,28 @@ def get_data(root, voltages, pressures, excluded, xy=False, vp=False):
         data_excluded: DataFrame of excluded data.
     """
     avg_data_file = root/'data'/'avg_data.feather'
-    data_fldr_path = root/'data'
+    data_fldr_path = root/'data'/'avg_data'
     voltage_excluded, pressure_excluded = excluded
 
-    # check if feather file exists and load avg_data
-    if avg_data_file.is_file():
+    # parse only the .dat files that are new or have changed since the last run
+    cache = NodeDataCache(data_fldr_path, root/'data'/'avg_data_cache')
+    start_time = time.time()
+    updated = cache.update(voltages, pressures)
+    if updated:
+        print(f'parsed {len(updated)} new or changed data files ({time.time()-start_time:0.1f} sec).\n')
+
+    if cache.cases:
+        # cases are contiguous row ranges in the store, so no masks over the whole table
+        store = cache.store
+        data_used     = store.frame(exclude=[excluded])
+        data_excluded = store.frame([excluded])
+    elif avg_data_file.is_file():  # no .dat files available, fall back to the old combined file
         print('reading data feather file...')
         avg_data = pd.read_feather(avg_data_file)
-    
+        data_used     = avg_data[~((avg_data['Vpp [V]']==voltage_excluded) & (avg_data['P [Pa]']==pressure_excluded))].copy()
+        data_excluded = avg_data[  (avg_data['Vpp [V]']==voltage_excluded) & (avg_data['P [Pa]']==pressure_excluded) ].copy()
     else:
-        print('data feather file not found, building file...')
-        start_time = time.time()
-        avg_data = read_all_data(data_fldr_path, voltages, pressures).drop(columns=['Ex (V/m)', 'Ey (V/m)'])
-        elapsed_time = time.time() - start_time
-        print(f' done ({elapsed_time:0.1f} sec).\n')
-
-        if len(avg_data)==0:
-            raise Exception('No data available.')
-
-        avg_data.to_feather(avg_data_file)
-
-    # separate data to be excluded (to later check the model)
-    data_used     = avg_data[~((avg_data['Vpp [V]']==voltage_excluded) & (avg_data['P [Pa]']==pressure_excluded))].copy()
-    data_excluded = avg_data[  (avg_data['Vpp [V]']==voltage_excluded) & (avg_data['P [Pa]']==pressure_excluded) ].copy()
+        raise Exception('No data available.')
 
     # rename columns
     data_used.rename(columns={'Vpp [V]' : 'V',
@@ -222,6 +488,215 @@ def get_data(root, voltages, pressures, excluded, xy=False, vp=False):
     
     return data_used, data_excluded
 
+##### streaming statistics #####
+def _renamed(data):
+    return data.rename(columns={'Vpp [V]': 'V', 'P [Pa]': 'P', 'X': 'x', 'Y': 'y'})
+
+
+def read_store_case(store_dir: Path, case) -> pd.DataFrame:
+    """Node data of a single (V, P) case of a CaseStore, with the columns of get_data."""
+    return _renamed(CaseStore(store_dir).frame([tuple(case)]))
+
+
+def read_feather_rows(file: Path, excluded=None) -> pd.DataFrame:
+    """Rows of a feather table (avg_data.feather or a vp augmentation file), with the columns of get_data.
+
+    Args:
+        file (Path): Path to the .feather file.
+        excluded (tuple, optional): (V, P) of rows to leave out. Defaults to None.
+    """
+    data = pd.read_feather(file).drop(columns=['Ex (V/m)', 'Ey (V/m)'], errors='ignore')
+    if excluded is not None:
+        data = data[~((data['Vpp [V]']==excluded[0]) & (data['P [Pa]']==excluded[1]))]
+    return _renamed(data)
+
+
+def read_netcdf_case(file: Path, voltage, pressure) -> pd.DataFrame:
+    """Rows of a single (V, P) of an interpolation dataset, without the NaN (electrode) cells.
+
+    Only this (V, P) is read from the file (see cubes.open_cube). The rows are those of
+    open_cube(file).to_dataframe().reset_index().dropna() for this (V, P).
+    """
+    with open_cube(file) as ds:
+        return ds.sel(V=[voltage], P=[pressure]).to_dataframe().reset_index().dropna()
+
+
+def source_rows(source) -> int:
+    """Number of rows of a piece of data (see training_sources), read as cheaply as possible."""
+    if source.func is read_netcdf_case:
+        file, voltage, pressure = source.args
+        with open_cube(file) as ds:
+            case = ds.sel(V=voltage, P=pressure)
+            valid = np.logical_and.reduce([~np.isnan(case[var].values) for var in case.data_vars])
+            return int(np.count_nonzero(valid))
+    if (source.func is read_feather_rows) and (source.args[1:] in [(), (None,)]):
+        return feather.read_table(source.args[0], columns=[], memory_map=True).num_rows  # no data is read
+    return len(source())
+
+
+def augmentation_sources(root, xy=False, vp=False) -> list:
+    """The augmentation data of get_data, as pieces that are read one at a time (see training_sources)."""
+    sources = []
+    if xy:
+        xyfile = root/'data'/'interpolation_datasets'/'rec-interpolation2.nc'
+        with open_cube(xyfile) as ds:
+            cases = [(voltage, pressure) for voltage in ds.V.values for pressure in ds.P.values]
+        sources += [partial(read_netcdf_case, xyfile, voltage, pressure) for voltage, pressure in cases]
+    if vp:
+        vpfolder = root/'data'/'interpolation_feather'/'20221209'
+        sources += [partial(read_feather_rows, file) for file in sorted(vpfolder.glob('*.feather'))]
+    return sources
+
+
+def training_sources(root, voltages, pressures, excluded, xy=False, vp=False) -> list:
+    """The training data of get_data, as a list of pieces that are read one at a time.
+
+    Each piece is a picklable callable returning a DataFrame with the columns of get_data's
+    data_used: a case of the node data, a (V, P) of the xy augmentation dataset or a vp
+    augmentation file. Together they hold the same rows as data_used.
+    """
+    cache = NodeDataCache(root/'data'/'avg_data', root/'data'/'avg_data_cache')
+    cache.update(voltages, pressures)
+    if cache.cases:
+        store_dir = cache.store.store_dir
+        sources = [partial(read_store_case, store_dir, case) for case in cache.cases if case != tuple(excluded)]
+    elif (root/'data'/'avg_data.feather').is_file():
+        sources = [partial(read_feather_rows, root/'data'/'avg_data.feather', tuple(excluded))]
+    else:
+        raise Exception('No data available.')
+
+    return sources + augmentation_sources(root, xy, vp)
+
+
+def _source_stats(job):
+    source, feature_names, label_names, lin = job
+    data = source()
+    labels = data[label_names].to_numpy()
+    return (ColumnStats(len(feature_names)).update(data[feature_names].to_numpy()),
+            ColumnStats(len(label_names)).update(labels, valid_rows(labels, lin=lin)))
+
+
+def scaling_stats(sources, feature_names, label_names, lin=True, processes=1):
+    """Statistics for the scaling of a dataset, in one pass that holds a single piece at a time.
+
+    Scaling.from_stats turns them into the parameters that scale_all and data_preproc find
+    on the whole table, e.g.
+    Scaling.from_stats(*scaling_stats(training_sources(...), feature_names, label_names), lin)
+
+    Args:
+        sources (list): Callables returning the pieces of the dataset (see training_sources).
+        feature_names (list): Feature columns.
+        label_names (list): Target columns.
+        lin (bool, optional): Targets will be divided by powers of ten, else log10-scaled.
+            Defaults to True.
+        processes (int, optional): Worker processes, each reading its own pieces. Defaults to 1.
+
+    Returns:
+        (ColumnStats, ColumnStats): Statistics of the features and of the targets.
+    """
+    jobs = [(source, feature_names, label_names, lin) for source in sources]
+    features, labels = ColumnStats(len(feature_names)), ColumnStats(len(label_names))
+    if processes > 1:
+        with mp.Pool(processes) as pool:
+            results = pool.imap_unordered(_source_stats, jobs)
+            for feature_stats, label_stats in results:
+                features.merge(feature_stats)
+                labels.merge(label_stats)
+    else:
+        for job in jobs:
+            feature_stats, label_stats = _source_stats(job)
+            features.merge(feature_stats)
+            labels.merge(label_stats)
+    return features, labels
+
+
+##### shards #####
+def write_shards(sources, scaling, shard_dir: Path, feature_names, label_names, dtype=np.float32,
+                 shard_rows=2**20, validation_split=0.0, seed=None) -> dict:
+    """Scale a dataset piece by piece into shards on disk, for training on more data than fits in memory.
+
+    The pieces (see training_sources) are read one at a time in random order, scaled with
+    a fixed scaling (see Scaling.from_stats) exactly like scale_all and data_preproc, and
+    written in shards of shard_rows rows. Every shard is a set of .npy files (features,
+    labels, and index: the row of every point in positions.npy, the distinct (x, y) of the
+    dataset, for Mesh.knn_query). A random validation_split of the rows goes to separate
+    shards. shards.json lists the shards (see train_helpers.ShardDataset).
+
+    Args:
+        sources (list): Callables returning the pieces of the dataset.
+        scaling (Scaling): Scaling of the features and targets.
+        shard_dir (Path): Output folder.
+        feature_names (list): Feature columns.
+        label_names (list): Target columns.
+        dtype (optional): dtype of the scaled data. Defaults to np.float32.
+        shard_rows (int, optional): Rows per shard. Defaults to 2**20.
+        validation_split (float, optional): Fraction of rows held out for validation. Defaults to 0.
+        seed (int, optional): Seed of the piece order and of the validation split. Defaults to None.
+
+    Returns:
+        dict: Contents of shards.json.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    (shard_dir/'shards.json').unlink(missing_ok=True)  # a manifest never outlives its shards
+    rng = np.random.default_rng(seed)
+    manifest = {'features': feature_names, 'labels': label_names, 'dtype': np.dtype(dtype).name,
+                'train': [], 'val': []}
+    pending = {'train': [], 'val': []}  # scaled (features, labels, index) waiting to be written
+    positions = pd.Index([], dtype=np.complex128)  # distinct x + iy
+
+    def flush(split, final=False):
+        num_rows = sum(len(part[0]) for part in pending[split])
+        while num_rows >= shard_rows or (final and num_rows > 0):
+            parts = [np.concatenate(arrays) for arrays in zip(*pending[split])]
+            rows = min(shard_rows, num_rows)
+            name = f'{split}_{len(manifest[split]):04d}'
+            for part, suffix in zip(parts, ['features', 'labels', 'index']):
+                np.save(shard_dir/f'{name}.{suffix}.npy', part[:rows])
+            manifest[split].append([name, rows])
+            pending[split] = [tuple(part[rows:] for part in parts)]
+            num_rows -= rows
+
+    for n in rng.permutation(len(sources)):
+        piece = sources[n]()
+        labels = piece[label_names].to_numpy(dtype=np.float64)
+        valid = valid_rows(labels, lin=not scaling.log)  # the rows that data_preproc keeps
+        features = scaling.scale_features(piece[feature_names].to_numpy(dtype=np.float64)[valid]).astype(dtype)
+        labels = scaling.scale_targets(labels[valid], dtype)
+
+        points = piece['x'].to_numpy()[valid] + 1j*piece['y'].to_numpy()[valid]
+        index = positions.get_indexer(points)
+        if (index < 0).any():
+            positions = positions.append(pd.Index(pd.unique(points[index < 0])))
+            index = positions.get_indexer(points)
+
+        is_val = rng.random(len(labels)) < validation_split
+        for split, rows in [('train', ~is_val), ('val', is_val)]:
+            pending[split].append((features[rows], labels[rows], index[rows]))
+            flush(split)
+    for split in pending:
+        flush(split, final=True)
+
+    positions = positions.to_numpy()
+    np.save(shard_dir/'positions.npy', np.stack([positions.real, positions.imag], axis=1))
+    with open(shard_dir/'shards.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def get_case(root, voltage, pressure) -> pd.DataFrame:
+    """Node data of a single (V, P) case, as data_excluded of get_data, without reading the other cases."""
+    cache = NodeDataCache(root/'data'/'avg_data', root/'data'/'avg_data_cache')
+    cache.update([voltage], [pressure])
+    if cache.cases:
+        return cache.shard(voltage, pressure)
+    elif (root/'data'/'avg_data.feather').is_file():
+        avg_data = pd.read_feather(root/'data'/'avg_data.feather')
+        return avg_data[(avg_data['Vpp [V]']==voltage) & (avg_data['P [Pa]']==pressure)].reset_index(drop=True)
+    else:
+        raise Exception('No data available.')
+
+
 ##### misc #####
 def yn(str):
     if str.lower() in ['y', 'yes', 'yea', 'ok', 'okay', 'k',  
@@ -270,13 +745,12 @@ class ImageDataset:
                 train = [torch.load(train_features), torch.load(train_labels)]
                 self.v_used = {pair[0] for pair in train[1]} 
                 self.p_used = {pair[1] for pair in train[1]}
+                if self.is_square:
+                    train[0] = crop(torch.tensor(train[0]), 350, 0, 200, 200).numpy()  # TODO: use opencv for cropping
             else:
-                train_ds = xr.open_dataset(self.data_dir/'rec-interpolation2.nc')
-                train = self._nc_to_np(train_ds, 'train')
-                # TODO: does this create train_features and train_labels?
-            
-            if self.is_square:
-                train[0] = crop(torch.tensor(train[0]), 350, 0, 200, 200).numpy()  # TODO: use opencv for cropping
+                # only the square crop is read from the file if is_square
+                with open_cube(self.data_dir/'rec-interpolation2.nc') as train_ds:
+                    train = self._nc_to_np(train_ds, 'train', SQUARE_WINDOW if self.is_square else None)
 
             self._train = train
             return self._train
@@ -301,12 +775,11 @@ class ImageDataset:
                 test = [torch.load(test_features), torch.load(test_labels)]
                 self.v_excluded = {test[1][0]}  # there is only one excluded set so I can't use a list comprehension
                 self.p_excluded = {test[1][1]}
+                if self.is_square:
+                    test[0] = crop(torch.tensor(test[0]), 350, 0, 200, 200).numpy()  # crop features only
             else:
-                test_ds = xr.open_dataset(self.data_dir/'test_set.nc')
-                test = self._nc_to_np(test_ds, 'test')
-
-            if self.is_square:
-                test[0] = crop(torch.tensor(test[0]), 350, 0, 200, 200).numpy()  # crop features only
+                with open_cube(self.data_dir/'test_set.nc') as test_ds:
+                    test = self._nc_to_np(test_ds, 'test', SQUARE_WINDOW if self.is_square else None)
 
             self._test = test
             return self._test
@@ -340,20 +813,31 @@ class ImageDataset:
         return (array - min) / (max - min)
 
 
-    def _nc_to_np(self, ds: xr.Dataset, which='train') -> list[np.ndarray]:
+    def _nc_to_np(self, ds: xr.Dataset, which='train', window=None) -> list[np.ndarray]:
         """Create NumPy arrays from NetCDF dataset
 
         Creates arrays from the .nc files if the .pt files don't yet exist, and 
         applies minmax scaling to return a pair of features and labels.
 
         Args:
-            ds (xr.Dataset): NetCDF dataset containing images.
-            which (str, optional): _description_. Defaults to 'train'.
+            ds (xr.Dataset): NetCDF dataset containing images (see cubes.open_cube).
+            which (str, optional): 'train' or 'test'. Defaults to 'train'.
+            window (tuple, optional): (rows, columns) to read, e.g. cubes.SQUARE_WINDOW. The .pt
+                files are only saved for whole images. Defaults to None (whole images).
 
         Returns:
             list[np.ndarray]: List containing features, i.e. 2d profiles and labels, i.e. (V, P)
         """
         variables = list(ds.data_vars)
+        if window is None:
+            shape = (ds.sizes['y'], ds.sizes['x'])
+        else:
+            shape = tuple(len(range(*s.indices(ds.sizes[dim]))) for s, dim in zip(window, ['y', 'x']))
+            # the scaling comes from the whole first image, as without a window
+            v, p = ds.V.values[0], ds.P.values[0]
+            for var, image in zip(variables, read_images(ds, v, p, variables=variables)):
+                if var not in self.scaler_dict:
+                    self._scale_np(image, var, self.scaler_dict)
 
         if which == 'test':
             
@@ -361,18 +845,20 @@ class ImageDataset:
                 for p in ds.P.values:
                     # extract the values from the dataset for all 5 variables
                     vp_data = np.nan_to_num(np.stack(
-                        [self._scale_np(ds[var].sel(V=v, P=p).values, var, self.scaler_dict) for var in variables]))
+                        [self._scale_np(image, var, self.scaler_dict)
+                         for var, image in zip(variables, read_images(ds, v, p, window, variables))]))
                     labels = np.array([v, p])  # not yet used
 
             # consider saving as .pt file after conversion
             features = np.expand_dims(np.float32(vp_data), axis=0)
-            assert features.shape == (1, 5, 707, 200)  # samples, channels, height, width
+            assert features.shape == (1, 5, *shape)  # samples, channels, height, width
 
             with open(self.data_dir/'scaler_dict.pkl', 'wb') as f:
                 pickle.dump(self.scaler_dict, f)
 
-            torch.save(labels, self.data_dir/'test_labels.pt')
-            torch.save(features, self.data_dir/'test_features.pt')
+            if window is None:
+                torch.save(labels, self.data_dir/'test_labels.pt')
+                torch.save(features, self.data_dir/'test_features.pt')
 
             return [features, labels]
         
@@ -383,7 +869,8 @@ class ImageDataset:
                 for p in ds.P.values:
                     # extract the values from the dataset for all 5 variables
                     vp_data = np.nan_to_num(np.stack(
-                        [self._scale_np(ds[var].sel(V=v, P=p).values, var, self.scaler_dict) for var in variables]))
+                        [self._scale_np(image, var, self.scaler_dict)
+                         for var, image in zip(variables, read_images(ds, v, p, window, variables))]))
                     label = np.array([v, p])
                     if (v == self.v_excluded) & (p == self.p_excluded):
                         pass  # this is a hole in the data set that contains only nans
@@ -394,13 +881,14 @@ class ImageDataset:
             features = np.float32(np.stack(data_list))
             labels = np.float32(np.stack(label_list))  # not yet used
             # samples, channels, height, width
-            assert features.shape == (31, 5, 707, 200)
+            assert features.shape == (31, 5, *shape)
 
             with open(self.data_dir/'scaler_dict.pkl', 'wb') as f:
                 pickle.dump(self.scaler_dict, f)
 
-            torch.save(labels, self.data_dir/'train_labels.pt')
-            torch.save(features, self.data_dir/'train_features.pt')
+            if window is None:
+                torch.save(labels, self.data_dir/'train_labels.pt')
+                torch.save(features, self.data_dir/'train_features.pt')
 
             return [features, labels]
         
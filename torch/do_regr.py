@@ -16,9 +16,12 @@ import os
 import sys
 import pickle
 from pathlib import Path
+from argparse import ArgumentParser
 
 import data_helpers
 import plot
+from scalers import MinMax, Scaling
+from train_helpers import Profiler
 
 
 class MLP(nn.Module):
@@ -107,6 +110,45 @@ class MLP2(nn.Module):
         return output
 
 
+class ScaledModel(nn.Module):
+    """Trained model with its scaling folded into the forward pass.
+
+    Takes unscaled features (e.g. V, P, x, y) and returns the targets in their original
+    units, so that inference is a single tensor-in, tensor-out call. The scaling is done
+    in float64 on either side of the model, like scale_features and reverse_minmax
+    (call .float() to keep everything in float32, e.g. on mps).
+
+    Args:
+        model (nn.Module): Trained model.
+        scaling (Scaling): Scaling of the model (see scalers.Scaling.from_model_dir).
+        rescale (bool, optional): Undo the power-of-ten scaling of the targets. If False, the
+            targets are in the units of scale_targets. Defaults to True.
+    """
+    def __init__(self, model: nn.Module, scaling: Scaling, rescale=True) -> None:
+        super(ScaledModel, self).__init__()
+        self.model = model
+        self.log = scaling.log and rescale
+        self.register_buffer('x_scale', torch.tensor(scaling.features.scale))
+        self.register_buffer('x_offset', torch.tensor(scaling.features.offset))
+        targets = scaling.targets
+        self.register_buffer('y_scale', None if targets is None else torch.tensor(targets.scale))
+        self.register_buffer('y_offset', None if targets is None else torch.tensor(targets.offset))
+        exponents = scaling.exponents if rescale and not scaling.log else None
+        self.register_buffer('y_factor', None if exponents is None else torch.tensor(10**exponents))
+
+    def forward(self, x):
+        """Predict the targets of a (batch_size, features) tensor of unscaled features."""
+        x = x.to(self.x_scale.dtype)*self.x_scale + self.x_offset
+        y = self.model(x.to(next(self.model.parameters()).dtype)).to(self.x_scale.dtype)
+        if self.y_scale is not None:
+            y = (y - self.y_offset)/self.y_scale
+        if self.log:
+            y = 10**y
+        elif self.y_factor is not None:
+            y = y*self.y_factor
+        return y
+
+
 class PredictionDataset:
     """
     A dataset for making predictions.
@@ -167,13 +209,11 @@ class PredictionDataset:
         self.model.eval()
         if self.prediction_result is None:
             print(f"\nGetting {self.model_name} prediction...\r", end="")
-            features_tensor = scale_features(self.features, model_dir)
-
-            result = pd.DataFrame(self.model(features_tensor)\
-                                            .detach().numpy(), 
-                                            columns=list(self.labels.columns))
-            
-            result = reverse_minmax(result, model_dir)
+            # targets are compared in the units of scale_targets
+            scaled_model = ScaledModel(self.model, Scaling.from_model_dir(model_dir), rescale=False)
+            with torch.no_grad():
+                outputs = scaled_model(torch.tensor(self.features.to_numpy()))
+            result = pd.DataFrame(outputs.numpy(), columns=list(self.labels.columns))
             print("\33[2KPrediction complete!")
             self.prediction_result = result
             return result
@@ -219,6 +259,9 @@ def process_data(df: pd.DataFrame, data_excluded: tuple):
 def scale_features(df: pd.DataFrame, model_dir: Path):
     """Scale table's features for regression.
 
+    The model's feature scalers are read once (see scalers.MinMax) and applied to the
+    whole table at once.
+
     Args:
         df (pd.DataFrame): Table of features to scale.
         model_dir (Path): Model directory to get the scaler files.
@@ -227,22 +270,8 @@ def scale_features(df: pd.DataFrame, model_dir: Path):
         torch.FloatTensor: Tensor of features that can be directly used for
         model evaluation.
     """
-    def scale_features_core(values, n):
-        # column_values = df[column].values.reshape(-1, 1)
-        values = np.array([values]).reshape(1, -1)
-        scaler_file = model_dir/'scalers'/f'xscaler_{n:02}.pkl'
-        with open(scaler_file, 'rb') as sf:
-            xscaler = pickle.load(sf)
-            xscaler.clip = False
-            return xscaler.transform(values).item()
-
-    columns = [df[column].apply(scale_features_core, args=(n,)) for n, column in enumerate(df.columns, start=1)]
-    scaled_df = pd.concat(columns, axis=1)
-
-    # columns = [scale_features_core(n, column) for n, column in enumerate(data_table.columns, start=1)]
-    # scaled_df = pd.DataFrame(np.hstack(columns), columns=data_table.columns)
-
-    return torch.FloatTensor(scaled_df.to_numpy())
+    xscaler = MinMax.load(model_dir/'scalers', 'x')
+    return torch.FloatTensor(xscaler.transform(df.to_numpy()))
 
 
 def scale_targets(data_table: pd.DataFrame, scale_exp=[1.0, 14.0, 14.0, 16.0, 0.0]):
@@ -282,19 +311,8 @@ def reverse_minmax(df: pd.DataFrame, model_dir: Path):
     Returns:
         pd.DataFrame: DataFrame of unscaled predictions.
     """
-
-    def reverse_minmax_core(values, n):
-        values = np.array([values]).reshape(1, -1)
-        scaler_file = model_dir/'scalers'/f'yscaler_{n:02}.pkl'
-        with open(scaler_file, 'rb') as sf:
-            yscaler = pickle.load(sf)
-            yscaler.clip = False
-            return yscaler.inverse_transform(values).item()
-
-    columns = [df[column].apply(reverse_minmax_core, args=(n,)) for n, column in enumerate(df.columns, start=1)]
-    scaled_df = pd.concat(columns, axis=1)
-
-    return scaled_df
+    yscaler = MinMax.load(model_dir/'scalers', 'y')
+    return pd.DataFrame(yscaler.inverse_transform(df.to_numpy()), columns=df.columns, index=df.index)
 
 
 def calculate_scores(reference_df: pd.DataFrame, prediction_df: pd.DataFrame):
@@ -324,6 +342,11 @@ def calculate_scores(reference_df: pd.DataFrame, prediction_df: pd.DataFrame):
     return scores_df
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the prediction with torch.profiler (saved in the prediction directory)')
+    args = parser.parse_args()
+
     feature_names = ['V', 'P', 'x', 'y']
     label_names = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
 
@@ -349,11 +372,12 @@ if __name__ == '__main__':
     print('\nLoaded model ' + name)
 
     # load dataset
-    regr_df = data_helpers.read_file(root/'data'/'avg_data'/'300Vpp_060Pa_node.dat')\
-        .drop(columns=['Ex (V/m)', 'Ey (V/m)'])
+    regr_df = data_helpers.read_file(root/'data'/'avg_data'/'300Vpp_060Pa_node.dat',
+                                     columns=data_helpers.not_efield)
     regr_df = PredictionDataset(regr_df, model, metadata)
 
-    prediction = regr_df.prediction  # make a prediction
+    with Profiler(regr_dir, enabled=args.profile, steps=None):
+        prediction = regr_df.prediction  # make a prediction
     regr_df.get_scores()  # get scores and make correlation plot
 
     triangles = plot.triangulate(regr_df.features[['x', 'y']])
@@ -11,7 +11,9 @@ import pandas as pd
 from pathlib import Path
 import matplotlib.pyplot as plt
 
-nc_data = Path('/Users/jarl/2d-discharge-nn/data/interpolation_datasets/full_interpolation.nc')
+from cubes import open_cube, read_images, SQUARE_WINDOW
+
+nc_data = Path.cwd()/'data'/'interpolation_datasets'/'full_interpolation.nc'  # run from the repository root
 
 def get_dataset_old(V, P, data_dir):
     """(old) function to load data from a pair of V, P
@@ -33,25 +35,27 @@ def get_dataset_old(V, P, data_dir):
     return array
 
 
-def get_dataset(V, P, dataset:Path = nc_data):
+def get_dataset(V, P, dataset:Path = nc_data, window=None):
     """Load the dataset for a pair of V, P from an nc file.
 
-    Uses interpolation_datasets/full_interpolation.nc by default.
+    Uses interpolation_datasets/full_interpolation.nc by default. Only the (V, P) and the
+    window are read from the file (see cubes.read_images).
 
     Args:
         V (numeric): voltage
         P (numeric): pressure
         dataset (Path, optional): Path to .nc file to be used. 
             Defaults to Path('/Users/jarl/2d-discharge-nn/data/\ interpolation_datasets/full_interpolation.nc').
+        window (tuple, optional): (rows, columns) to read, e.g. SQUARE_WINDOW for the crop of
+            crop(). Defaults to None (the whole image).
 
     Returns:
         np.ndarray: Dataset for the specified V, P pair, with shape (channels, height, width).
     """
 
-    ds = xr.open_dataset(dataset)
-    
-    # each element in the array has shape (height, width), stacking gives (channels, height, width)
-    data_array = np.stack([np.nan_to_num(ds[variable].sel(V=V, P=P).values) for variable in list(ds.keys())])
+    with open_cube(dataset) as ds:
+        # each element in the array has shape (height, width), stacking gives (channels, height, width)
+        data_array = np.nan_to_num(read_images(ds, V, P, window))
 
     return data_array
 
@@ -139,7 +143,7 @@ def get_data(test:tuple, validation:tuple = None, resolution=None, square=False)
     """
     
     global nc_data
-    ds = xr.open_dataset(nc_data)
+    ds = open_cube(nc_data)
     v_list = list(ds.V.values)
     p_list = list(ds.P.values)
 
@@ -147,8 +151,7 @@ def get_data(test:tuple, validation:tuple = None, resolution=None, square=False)
 
     train_images = []
     for vp in vps:
-        image = get_dataset(vp[0], vp[1])  # load data
-        image = crop(image) if square else None
+        image = get_dataset(vp[0], vp[1], window=SQUARE_WINDOW if square else None)  # load data, cropped if square
         image = downscale(image, resolution) if resolution is not None else None
 
         image = minmax_scale(image, ds)
@@ -9,6 +9,7 @@ Conditional autoencoder to reproduce 2d plasma profiles from a pair of V, P
 import os
 import time
 from pathlib import Path
+from argparse import ArgumentParser
 
 import matplotlib.pyplot as plt
 
@@ -31,6 +32,7 @@ from sklearn.model_selection import train_test_split
 
 from data_helpers import ImageDataset
 from plot import draw_apparatus, save_history_graph
+from train_helpers import Checkpointer
 
 class Autoencoder(nn.Module):
     def __init__(self):
@@ -190,6 +192,10 @@ def plot_comparison_ae(reference: np.ndarray, name=None,
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of the model')
+    args = parser.parse_args()
+
     # set metal backend (apple socs)
     device = torch.device(
         'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -242,10 +248,17 @@ if __name__ == '__main__':
                             torch.tensor(train_labels, device=device))
     trainloader = DataLoader(dataset, batch_size=1, shuffle=True)
 
+    # periodic checkpoints of the MLP, written in the background
+    checkpointer = Checkpointer(out_dir/'checkpoints', keep=3)
+    start_epoch = 0
+    if args.resume:
+        start_epoch, history = checkpointer.load(mlp, optimizer)
+        epoch_loss = history['epoch_loss']
+
     # begin training MLP
     print("Training MLP...\r", end="")
     train_start = time.time()
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         loop = tqdm(trainloader)
         running_loss = 0.0  # record losses
 
@@ -265,11 +278,11 @@ if __name__ == '__main__':
             running_loss += loss.item()
 
         epoch_loss.append(loss.item())
-        if (epoch+1) % epochs == 0:
-            # save model every 10 epochs (so i dont lose all training progress in case i do something unwise)
-            torch.save(model.state_dict(), out_dir/f'{name}')
-            save_history_graph(epoch_loss, out_dir)
+        if (epoch+1) % 10 == 0:
+            # checkpoint every 10 epochs (so i dont lose all training progress in case i do something unwise)
+            checkpointer.save(epoch, mlp, optimizer, {'epoch_loss': epoch_loss})
 
+    checkpointer.close()
     print("\33[2KMLP training complete!")
     train_end = time.time()
     torch.save(model.state_dict(), out_dir/f'{name}')
@@ -0,0 +1,218 @@
+""" Simulation mesh shared by plotting, neighbor regularization and interpolation.
+
+The node files end with the element connectivity of the simulation mesh. It is stored
+once per mesh (keyed by a hash of the node coordinates) so that consumers don't have
+to rebuild the geometry from scratch.
+
+created by jarl
+"""
+
+import os
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+import matplotlib.tri
+
+mesh_dir = Path.cwd()/'data'/'avg_data_cache'/'mesh'
+_meshes = {}  # meshes already loaded in this process, keyed by mesh_key()
+
+
+def mesh_key(nodes: np.ndarray) -> str:
+    """Hash of the node coordinates, used to identify a mesh.
+
+    Args:
+        nodes (np.ndarray): (num_nodes, 2) array of node coordinates (X, Y) in m.
+
+    Returns:
+        str: Hex digest identifying the mesh.
+    """
+    nodes = np.ascontiguousarray(nodes, dtype=np.float64)
+    return hashlib.sha256(nodes.tobytes()).hexdigest()[:16]
+
+
+class Mesh:
+    """Simulation mesh with lazily computed triangles, adjacency and KD-tree.
+
+    Args:
+        nodes (np.ndarray): (num_nodes, 2) array of node coordinates (X, Y) in m.
+        elements (np.ndarray, optional): (num_elements, 4) array of 0-based node indices
+            of each quadrilateral element (triangles repeat their last node). Defaults to None.
+    """
+    def __init__(self, nodes: np.ndarray, elements: np.ndarray = None) -> None:
+        self.nodes = np.ascontiguousarray(nodes, dtype=np.float64)
+        self.elements = elements
+        self.key = mesh_key(self.nodes)
+        self._triangles = None
+        self._adjacency = None
+        self._tree = None
+        self._knn = {}  # (k, distance_upper_bound): k-NN adjacency
+
+    @property
+    def triangles(self) -> np.ndarray:
+        """(num_triangles, 3) node indices, each quad split in two and degenerate triangles removed.
+
+        Falls back to a Delaunay triangulation if the connectivity is unknown.
+        """
+        if self._triangles is None:
+            if self.elements is None:
+                self._triangles = matplotlib.tri.Triangulation(self.nodes[:, 0], self.nodes[:, 1]).triangles
+            else:
+                e = self.elements
+                triangles = np.concatenate([e[:, [0, 1, 2]], e[:, [0, 2, 3]]])
+                degenerate = ((triangles[:, 0] == triangles[:, 1]) |
+                              (triangles[:, 1] == triangles[:, 2]) |
+                              (triangles[:, 0] == triangles[:, 2]))
+                self._triangles = triangles[~degenerate]
+        return self._triangles
+
+    @property
+    def adjacency(self) -> sp.csr_matrix:
+        """Symmetric (num_nodes, num_nodes) CSR matrix of nodes sharing an element edge."""
+        if self._adjacency is None:
+            if self.elements is None:
+                edges = np.concatenate([self.triangles[:, [0, 1]], self.triangles[:, [1, 2]], self.triangles[:, [2, 0]]])
+            else:
+                e = self.elements
+                edges = np.concatenate([e[:, [0, 1]], e[:, [1, 2]], e[:, [2, 3]], e[:, [3, 0]]])
+            edges = edges[edges[:, 0] != edges[:, 1]]
+            i = np.concatenate([edges[:, 0], edges[:, 1]])
+            j = np.concatenate([edges[:, 1], edges[:, 0]])
+
+            num_nodes = len(self.nodes)
+            adjacency = sp.coo_matrix((np.ones(len(i)), (i, j)), shape=(num_nodes, num_nodes)).tocsr()
+            adjacency.data[:] = 1.0  # shared edges are counted twice by tocsr()
+            self._adjacency = adjacency
+        return self._adjacency
+
+    @property
+    def tree(self) -> cKDTree:
+        """KD-tree of the node coordinates (m)."""
+        if self._tree is None:
+            self._tree = cKDTree(self.nodes)
+        return self._tree
+
+    def knn_adjacency(self, k=4, distance_upper_bound=1e-3, cache_dir: Path = None) -> sp.csr_matrix:
+        """Row-normalized (num_nodes, num_nodes) CSR matrix of each node's k nearest neighbors.
+
+        Row i holds 1/n at the columns of the n <= k nodes (including node i itself) that are
+        within distance_upper_bound of node i, so that knn @ outputs gives the neighbor mean
+        of every node. The matrix is computed once per mesh and cached as
+        {key}_knn{k}_{distance_upper_bound}.npz in cache_dir (mesh_dir by default).
+
+        Args:
+            k (int, optional): Number of nearest neighbors. Defaults to 4.
+            distance_upper_bound (float, optional): Maximum neighbor distance (m). Defaults to 1e-3.
+            cache_dir (Path, optional): Folder of the cached matrices. Defaults to mesh_dir.
+
+        Returns:
+            sp.csr_matrix: k-NN adjacency.
+        """
+        if (k, distance_upper_bound) not in self._knn:
+            file = Path(cache_dir or mesh_dir)/f'{self.key}_knn{k}_{distance_upper_bound:g}.npz'
+            if file.exists():
+                knn = sp.load_npz(file).tocsr()
+            else:
+                knn = self.knn_query(self.nodes, k, distance_upper_bound)
+                file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = file.with_name(f'{file.stem}.{os.getpid()}.tmp.npz')
+                sp.save_npz(tmp_file, knn)
+                os.replace(tmp_file, file)  # other processes never see a partial file
+            self._knn[(k, distance_upper_bound)] = knn
+        return self._knn[(k, distance_upper_bound)]
+
+    def knn_query(self, points: np.ndarray, k=4, distance_upper_bound=1e-3) -> sp.csr_matrix:
+        """Row-normalized (num_points, num_nodes) CSR matrix of the k nearest nodes of any points.
+
+        Row i holds 1/n at the columns of the n <= k nodes within distance_upper_bound of
+        point i (see knn_adjacency, which is knn_query of the nodes themselves). A point with
+        no node within the bound (e.g. an augmentation point off the mesh) gets its single
+        nearest node instead, so that no row is empty and no neighbor mean is zero.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        _, ii = self.tree.query(points, k, distance_upper_bound=distance_upper_bound)
+        ii = ii.reshape(len(points), k)
+        found = ii < len(self.nodes)  # missing neighbors are returned as num_nodes
+
+        isolated = ~found.any(axis=1)
+        if isolated.any():
+            _, ii[isolated, 0] = self.tree.query(points[isolated], 1)
+            found[isolated, 0] = True
+
+        rows = np.broadcast_to(np.arange(len(points))[:, np.newaxis], ii.shape)
+        weights = np.broadcast_to(1/found.sum(axis=1, keepdims=True), ii.shape)
+        return sp.csr_matrix((weights[found], (rows[found], ii[found])), shape=(len(points), len(self.nodes)))
+
+    def knn_rows(self, points: np.ndarray, k=4, distance_upper_bound=1e-3):
+        """k-NN adjacency for the points of a training table, and the row of every point in it.
+
+        A table of whole cases (every node in file order, case after case) uses the cached
+        knn_adjacency, with node i at row i. Otherwise, e.g. with augmentation data that is
+        not on the mesh, every distinct point gets a row with its k nearest nodes.
+
+        Args:
+            points (np.ndarray): (num_points, 2) coordinates (x, y) in m.
+            k (int, optional): Number of nearest neighbors. Defaults to 4.
+            distance_upper_bound (float, optional): Maximum neighbor distance (m). Defaults to 1e-3.
+
+        Returns:
+            (sp.csr_matrix, np.ndarray): Adjacency, and the row of each point.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        num_nodes = len(self.nodes)
+        if (len(points) % num_nodes == 0) and (points.reshape(-1, num_nodes, 2) == self.nodes).all():
+            return self.knn_adjacency(k, distance_upper_bound), np.arange(len(points)) % num_nodes
+        positions, index = np.unique(points, axis=0, return_inverse=True)
+        return self.knn_query(positions, k, distance_upper_bound), index.reshape(-1)
+
+    def triangulation(self, scale=100) -> matplotlib.tri.Triangulation:
+        """Triangulation for tricontourf. scale converts m to the plot units (default: cm)."""
+        return matplotlib.tri.Triangulation(self.nodes[:, 0]*scale, self.nodes[:, 1]*scale,
+                                            triangles=self.triangles)
+
+    def save(self, out_dir: Path = None) -> Path:
+        """Save nodes and connectivity as {key}.npz in out_dir (mesh_dir by default)."""
+        out_dir = Path(out_dir or mesh_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        file = out_dir/f'{self.key}.npz'
+        tmp_file = out_dir/f'{self.key}.{os.getpid()}.tmp.npz'
+        if self.elements is None:
+            np.savez(tmp_file, nodes=self.nodes)
+        else:
+            np.savez(tmp_file, nodes=self.nodes, elements=self.elements)
+        os.replace(tmp_file, file)  # other processes never see a partial file
+        _meshes[self.key] = self
+        return file
+
+
+def get_mesh(nodes, in_dir: Path = None) -> Mesh:
+    """Get the shared Mesh object for a set of node coordinates.
+
+    Meshes are looked up in memory first, then in {key}.npz files written by Mesh.save().
+    If the connectivity has never been saved, a mesh without elements is returned
+    (triangles fall back to Delaunay).
+
+    Args:
+        nodes (np.ndarray or pd.DataFrame): (num_nodes, 2) node coordinates (X, Y) in m,
+            in the order of the node file.
+        in_dir (Path, optional): Folder of saved meshes. Defaults to mesh_dir.
+
+    Returns:
+        Mesh: Mesh shared by every caller with the same node coordinates.
+    """
+    nodes = np.asarray(nodes, dtype=np.float64)
+    key = mesh_key(nodes)
+    if key in _meshes:
+        return _meshes[key]
+
+    file = Path(in_dir or mesh_dir)/f'{key}.npz'
+    if file.exists():
+        with np.load(file) as saved:
+            mesh = Mesh(saved['nodes'], saved['elements'] if 'elements' in saved else None)
+    else:
+        mesh = Mesh(nodes)
+
+    _meshes[key] = mesh
+    return mesh
@@ -0,0 +1,158 @@
+"""
+Reading the Tecplot node files ({V}Vpp_{P}Pa_node.dat) of the simulation.
+
+Each file starts with a line of quoted variable names and a ZONE line, followed by the
+node block (one line of values per node) and the element connectivity (4 node indices
+per line). read_file parses a file in a single pass with pandas' C tokenizer, and
+read_all_data reads several cases into one table.
+
+Only depends on numpy and pandas, so that the tensorflow scripts (tensorflow/data.py)
+use the same parser as data_helpers.
+
+created: @jarl
+"""
+
+import io
+import os
+import re
+import posixpath
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+# a line of 4 integer node indices marks the start of the element connectivity section
+CONNECTIVITY_LINE = re.compile(r'\n[ \t]*\d+[ \t]+\d+[ \t]+\d+[ \t]+\d+[ \t]*(?:\n|$)')
+
+def read_all_data(fldr_path, voltages, pressures, columns=None, processes=1):
+    """Read the {V}Vpp_{P}Pa_node.dat files of all (V, P) pairs into one DataFrame.
+
+    Files are parsed in a process pool if processes != 1. The parsed cases are copied
+    once into a preallocated array and the V, P columns are filled by broadcasting.
+
+    Args:
+        fldr_path (str or Path): Folder containing the .dat files.
+        voltages (list): Voltages to read (V).
+        pressures (list): Pressures to read (Pa).
+        columns (list or callable, optional): Variables to parse, see read_file.
+            Must be picklable (no lambdas) when using processes. Defaults to None.
+        processes (int, optional): Number of worker processes, all cores if None.
+            Defaults to 1 (serial).
+
+    Returns:
+        pd.DataFrame: Node data of all cases, with 'Vpp [V]' and 'P [Pa]' as the first columns.
+    """
+    cases = find_cases(fldr_path, voltages, pressures)
+    if len(cases) == 0:
+        return pd.DataFrame(columns=['Vpp [V]', 'P [Pa]'])
+
+    results = read_cases([file_path for _, _, file_path in cases], columns, processes)
+
+    # single copy of every case into one contiguous (cases*nodes, variables) array
+    column_labels = results[0][0]
+    num_rows = sum(len(values) for _, values, _ in results)
+    data_table = np.empty((num_rows, len(column_labels)+2), dtype=np.float64)
+
+    start = 0
+    for (voltage, pressure, file_path), (labels, values, _) in zip(cases, results):
+        if labels != column_labels:
+            raise Exception(f'{file_path} has variables {labels}, expected {column_labels}')
+        end = start + len(values)
+        data_table[start:end, 0] = voltage
+        data_table[start:end, 1] = pressure
+        data_table[start:end, 2:] = values
+        start = end
+
+    return pd.DataFrame(data_table, columns=['Vpp [V]', 'P [Pa]'] + column_labels)
+
+
+def find_cases(fldr_path, voltages, pressures):
+    """List the node files available for each (V, P) pair.
+
+    Returns:
+        list: (voltage, pressure, file_path) of every file that exists, V-major order.
+    """
+    cases = []
+    for voltage in voltages:
+        for pressure in pressures:
+            file_name = '{0:d}Vpp_{1:03d}Pa_node.dat'.format(voltage,pressure)
+            file_path = posixpath.join(fldr_path, file_name)
+            if os.path.exists(file_path):
+                cases.append((voltage, pressure, file_path))
+    return cases
+
+
+def read_cases(file_paths, columns=None, processes=1, elements=False):
+    """Parse several node files, in a process pool if processes != 1.
+
+    Returns:
+        list: (column labels, values, elements) for each file, in the order of file_paths.
+            elements is None unless requested.
+    """
+    jobs = [(file_path, columns, elements) for file_path in file_paths]
+    if (processes == 1) or (len(jobs) <= 1):
+        return [_read_case(job) for job in jobs]
+
+    processes = min(processes or os.cpu_count(), len(jobs))
+    with mp.Pool(processes) as pool:
+        return pool.map(_read_case, jobs)
+
+
+def _read_case(job):
+    """Parse a single file for read_cases. Returns (column labels, values, elements)."""
+    file_path, columns, elements = job
+    if elements:
+        data, elements = read_file(file_path, columns, elements=True)
+    else:
+        data, elements = read_file(file_path, columns), None
+    return list(data.columns), data.to_numpy(), elements
+
+
+def read_file(file_path, columns=None, elements=False):
+    """Read a Tecplot-style node file into a DataFrame.
+
+    The first line holds the quoted variable names and the second line is the ZONE
+    header. The node block is parsed in a single pass with pandas' C tokenizer and
+    ends at the first 4-column line, where the element connectivity section begins.
+
+    Args:
+        file_path (str or Path): Path to the .dat file.
+        columns (list or callable, optional): Variables to parse, passed to
+            pd.read_csv as usecols. Other columns are never materialized.
+            Defaults to None (all columns).
+        elements (bool, optional): Also return the element connectivity. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Node data (float64) with the variable names as columns.
+        np.ndarray: (num_elements, 4) array of 0-based node indices, only if elements=True.
+    """
+    with open(file_path, 'r') as f:
+        header = f.readline().strip()
+        f.readline()  # ZONE line
+        body = f.read()
+
+    line = re.findall(r'"[^"]*"', header) # get ['"var_name1"', '"var_name2"', ...]
+    column_labels = [var_name.replace('"','') for var_name in line]
+
+    connectivity = CONNECTIVITY_LINE.search(body)
+    node_block = body if connectivity is None else body[:connectivity.start()+1]
+
+    nodes = pd.read_csv(io.StringIO(node_block), sep=r'\s+', header=None, names=column_labels,
+                        usecols=columns, dtype=np.float64, engine='c')
+    if not elements:
+        return nodes
+
+    element_block = '' if connectivity is None else body[connectivity.start()+1:]
+    if element_block.strip():
+        element_array = pd.read_csv(io.StringIO(element_block), sep=r'\s+', header=None,
+                                    dtype=np.int64, engine='c').to_numpy() - 1  # Tecplot indices start at 1
+    else:
+        element_array = np.empty((0, 4), dtype=np.int64)
+    return nodes, element_array
+
+
+def attach_VP_columns(data, voltage, pressure):
+    num_data_points = len(data)
+    vp_columns = [[voltage, pressure] for n in range(num_data_points)]
+    vp_columns = pd.DataFrame(vp_columns, columns=['Vpp [V]', 'P [Pa]'])
+    return vp_columns.join(data)
@@ -27,17 +27,19 @@ from pathlib import Path
 from sklearn.preprocessing import MinMaxScaler
 
 from data_helpers import mse, get_data
+from mesh import get_mesh
 
 def triangulate(df: pd.DataFrame):   
     """
     Create triangulation of the mesh grid, which is passed to tricontourf.
     
-    Uses Delaunay triangulation.
+    Uses the simulation mesh's own elements if its connectivity has been cached
+    (see mesh.get_mesh), otherwise falls back to Delaunay triangulation.
 
     Parameters
     ----------
     df : DataFrame
-        DataFrame with X and Y values for the triangulation.
+        DataFrame with X and Y values (in m) for the triangulation, in node file order.
 
     Returns
     -------
@@ -45,11 +47,7 @@ def triangulate(df: pd.DataFrame):
         Triangulated grid.
 
     """
-    x = df['x'].to_numpy()*100
-    y = df['y'].to_numpy()*100
-    triangles = matplotlib.tri.Triangulation(x, y)
-    
-    return triangles
+    return get_mesh(df[['x', 'y']].to_numpy()).triangulation(scale=100)
 
 
 # from data.py
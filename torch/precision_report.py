@@ -0,0 +1,95 @@
+"""
+Compare MLP models trained at different precisions against the float64 baseline.
+
+Every model is evaluated on the held-out (300 V, 60 Pa) case with the scores used in
+do_regr.py. Its prediction is also compared directly against the baseline's prediction.
+The models should come from the same config, differing only in 'precision'.
+
+usage: python torch/precision_report.py BASELINE_DIR MODEL_DIR [MODEL_DIR ...]
+
+created: @jarl
+"""
+
+import time
+import pickle
+from pathlib import Path
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+import pandas as pd
+import torch
+
+import data_helpers
+from do_regr import MLP, scale_features, scale_targets, reverse_minmax, calculate_scores
+from train_helpers import set_precision, autocast
+
+feature_names = ['V', 'P', 'x', 'y']
+label_names = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
+
+
+def predict(model_dir: Path, features: pd.DataFrame):
+    """Predict the held-out case with a model in the precision it was trained in.
+
+    Args:
+        model_dir (Path): Model directory (with train_metadata.pkl and scalers/).
+        features (pd.DataFrame): Unscaled features (V, P, x, y).
+
+    Returns:
+        dict: Training metadata.
+        pd.DataFrame: Prediction after reversing the minmax scaling.
+        float: Inference time (s) of the forward pass.
+    """
+    with open(model_dir/'train_metadata.pkl', 'rb') as f:
+        metadata = pickle.load(f)
+    precision = metadata.get('precision', 'float64')  # models trained before precision modes are float64
+
+    set_precision(precision)
+    model = MLP(len(feature_names), len(label_names))
+    model.load_state_dict(torch.load(model_dir/metadata['name']))
+    model.eval()
+
+    inputs = scale_features(features, model_dir).to(torch.get_default_dtype())
+    start = time.perf_counter()
+    with torch.no_grad(), autocast(precision):
+        outputs = model(inputs).double()
+    elapsed = time.perf_counter() - start
+
+    prediction = pd.DataFrame(outputs.numpy(), columns=label_names)
+    return metadata, reverse_minmax(prediction, model_dir), elapsed
+
+
+if __name__ == '__main__':
+    root = Path.cwd()
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('baseline', type=Path, help='Directory of the float64 model.')
+    parser.add_argument('models', type=Path, nargs='+', help='Directories of the models to compare.')
+    parser.add_argument('-o', '--out', type=Path, default=root/'created_models'/'precision_report.csv',
+                        help='Output csv file.')
+    args = parser.parse_args()
+
+    regr_df = data_helpers.read_file(root/'data'/'avg_data'/'300Vpp_060Pa_node.dat',
+                                     columns=data_helpers.not_efield)
+    features = pd.DataFrame({'V': 300.0, 'P': 60.0, 'x': regr_df['X'], 'y': regr_df['Y']})[feature_names]
+    labels = regr_df[label_names]
+
+    _, baseline, _ = predict(args.baseline, features)
+
+    rows = []
+    for model_dir in [args.baseline] + args.models:
+        metadata, prediction, elapsed = predict(model_dir, features)
+        targets = scale_targets(labels, metadata['parameter_exponents'])
+        scores = calculate_scores(targets, prediction)
+        for column in label_names:
+            rows.append({'model': metadata['name'],
+                         'precision': metadata.get('precision', 'float64'),
+                         'variable': column,
+                         'MAE': scores[column].iloc[0],
+                         'RMSE': scores[column].iloc[1],
+                         'R2': scores[column].iloc[3],
+                         'max |pred - float64 pred|': np.abs(prediction[column] - baseline[column]).max(),
+                         'inference time (ms)': elapsed*1e3})
+
+    report = pd.DataFrame(rows)
+    report.to_csv(args.out, index=False)
+    print(report.to_string(index=False))
+    print(f'\nreport saved to {args.out}')
@@ -0,0 +1,469 @@
+"""
+Minmax scaling of a model's features and targets, as whole-array affine transforms.
+
+A table is scaled as a whole (scale, offset) pair of arrays, so that scaling is a single
+multiply-add over a contiguous array instead of a scaler call per column (or per value).
+The scaling of a table is saved as one file in the model's scaler directory
+(scalers/xscaler.json for the features, scalers/yscaler.json for the targets). Older models
+have one pickled sklearn MinMaxScaler per column (scalers/xscaler_01.pkl, ...), which are
+collapsed into the same arrays. The arithmetic is the same as MinMaxScaler's (without
+clipping), so results are identical.
+
+Power-of-ten (or log10) scaling of the targets before the minmax is done here as well
+(see power_scale). The same scaling can be computed from running statistics (ColumnStats)
+in one pass over data that doesn't fit in memory.
+
+All the scaling of a pointwise model (feature minmax, target minmax and the power-of-ten
+exponents of the targets) is kept in a single versioned artifact, scaling.json in the model
+directory (see Scaling). Models trained before it existed are read from their scaler files
+and train_metadata.pkl, and can be converted with:
+
+usage: python torch/scalers.py MODEL_DIR [MODEL_DIR ...]
+
+Only depends on numpy, so that tensorflow/do_regr.py can use it too.
+
+created: @jarl
+"""
+
+import json
+import pickle
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+
+SCALING_FILE = 'scaling.json'
+SCALING_VERSION = 1
+
+feature_names = ['V', 'P', 'x', 'y']
+label_names = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
+
+_cache = {}  # (scaler directory, prefix, file times) -> MinMax
+
+
+class MinMax:
+    """Per-column minmax scaling to [0, 1], X*scale + offset, as in sklearn's MinMaxScaler.
+
+    scale and offset are computed from the column ranges as MinMaxScaler does, unless given.
+    Scalers fitted on float32 data have float32 scale_ and min_, so those are passed as they
+    are to match the fitted scaler bit for bit.
+
+    Args:
+        data_min (np.ndarray): Minimum of every column.
+        data_max (np.ndarray): Maximum of every column.
+        scale (np.ndarray, optional): Fitted scale of every column. Defaults to None.
+        offset (np.ndarray, optional): Fitted offset of every column. Defaults to None.
+    """
+    def __init__(self, data_min: np.ndarray, data_max: np.ndarray, scale=None, offset=None) -> None:
+        self.data_min = np.asarray(data_min, dtype=np.float64)
+        self.data_max = np.asarray(data_max, dtype=np.float64)
+        if scale is None or offset is None:
+            data_range = self.data_max - self.data_min
+            data_range[data_range < 10*np.finfo(np.float64).eps] = 1.0  # constant columns
+            scale = 1.0/data_range
+            offset = 0.0 - self.data_min*scale
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.scale)
+
+    @classmethod
+    def fit(cls, values: np.ndarray) -> 'MinMax':
+        """Column ranges of a (rows, columns) float array, skipping NaNs."""
+        return cls.from_range(np.nanmin(values, axis=0), np.nanmax(values, axis=0))
+
+    @classmethod
+    def from_range(cls, data_min: np.ndarray, data_max: np.ndarray) -> 'MinMax':
+        """Scaling of columns with the given ranges.
+
+        Computed in the dtype of the ranges, like MinMaxScaler.fit, so float32 data gives
+        float32 scale and offset.
+        """
+        data_range = data_max - data_min
+        data_range[data_range < 10*np.finfo(data_range.dtype).eps] = 1.0  # constant columns
+        scale = 1.0/data_range
+        return cls(data_min, data_max, scale, 0.0 - data_min*scale)
+
+    def state_dict(self) -> dict:
+        return {'min': self.data_min.tolist(), 'max': self.data_max.tolist(),
+                'scale': self.scale.tolist(), 'offset': self.offset.tolist()}
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> 'MinMax':
+        return cls(state['min'], state['max'], state.get('scale'), state.get('offset'))
+
+    def save(self, scaler_dir: Path, prefix: str) -> Path:
+        """Write {prefix}scaler.json in the scaler directory."""
+        file = Path(scaler_dir)/f'{prefix}scaler.json'
+        with open(file, 'w') as f:
+            json.dump({'version': SCALING_VERSION, **self.state_dict()}, f, indent=2)
+        return file
+
+    @classmethod
+    def from_scalers(cls, scalers: list) -> 'MinMax':
+        """Collapse fitted single-column MinMaxScalers (in column order)."""
+        for scaler in scalers:
+            if tuple(scaler.feature_range) != (0, 1):
+                raise Exception(f'feature_range {scaler.feature_range} is not supported')
+        return cls(*(np.concatenate([getattr(scaler, attribute).astype(np.float64) for scaler in scalers])
+                     for attribute in ('data_min_', 'data_max_', 'scale_', 'min_')))
+
+    @classmethod
+    def load(cls, scaler_dir: Path, prefix: str) -> 'MinMax':
+        """Read the {prefix}scaler.json file of a scaler directory (or its {prefix}scaler_NN.pkl files).
+
+        Files are read once: later calls return the cached transform, unless the files changed.
+
+        Args:
+            scaler_dir (Path): Directory of the scaler files (a model's scalers/ directory).
+            prefix (str): 'x' for the features, 'y' for the targets.
+
+        Returns:
+            MinMax: Scaling of every column, in the order of the file numbers.
+        """
+        files = [Path(scaler_dir)/f'{prefix}scaler.json']
+        if not files[0].exists():
+            files = sorted(Path(scaler_dir).glob(f'{prefix}scaler_[0-9][0-9].pkl'))
+        if not files:
+            raise Exception(f'no {prefix}scaler.json or {prefix}scaler_NN.pkl files in {scaler_dir}')
+        key = (str(Path(scaler_dir).resolve()), prefix, tuple(file.stat().st_mtime_ns for file in files))
+        if key not in _cache:
+            if files[0].suffix == '.json':
+                with open(files[0], 'r') as f:
+                    _cache[key] = cls.from_state_dict(json.load(f))
+            else:
+                scalers = []
+                for file in files:
+                    with open(file, 'rb') as f:
+                        scalers.append(pickle.load(f))
+                _cache[key] = cls.from_scalers(scalers)
+        return _cache[key]
+
+    def _check(self, values, inplace=False) -> np.ndarray:
+        if not (inplace and isinstance(values, np.ndarray) and values.dtype in (np.float32, np.float64)):
+            values = np.array(values, dtype=np.float64)  # copy, scaled in place
+        if values.shape[-1] != len(self):
+            raise Exception(f'{values.shape[-1]} columns to scale, but {len(self)} scalers')
+        return values
+
+    def transform(self, values, inplace=False) -> np.ndarray:
+        """Scale a (rows, columns) array or table.
+
+        Args:
+            values: Values to scale, copied to float64.
+            inplace (bool, optional): Scale a float array in place, in its own dtype (like
+                MinMaxScaler.transform). Defaults to False.
+        """
+        values = self._check(values, inplace)
+        values *= self.scale.astype(values.dtype, copy=False)
+        values += self.offset.astype(values.dtype, copy=False)
+        return values
+
+    def inverse_transform(self, values) -> np.ndarray:
+        """Reverse the scaling of a (rows, columns) array or table."""
+        values = self._check(values)
+        values -= self.offset
+        values /= self.scale
+        return values
+
+
+class Scaling:
+    """Every scaling step between a pointwise model's raw data and its tensors.
+
+    Features are minmax-scaled for the model. The model's outputs are reverse minmax-scaled
+    (if the targets were minmax-scaled), which gives the targets divided by 10**exponents
+    (the units of do_regr.scale_targets), or log10 of the targets if they were log-scaled.
+
+    Args:
+        features (MinMax): Feature scaling.
+        targets (MinMax, optional): Target scaling, None if the targets were not minmax-scaled.
+        exponents (list, optional): Power-of-ten exponent of every target. Defaults to None.
+        log (bool, optional): Targets were log10-scaled instead of divided. Defaults to False.
+        feature_names (list, optional): Feature columns. Defaults to None.
+        target_names (list, optional): Target columns. Defaults to None.
+    """
+    def __init__(self, features: MinMax, targets: MinMax = None, exponents=None, log=False,
+                 feature_names=None, target_names=None) -> None:
+        self.features = features
+        self.targets = targets
+        self.exponents = None if exponents is None else np.asarray(exponents, dtype=np.float64)
+        self.log = log
+        self.feature_names = feature_names
+        self.target_names = target_names
+
+    @classmethod
+    def from_scaler_dir(cls, scaler_dir: Path, exponents=None, is_target_scaled=True, lin=True,
+                        feature_names=None, target_names=None) -> 'Scaling':
+        """Collect the scaling of a model from its scaler files."""
+        return cls(MinMax.load(scaler_dir, 'x'), MinMax.load(scaler_dir, 'y') if is_target_scaled else None,
+                   exponents if lin else None, not lin, feature_names, target_names)
+
+    @classmethod
+    def from_stats(cls, features: 'ColumnStats', targets: 'ColumnStats', lin=True, floor=0.0,
+                   is_target_scaled=True, dtype=np.float64, feature_names=None, target_names=None) -> 'Scaling':
+        """Scaling of a dataset from its statistics (see ColumnStats), without loading it.
+
+        Gives the parameters of scale_all on the features and of data_preproc and scale_all
+        on the targets. Division by a power of ten and log10 are monotonic, so the range of
+        the scaled targets is the scaled range of the raw targets.
+
+        Args:
+            features (ColumnStats): Statistics of the raw features.
+            targets (ColumnStats): Statistics of the raw targets, with the range over valid_rows.
+            lin (bool, optional): Targets are divided by powers of ten, else log10-scaled.
+                Defaults to True.
+            floor (float, optional): Smallest exponent (see mean_exponents). Defaults to 0.0.
+            is_target_scaled (bool, optional): Targets are minmax-scaled. Defaults to True.
+            dtype (optional): dtype of the targets after data_preproc. Defaults to np.float64.
+            feature_names (list, optional): Feature columns. Defaults to None.
+            target_names (list, optional): Target columns. Defaults to None.
+        """
+        exponents = None
+        if lin:
+            exponents = power_exponents(targets.mean, floor)
+            low, high = targets.min/10**exponents, targets.max/10**exponents
+        else:
+            low, high = np.log10(targets.min), np.log10(targets.max)
+        target_scaling = MinMax.from_range(low.astype(dtype), high.astype(dtype)) if is_target_scaled else None
+        return cls(MinMax.from_range(features.min, features.max), target_scaling, exponents, not lin,
+                   feature_names, target_names)
+
+    @classmethod
+    def from_model_dir(cls, model_dir: Path) -> 'Scaling':
+        """Read a model's scaling.json, or build it from the files of older models.
+
+        Older models keep their scaling in scalers/ and in train_metadata.pkl (or nowhere, in
+        which case do_regr.py's defaults are assumed: linear, minmax-scaled targets).
+        """
+        model_dir = Path(model_dir)
+        if (model_dir/SCALING_FILE).exists():
+            return cls.load(model_dir)
+
+        metadata = {}
+        if (model_dir/'train_metadata.pkl').exists():
+            with open(model_dir/'train_metadata.pkl', 'rb') as f:
+                metadata = pickle.load(f)
+        scaling = cls.from_scaler_dir(model_dir/'scalers', metadata.get('parameter_exponents'),
+                                      metadata.get('is_target_scaled', True), metadata.get('scaling', True))
+        if len(scaling.features) == len(feature_names):
+            scaling.feature_names = feature_names
+        if scaling.targets is not None and len(scaling.targets) == len(label_names):
+            scaling.target_names = label_names
+        return scaling
+
+    def state_dict(self) -> dict:
+        def minmax(scaler, names):
+            return None if scaler is None else {'names': names, **scaler.state_dict()}
+        return {'version': SCALING_VERSION,
+                'features': minmax(self.features, self.feature_names),
+                'targets': minmax(self.targets, self.target_names),
+                'exponents': None if self.exponents is None else self.exponents.tolist(),
+                'log': self.log}
+
+    def save(self, model_dir: Path) -> Path:
+        """Write scaling.json in the model directory."""
+        file = Path(model_dir)/SCALING_FILE
+        with open(file, 'w') as f:
+            json.dump(self.state_dict(), f, indent=2)  # floats are written with full precision
+        return file
+
+    @classmethod
+    def load(cls, model_dir: Path) -> 'Scaling':
+        with open(Path(model_dir)/SCALING_FILE, 'r') as f:
+            state = json.load(f)
+        if state.get('version', 0) > SCALING_VERSION:
+            raise Exception(f'{Path(model_dir)/SCALING_FILE} has version {state["version"]}, '
+                            f'only versions up to {SCALING_VERSION} are supported')
+        features, targets = state['features'], state['targets']
+        return cls(MinMax.from_state_dict(features), None if targets is None else MinMax.from_state_dict(targets),
+                   state['exponents'], state['log'],
+                   features['names'], None if targets is None else targets['names'])
+
+    def scale_features(self, values) -> np.ndarray:
+        """Raw (rows, features) values to model inputs."""
+        return self.features.transform(values)
+
+    def scale_targets(self, values, dtype=np.float64) -> np.ndarray:
+        """Targets to model outputs, the reverse of unscale_targets.
+
+        Computed like data_preproc and scale_all: power-of-ten (or log10) scaling in float64,
+        rounded once to dtype, then the minmax in dtype.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if self.log:
+            values = np.log10(values)
+        elif self.exponents is not None:
+            values = values/10**self.exponents
+        values = values.astype(dtype)
+        return values if self.targets is None else self.targets.transform(values, inplace=True)
+
+    def unscale_targets(self, values, rescale=True) -> np.ndarray:
+        """Model outputs to targets.
+
+        Args:
+            values (np.ndarray): (rows, targets) model outputs.
+            rescale (bool, optional): Undo the power-of-ten (or log) scaling as well, which gives
+                the targets in their original units. Defaults to True.
+        """
+        values = np.array(values, dtype=np.float64) if self.targets is None else self.targets.inverse_transform(values)
+        if rescale:
+            if self.log:
+                values = 10**values
+            elif self.exponents is not None:
+                values *= 10**self.exponents
+        return values
+
+
+class ColumnStats:
+    """Running statistics of every column of a (rows, columns) array, one chunk at a time.
+
+    One pass over data that doesn't fit in memory gives its scaling (see Scaling.from_stats).
+    Statistics of separate parts of the data, e.g. from different processes, are combined
+    with merge.
+
+    Means skip NaNs, as in pandas. The minimum and maximum also skip NaNs, and only cover
+    the valid rows passed to update (e.g. the rows that data_preproc keeps, see valid_rows).
+
+    Args:
+        num_columns (int): Number of columns.
+    """
+    def __init__(self, num_columns: int) -> None:
+        self.count = np.zeros(num_columns, dtype=np.int64)  # values that are not NaN
+        self.total = np.zeros(num_columns)
+        self.log_count = np.zeros(num_columns, dtype=np.int64)  # positive values
+        self.log_total = np.zeros(num_columns)  # sum of log10
+        self.min = np.full(num_columns, np.nan)
+        self.max = np.full(num_columns, np.nan)
+
+    def update(self, values: np.ndarray, valid=None) -> 'ColumnStats':
+        """Add the rows of a chunk.
+
+        Args:
+            values (np.ndarray): (rows, columns) array.
+            valid (np.ndarray, optional): Boolean mask of the rows that count for the minimum
+                and maximum. Defaults to None (all rows).
+        """
+        values = np.asarray(values)
+        self.count += np.count_nonzero(~np.isnan(values), axis=0)
+        self.total += np.nansum(values, axis=0, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            positive = values > 0
+        self.log_count += np.count_nonzero(positive, axis=0)
+        self.log_total += np.log10(values, out=np.zeros(values.shape), where=positive).sum(axis=0)
+
+        if valid is not None:
+            values = values[valid]
+        if len(values) > 0:
+            self.min = np.fmin(self.min, np.fmin.reduce(values, axis=0))  # fmin skips NaNs
+            self.max = np.fmax(self.max, np.fmax.reduce(values, axis=0))
+        return self
+
+    def merge(self, other: 'ColumnStats') -> 'ColumnStats':
+        """Add the statistics of other rows."""
+        self.count += other.count
+        self.total += other.total
+        self.log_count += other.log_count
+        self.log_total += other.log_total
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        return self
+
+    @property
+    def mean(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.total/self.count
+
+    @property
+    def log_mean(self) -> np.ndarray:
+        """Mean of log10 of the positive values."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.log_total/self.log_count
+
+
+def valid_rows(values: np.ndarray, targets=None, lin=True) -> np.ndarray:
+    """Rows of an unscaled table that data_preproc keeps.
+
+    Args:
+        values (np.ndarray): (rows, columns) array.
+        targets (optional): Boolean mask of the target columns. Defaults to None (all columns).
+        lin (bool, optional): Targets are divided by powers of ten, else log10-scaled (which
+            drops rows with targets <= 0). Defaults to True.
+    """
+    valid = np.isfinite(values)
+    if not lin:
+        with np.errstate(invalid='ignore'):
+            valid &= (values > 0) | (False if targets is None else ~np.asarray(targets, dtype=bool))
+    return valid.all(axis=1)
+
+
+def mean_exponents(values: np.ndarray, floor=0.0) -> np.ndarray:
+    """Power-of-ten exponent of every column, one below the order of magnitude of its mean.
+
+    Args:
+        values (np.ndarray): (rows, columns) array. NaNs are skipped, as in pandas' mean.
+        floor (float, optional): Smallest exponent, so that small values are not blown up.
+            None for no limit. Defaults to 0.0.
+
+    Returns:
+        np.ndarray: round(log10(mean)) - 1 of every column.
+    """
+    means = values.mean(axis=0)
+    if np.isnan(means).any():
+        means = np.nanmean(values, axis=0)  # copies, so only if needed
+    return power_exponents(means, floor)
+
+
+def power_exponents(means: np.ndarray, floor=0.0) -> np.ndarray:
+    """round(log10(means)) - 1, limited to floor (see mean_exponents)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponents = np.round(np.log10(means)) - 1.0
+    if floor is not None:
+        exponents = np.where(exponents >= floor, exponents, floor)
+    return exponents
+
+
+def power_scale(values: np.ndarray, targets, lin=True, floor=0.0, dtype=None, inplace=False):
+    """Divide the target columns by powers of ten (see mean_exponents), or take their log10.
+
+    All columns are done in one pass over the array, into a single output array. Other
+    columns are copied as they are. The result is computed in the dtype of values and
+    rounded once to dtype, so float32 output matches scaling in float64 and then casting.
+
+    Args:
+        values (np.ndarray): (rows, columns) array.
+        targets: Boolean mask of the target columns.
+        lin (bool, optional): Divide by 10**exponent, else take log10. Defaults to True.
+        floor (float, optional): Smallest exponent. Defaults to 0.0.
+        dtype (optional): dtype of the result. Defaults to the dtype of values.
+        inplace (bool, optional): Write into values if it already has dtype. Defaults to False.
+
+    Returns:
+        (np.ndarray, list): Scaled array, exponents of the target columns (None if not lin).
+    """
+    values = np.asarray(values)
+    dtype = values.dtype if dtype is None else np.dtype(dtype)
+    targets = np.asarray(targets, dtype=bool)
+    if inplace and values.dtype == dtype and values.flags.writeable:
+        out = values
+    else:
+        out = np.empty(values.shape, dtype=dtype, order='F')  # columns are contiguous, like a DataFrame's
+
+    if lin:
+        exponents = mean_exponents(values, floor)[targets]  # before values are overwritten
+        divisor = np.ones(values.shape[1])
+        divisor[targets] = 10**exponents
+        np.divide(values, divisor, out=out, casting='same_kind')
+        return out, exponents.tolist()
+    np.copyto(out, values, casting='same_kind', where=~targets)
+    np.log10(values, out=out, casting='same_kind', where=targets)
+    return out, None
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Write scaling.json for models trained before it existed.')
+    parser.add_argument('model_dirs', type=Path, nargs='+', help='Model directories.')
+    args = parser.parse_args()
+
+    for model_dir in args.model_dirs:
+        print(f'wrote {Scaling.from_model_dir(model_dir).save(model_dir)}')
@@ -0,0 +1,113 @@
+"""
+Run the configs of a conf_dicts.txt file in parallel.
+
+Every config is trained by its own MLP.py process, in its own directory of the sweep
+directory, with torch limited to an equal share of the cores. The node data cache is
+brought up to date once before the runs start, so that they only read it. When all runs
+are finished, their metadata is collected into results.csv in the sweep directory.
+
+usage: python torch/sweep.py [CONFIG_FILE] [-j JOBS] [-s SCRIPT]
+
+created: @jarl
+"""
+
+import os
+import sys
+import ast
+import pickle
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import pandas as pd
+
+import data_helpers as data
+
+# same cases as MLP.py
+voltages  = [200, 300, 400, 500] # V
+pressures = [  5,  10,  30,  45, 60, 80, 100, 120] # Pa
+excluded = (300, 60)  # V, Pa
+
+
+def run_config(script: Path, config: dict, run_dir: Path, num_threads: int) -> int:
+    """Train a single config in a new process.
+
+    Args:
+        script (Path): Training script (reads the config file given as its first argument).
+        config (dict): Config dict.
+        run_dir (Path): Output directory of the run, also holds its config and log.
+        num_threads (int): Number of threads of the run.
+
+    Returns:
+        int: Return code of the training process.
+    """
+    run_dir.mkdir(parents=True, exist_ok=True)
+    config = dict(config, out_dir=str(run_dir), num_threads=num_threads)
+    config_file = run_dir/'config.txt'
+    with open(config_file, 'w') as f:
+        f.write(repr([config]))
+
+    # keep numpy/BLAS inside the same share of the cores as torch
+    env = dict(os.environ, OMP_NUM_THREADS=str(num_threads), MKL_NUM_THREADS=str(num_threads),
+               OPENBLAS_NUM_THREADS=str(num_threads))
+    with open(run_dir/'log.txt', 'w') as log:
+        process = subprocess.run([sys.executable, str(script), str(config_file.resolve())],
+                                 stdout=log, stderr=subprocess.STDOUT, env=env)
+    return process.returncode
+
+
+def collect_results(configs: list, run_dirs: list, returncodes: list) -> pd.DataFrame:
+    """One row per run: its config, return code and the metrics in train_metadata.pkl."""
+    rows = []
+    for config, run_dir, returncode in zip(configs, run_dirs, returncodes):
+        row = dict(config, run_dir=str(run_dir), returncode=returncode)
+        metadata_file = run_dir/'train_metadata.pkl'
+        if metadata_file.exists():
+            with open(metadata_file, 'rb') as f:
+                metadata = pickle.load(f)
+            row.update({key: value for key, value in metadata.items()
+                        if key not in ('name', 'parameter_exponents')})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    root = Path.cwd()
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('configs', nargs='?', type=Path, default=root/'torch'/'conf_dicts.txt',
+                        help='File with a list of config dicts.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of parallel runs (default: one per config, at most one per core).')
+    parser.add_argument('-s', '--script', type=Path, default=Path(__file__).parent/'MLP.py',
+                        help='Training script.')
+    args = parser.parse_args()
+
+    with open(args.configs, 'r') as f:
+        configs = ast.literal_eval(f.read())
+
+    num_cores = os.cpu_count()
+    jobs = args.jobs or min(len(configs), num_cores)
+    num_threads = max(1, num_cores // jobs)
+
+    # update the cache once, so that the runs don't parse the same files concurrently
+    data.get_data(root, voltages, pressures, excluded)
+
+    sweep_dir = data.create_output_dir(root, 'sweep')
+    run_dirs = []
+    for i, config in enumerate(configs):
+        run_dirs.append(sweep_dir/f"{i:02d}_{config['name']}")  # names don't have to be unique
+
+    print(f'{len(configs)} runs, {jobs} at a time with {num_threads} threads each')
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        returncodes = list(executor.map(run_config, [args.script]*len(configs), configs,
+                                        run_dirs, [num_threads]*len(configs)))
+
+    results = collect_results(configs, run_dirs, returncodes)
+    results.to_csv(sweep_dir/'results.csv', index=False)
+    print(results.to_string(index=False))
+    print(f'\nresults saved to {sweep_dir/"results.csv"}')
+
+    failed = [str(run_dir) for run_dir, returncode in zip(run_dirs, returncodes) if returncode != 0]
+    if failed:
+        raise Exception(f'{len(failed)} runs failed, see log.txt in: {failed}')
@@ -0,0 +1,228 @@
+"""
+Generate a synthetic discharge dataset with the layout and file formats of the real one.
+
+Writes, under ROOT/data:
+    avg_data/{V}Vpp_{P}Pa_node.dat               node data of every case (Tecplot FEPOINT: quoted
+                                                 VARIABLES line, ZONE line, node lines, then the
+                                                 4-column quadrilateral connectivity)
+    interpolation_datasets/full_interpolation.nc  images of every case, variables on (V, P, y, x)
+    interpolation_datasets/rec-interpolation2.nc  the same, with the excluded case left as NaN
+    interpolation_datasets/test_set.nc           images of the excluded case only
+
+The fields are smooth functions of (x, y, V, P) with the magnitudes of the simulation output,
+so the node files and the images describe the same discharge. The mesh is a quadrilateral grid
+refined around the plasma, so that part of it has neighbors within the 1 mm bound of the k-NN
+adjacency. Images have 1 mm pixels over the 0.2 x 0.707 m domain, with NaN over the electrode.
+
+--scale multiplies the number of mesh nodes (at 1x: about the size of the simulation mesh),
+--image-scale the number of image pixels (at 1x: 707x200), and the cases are set by --voltages
+and --pressures, so that the same scripts can be run at 1x, 10x and 100x today's data size.
+Scripts read the data from the current directory, so run them from ROOT.
+
+usage: python torch/synthetic_data.py ROOT [-s SCALE] [-i IMAGE_SCALE] [-v VOLTAGES ...] [-p PRESSURES ...]
+
+created: @jarl
+"""
+
+import os
+import multiprocessing as mp
+from pathlib import Path
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+
+from cubes import CubeWriter
+
+# same cases as MLP.py
+voltages  = [200, 300, 400, 500] # V
+pressures = [  5,  10,  30,  45, 60, 80, 100, 120] # Pa
+excluded = (300, 60)  # V, Pa
+
+node_columns = ['X', 'Y', 'potential (V)', 'Ex (V/m)', 'Ey (V/m)',
+                'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
+image_variables = ['potential (V)', 'Ne (#/m^-3)', 'Ar+ (#/m^-3)', 'Nm (#/m^-3)', 'Te (eV)']
+
+width, height = 0.2, 0.707  # domain (m)
+num_nodes = 17000  # nodes of the mesh at scale 1
+center = (0.18, 0.26)  # densest part of the plasma (m)
+electrode = ((0.15, 0.2), (0.27, 0.3))  # (x range, y range) without plasma in the images
+
+
+def cluster(n: int, c: float, beta=6.0) -> np.ndarray:
+    """n points in [0, 1], clustered around c (sinh stretching, stronger with beta)."""
+    u = np.linspace(0, 1, n)
+    a = np.log((1 + (np.exp(beta) - 1)*c)/(1 + (np.exp(-beta) - 1)*c))/(2*beta)
+    return c*(1 + np.sinh(beta*(u - a))/np.sinh(beta*a))
+
+
+def synthetic_mesh(n: int):
+    """Quadrilateral mesh of about n nodes over the domain, refined around the plasma.
+
+    Returns:
+        np.ndarray: (num_nodes, 2) node coordinates X, Y (m), row-major.
+        np.ndarray: (num_elements, 4) 0-based node indices of the quadrilaterals.
+    """
+    nx = max(2, round(np.sqrt(n*width/height)))
+    ny = max(2, int(np.ceil(n/nx)))
+    x, y = np.meshgrid(width*cluster(nx, center[0]/width), height*cluster(ny, center[1]/height))
+    nodes = np.c_[x.ravel(), y.ravel()]
+
+    ix, iy = np.meshgrid(np.arange(nx-1), np.arange(ny-1))
+    corner = (iy*nx + ix).ravel()
+    elements = np.c_[corner, corner+1, corner+nx+1, corner+nx]
+    return nodes, elements
+
+
+def fields(x: np.ndarray, y: np.ndarray, voltage: float, pressure: float, rng=None) -> dict:
+    """Values of every variable at (x, y) for a single case.
+
+    Args:
+        x, y (np.ndarray): Coordinates (m).
+        voltage (float): Voltage (V).
+        pressure (float): Pressure (Pa).
+        rng (np.random.Generator, optional): Adds 1% noise if given. Defaults to None.
+
+    Returns:
+        dict: Arrays of every variable of node_columns except X and Y.
+    """
+    # higher pressures confine the plasma closer to the electrode
+    sx, sy = 0.04*(60/pressure)**0.25, 0.12*(60/pressure)**0.25
+    dx, dy = (x - center[0])/sx, (y - center[1])/sy
+    profile = np.exp(-(dx**2 + dy**2)/2)
+    noise = 1.0 if rng is None else 1 + 0.01*rng.standard_normal(np.shape(x))
+
+    potential = 0.3*voltage*profile*noise
+    ne = 1e13*(voltage/200)**1.5*(pressure/60)**0.5*profile*noise
+    return {'potential (V)': potential,
+            'Ex (V/m)': potential*dx/sx,  # -grad of the potential
+            'Ey (V/m)': potential*dy/sy,
+            'Ne (#/m^-3)': ne,
+            'Ar+ (#/m^-3)': 1.1*ne + 1e12*profile,
+            'Nm (#/m^-3)': 1e15*(pressure/60)*np.sqrt(profile)*noise,
+            'Te (eV)': (3 + 2*(60/pressure)**0.2*profile)*noise}
+
+
+def write_node_file(file_path: Path, nodes: np.ndarray, elements: np.ndarray, values: dict):
+    """Write a {V}Vpp_{P}Pa_node.dat file.
+
+    Args:
+        file_path (Path): Output file.
+        nodes (np.ndarray): (num_nodes, 2) node coordinates.
+        elements (np.ndarray): (num_elements, 4) 0-based node indices.
+        values (dict): Node values of every variable of node_columns except X and Y.
+    """
+    header = 'VARIABLES = ' + ' '.join(f'"{column}"' for column in node_columns)
+    zone = f'ZONE N={len(nodes)}, E={len(elements)}, F=FEPOINT, ET=QUADRILATERAL'
+    table = np.column_stack([nodes] + [values[column] for column in node_columns[2:]])
+    tmp_file = file_path.with_suffix('.tmp')
+    with open(tmp_file, 'w') as f:
+        f.write(header + '\n' + zone + '\n')
+        np.savetxt(f, table, fmt='%.6E')
+        np.savetxt(f, elements + 1, fmt='%d')  # Tecplot indices start at 1
+    os.replace(tmp_file, file_path)
+
+
+def _write_case(job):
+    """Write the node file of a single case (for write_cases)."""
+    data_dir, nodes, elements, voltage, pressure, seed = job
+    rng = np.random.default_rng([seed, voltage, pressure])  # same values in any order
+    write_node_file(data_dir/f'{voltage:d}Vpp_{pressure:03d}Pa_node.dat', nodes, elements,
+                    fields(nodes[:, 0], nodes[:, 1], voltage, pressure, rng))
+
+
+def write_cases(data_dir: Path, nodes: np.ndarray, elements: np.ndarray, voltages: list, pressures: list,
+                seed=0, processes=1):
+    """Write the node files of every (V, P) case, in a process pool if processes != 1."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(data_dir, nodes, elements, voltage, pressure, seed) for voltage in voltages for pressure in pressures]
+    if processes == 1:
+        for job in jobs:
+            _write_case(job)
+    else:
+        with mp.Pool(min(processes or os.cpu_count(), len(jobs))) as pool:
+            pool.map(_write_case, jobs)
+
+
+def write_images(file_path: Path, voltages: list, pressures: list, scale=1.0, holes=(), seed=0):
+    """Write an interpolation dataset: every image variable on (V, P, y, x).
+
+    Written in the chunked layout of tensorflow/data-augmentation-spatial.py, one case
+    at a time (see cubes.CubeWriter), so that only the images of one case are in memory.
+
+    Args:
+        file_path (Path): Output .nc file.
+        voltages (list): Voltages (V).
+        pressures (list): Pressures (Pa).
+        scale (float, optional): Pixels relative to the 707x200 images. Defaults to 1.0.
+        holes (tuple, optional): (V, P) cases left as NaN. Defaults to ().
+        seed (int, optional): Seed of the noise. Defaults to 0.
+    """
+    step = 1e-3/np.sqrt(scale)  # 1 mm pixels at scale 1
+    x = np.arange(round(width/step))*step
+    y = np.arange(round(height/step))*step
+    grid_x, grid_y = np.meshgrid(x, y)
+    no_plasma = ((grid_x >= electrode[0][0]) & (grid_x <= electrode[0][1]) &
+                 (grid_y >= electrode[1][0]) & (grid_y <= electrode[1][1]))
+
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file_path.with_suffix('.tmp')
+    with CubeWriter(tmp_file, {'V': voltages, 'P': pressures, 'y': y, 'x': x}, image_variables) as cube:
+        for i, voltage in enumerate(voltages):
+            for j, pressure in enumerate(pressures):
+                if (voltage, pressure) in holes:
+                    continue  # stays NaN
+                rng = np.random.default_rng([seed, voltage, pressure])
+                case = fields(grid_x, grid_y, voltage, pressure, rng)
+                cube.write(i, j, {name: np.where(no_plasma, np.nan, case[name]) for name in image_variables})
+    os.replace(tmp_file, file_path)
+
+
+def generate(root: Path, scale=1.0, voltages=voltages, pressures=pressures, excluded=excluded,
+             image_scale=1.0, images=True, seed=0, processes=None):
+    """Write the node files and the interpolation datasets of a synthetic dataset under root/data.
+
+    Args:
+        root (Path): Root directory, scripts are run from here.
+        scale (float, optional): Mesh nodes relative to the real data. Defaults to 1.0.
+        voltages (list, optional): Voltages (V) of the cases. Defaults to the cases of MLP.py.
+        pressures (list, optional): Pressures (Pa) of the cases. Defaults to the cases of MLP.py.
+        excluded (tuple, optional): (V, P) of the test case. Defaults to (300, 60).
+        image_scale (float, optional): Image pixels relative to the real data. Defaults to 1.0.
+        images (bool, optional): Also write the .nc files. Defaults to True.
+        seed (int, optional): Seed of the noise. Defaults to 0.
+        processes (int, optional): Processes writing node files, all cores if None. Defaults to None.
+    """
+    nodes, elements = synthetic_mesh(int(num_nodes*scale))
+    write_cases(root/'data'/'avg_data', nodes, elements, voltages, pressures, seed, processes)
+    print(f'{len(voltages)*len(pressures)} node files with {len(nodes)} nodes in {root/"data"/"avg_data"}')
+
+    if images:
+        image_dir = root/'data'/'interpolation_datasets'
+        write_images(image_dir/'full_interpolation.nc', voltages, pressures, image_scale, seed=seed)
+        write_images(image_dir/'rec-interpolation2.nc', voltages, pressures, image_scale, holes=[excluded],
+                     seed=seed)
+        write_images(image_dir/'test_set.nc', [excluded[0]], [excluded[1]], image_scale, seed=seed)
+        print(f'interpolation datasets in {image_dir}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('root', type=Path, help='Root directory of the dataset.')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='Mesh nodes relative to the real data.')
+    parser.add_argument('-i', '--image-scale', type=float, default=1.0,
+                        help='Image pixels relative to the real data.')
+    parser.add_argument('-v', '--voltages', type=int, nargs='+', default=voltages, help='Voltages (V).')
+    parser.add_argument('-p', '--pressures', type=int, nargs='+', default=pressures, help='Pressures (Pa).')
+    parser.add_argument('-e', '--excluded', type=int, nargs=2, default=excluded, metavar=('V', 'P'),
+                        help='Test case.')
+    parser.add_argument('--no-images', action='store_true', help='Only write the node files.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the noise.')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Processes writing node files (default: all cores).')
+    args = parser.parse_args()
+
+    if tuple(args.excluded) not in [(v, p) for v in args.voltages for p in args.pressures]:
+        raise Exception(f'excluded case {tuple(args.excluded)} is not one of the cases')
+
+    generate(args.root, args.scale, args.voltages, args.pressures, tuple(args.excluded),
+             args.image_scale, not args.no_images, args.seed, args.processes)
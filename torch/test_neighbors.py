@@ -0,0 +1,54 @@
+"""
+Tests for the neighbor means of the neighbor regularization (process_batch, Mesh.knn_query)
+"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+import MLP
+import twostageMLP
+from mesh import Mesh
+
+
+class RecordingModel(nn.Module):
+    """Returns its inputs, and keeps the last of them."""
+    def forward(self, x):
+        self.inputs = x.clone()
+        return x
+
+
+class ProcessBatchTest(unittest.TestCase):
+    def setUp(self):
+        # nodes 0 and 1 are neighbors, node 2 is alone
+        nodes = np.array([[0.1, 0.2], [0.11, 0.21], [0.5, 0.5]])
+        self.knn = Mesh(nodes).knn_query(nodes, k=2, distance_upper_bound=0.05)
+        self.sdf = pd.DataFrame(nodes, columns=['X', 'Y'])
+        self.chunk = torch.tensor([[0.9, 0.8, 0.1, 0.2]], dtype=torch.float64)  # V, P, x, y of node 0
+
+    def test_neighbor_inputs(self):
+        for process_batch in (MLP.process_batch, twostageMLP.process_batch):
+            model = RecordingModel()
+            means = process_batch(self.chunk, torch.tensor([0]), model, self.knn, self.sdf)
+
+            # the point's V and P with the grid coordinates of each neighbor
+            expected = torch.tensor([[0.9, 0.8, 0.1, 0.2], [0.9, 0.8, 0.11, 0.21]], dtype=torch.float64)
+            torch.testing.assert_close(model.inputs, expected)
+            torch.testing.assert_close(means, expected.mean(dim=0, keepdim=True))
+
+
+class KnnQueryTest(unittest.TestCase):
+    def test_point_without_neighbors(self):
+        mesh = Mesh(np.array([[0.1, 0.2], [0.11, 0.21], [0.5, 0.5]]))
+        knn = mesh.knn_query(np.array([[0.1, 0.2], [0.4, 0.5]]), k=2, distance_upper_bound=0.05)
+
+        # no node within the bound: the nearest node (2) instead of an empty row
+        np.testing.assert_array_equal(knn[1].indices, [2])
+        np.testing.assert_allclose(knn.sum(axis=1).A1, [1.0, 1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,677 @@
+""" Helper functions and classes for the pointwise MLP training scripts.
+
+created by jarl
+"""
+
+import os
+import copy
+import json
+import time
+import queue
+import random
+import threading
+import contextlib
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# precision modes: (parameter/data dtype, autocast dtype for the forward pass)
+PRECISIONS = {'float64': (torch.float64, None),
+              'float32': (torch.float32, None),
+              'bfloat16': (torch.float32, torch.bfloat16)}
+
+
+def set_precision(precision='float32'):
+    """Set the default torch dtype for a precision mode.
+
+    bfloat16 keeps float32 parameters and data, and runs the forward pass under CPU
+    autocast (see autocast()).
+
+    Args:
+        precision (str, optional): One of 'float64', 'float32' or 'bfloat16'. Defaults to 'float32'.
+
+    Returns:
+        np.dtype: NumPy dtype to use for the data path.
+    """
+    if precision not in PRECISIONS:
+        raise Exception(f'precision {precision} not recognized: use one of {list(PRECISIONS)}')
+    dtype, _ = PRECISIONS[precision]
+    torch.set_default_dtype(dtype)
+    return np.float64 if dtype == torch.float64 else np.float32
+
+
+def autocast(precision='float32'):
+    """Context manager for the forward pass: bfloat16 autocast on CPU, otherwise a no-op."""
+    _, autocast_dtype = PRECISIONS[precision]
+    if autocast_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast('cpu', dtype=autocast_dtype)
+
+
+def scale_learning_rate(learning_rate, batch_size, base_batch_size=128, rule=None):
+    """Scale the learning rate for large batches.
+
+    Args:
+        learning_rate (float): Learning rate at base_batch_size.
+        batch_size (int): Batch size used for training.
+        base_batch_size (int, optional): Batch size learning_rate was tuned for. Defaults to 128.
+        rule (str, optional): None (no scaling), 'linear' or 'sqrt'. Defaults to None.
+
+    Returns:
+        float: Scaled learning rate.
+    """
+    if rule is None:
+        return learning_rate
+    elif rule == 'linear':
+        return learning_rate*batch_size/base_batch_size
+    elif rule == 'sqrt':
+        return learning_rate*np.sqrt(batch_size/base_batch_size)
+    raise Exception(f'learning rate scaling rule {rule} not recognized: use None, linear or sqrt')
+
+
+def get_optimizer(name, parameters, learning_rate):
+    """Create the optimizer named in a training config.
+
+    Args:
+        name (str): 'adam', or 'lbfgs' for full-batch L-BFGS with a strong Wolfe line search.
+        parameters (iterable): Model parameters.
+        learning_rate (float): Learning rate (step size of L-BFGS, usually 1).
+
+    Returns:
+        torch.optim.Optimizer: Optimizer.
+    """
+    if name == 'adam':
+        return torch.optim.Adam(parameters, lr=learning_rate)
+    elif name == 'lbfgs':
+        return torch.optim.LBFGS(parameters, lr=learning_rate, max_iter=20, history_size=100,
+                                 line_search_fn='strong_wolfe')
+    raise Exception(f'optimizer {name} not recognized: use adam or lbfgs')
+
+
+def train_step(model, optimizer, criterion, inputs, labels, neighbor_means=None, c=0, precision='float32',
+               telemetry=None):
+    """Take one optimizer step on a batch.
+
+    The loss is evaluated in a closure, so the same step works for Adam (one evaluation)
+    and L-BFGS (several evaluations during the line search).
+
+    Args:
+        model (nn.Module): Model being trained.
+        optimizer (torch.optim.Optimizer): Optimizer.
+        criterion (nn.Module): Loss function.
+        inputs (torch.Tensor): Batch of inputs.
+        labels (torch.Tensor): Batch of targets.
+        neighbor_means (torch.Tensor, optional): Neighbor means of the batch, None to disable
+            neighbor regularization. Defaults to None.
+        c (float, optional): Neighbor regularization coefficient. Defaults to 0.
+        precision (str, optional): Precision mode (see set_precision()). Defaults to 'float32'.
+        telemetry (Telemetry, optional): Records the forward, backward and optimizer phases. Defaults to None.
+
+    Returns:
+        tuple: Total, data and neighbor loss (None without regularization) of the last evaluation.
+    """
+    telemetry = telemetry or Telemetry(None, enabled=False)
+    losses = []
+
+    def closure():
+        optimizer.zero_grad()  # zero the parameter gradients
+        with telemetry.phase('forward'), autocast(precision):  # no-op unless precision is bfloat16
+            outputs = model(inputs)  # forward pass
+            train_loss = criterion(outputs, labels)
+            if neighbor_means is None:
+                neighbor_loss = None
+                loss = train_loss
+            else:
+                neighbor_loss = criterion(outputs, neighbor_means)
+                loss = train_loss + c*neighbor_loss
+        with telemetry.phase('backward'):
+            loss.backward()  # compute gradients
+        losses[:] = [loss, train_loss, neighbor_loss]
+        return loss
+
+    with telemetry.phase('optimizer'):  # excludes the closure's forward and backward passes
+        optimizer.step(closure)  # apply changes to network
+    return tuple(losses)
+
+
+def time_to_target(epoch_times, losses, target_loss):
+    """Wall time until the loss first reaches target_loss.
+
+    Args:
+        epoch_times (list): Time (s) of every epoch.
+        losses (list): Loss after every epoch.
+        target_loss (float): Target loss.
+
+    Returns:
+        tuple: Time (s) and number of epochs to reach the target, (None, None) if it was never reached.
+    """
+    for epoch, loss in enumerate(losses):
+        if loss <= target_loss:
+            return sum(epoch_times[:epoch+1]), epoch + 1
+    return None, None
+
+
+def validation_indices(num_samples, validation_split, seed=None):
+    """Randomly split sample indices into training and validation indices.
+
+    Args:
+        num_samples (int): Number of samples.
+        validation_split (float): Fraction of samples held out for validation.
+        seed (int, optional): Seed of the split. Defaults to None.
+
+    Returns:
+        tuple: Training and validation indices (torch.Tensor).
+    """
+    generator = None if seed is None else torch.Generator().manual_seed(seed)
+    perm = torch.randperm(num_samples, generator=generator)
+    num_val = int(round(num_samples*validation_split))
+    return perm[num_val:].sort().values, perm[:num_val].sort().values
+
+
+class EarlyStopping:
+    """Stop training when the validation loss stops improving, and keep the best weights.
+
+    Args:
+        patience (int): Number of epochs without improvement before stopping.
+        min_delta (float, optional): Minimum decrease of the loss that counts as an improvement. Defaults to 0.
+    """
+    def __init__(self, patience: int, min_delta=0.0) -> None:
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = np.inf
+        self.best_epoch = None
+        self.best_state = None
+        self.counter = 0  # epochs since the last improvement
+
+    def step(self, loss: float, model: torch.nn.Module, epoch: int) -> bool:
+        """Record the validation loss of an epoch.
+
+        Returns:
+            bool: True if training should stop.
+        """
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_epoch = epoch
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            self.counter = 0
+        else:
+            self.counter += 1
+        return self.counter >= self.patience
+
+    def restore(self, model: torch.nn.Module) -> None:
+        """Load the best weights into model."""
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def state_dict(self) -> dict:
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch,
+                'best_state': self.best_state, 'counter': self.counter}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.best_loss = state['best_loss']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+        self.counter = state['counter']
+
+
+class Telemetry:
+    """Per-phase timing of the training loop, written to a JSONL file.
+
+    Phases are timed with `with telemetry.phase('forward'):` blocks. Nested phases are
+    subtracted from the enclosing phase, so the phase times of a batch add up to its wall
+    time. end_batch() and end_epoch() write one record per epoch with the phase totals,
+    samples/s and the loss components. close() adds a summary record with per-batch
+    percentiles of every phase.
+
+    When disabled, phase() returns a shared no-op context and nothing is recorded, so the
+    instrumentation can stay in the loop.
+
+    Args:
+        out_file (Path): JSONL file (e.g. the run directory's telemetry.jsonl), appended to.
+        enabled (bool, optional): Record and write telemetry. Defaults to True.
+    """
+    _off = contextlib.nullcontext()
+
+    def __init__(self, out_file: Path, enabled=True) -> None:
+        self.enabled = enabled
+        self.out_file = out_file
+        self._stack = []  # [phase, start, time in nested phases]
+        self._batch = {}  # phase: time (s) in the current batch
+        self._epoch = {}  # phase: time (s) in the current epoch
+        self._batches = {}  # phase: list of per-batch times (s), for the summary
+        self._samples = 0
+        self._epoch_start = time.perf_counter()
+        if enabled:
+            self._file = open(self.out_file, 'a')
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+        try:
+            yield
+        finally:
+            name, start, nested = self._stack.pop()
+            self._add(name, time.perf_counter() - start, nested)
+
+    def _add(self, name, elapsed, nested=0.0):
+        self._batch[name] = self._batch.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def phase(self, name: str):
+        """Context manager timing a phase of the current batch."""
+        if not self.enabled:
+            return self._off
+        return self._timed(name)
+
+    def iterate(self, loader, name='data'):
+        """Iterate over loader, timing every next() as phase name."""
+        if not self.enabled:
+            return loader
+        return self._iterate(loader, name)
+
+    def _iterate(self, loader, name):
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return  # the end of the loader (e.g. ShardDataset stopping its prefetch thread) is no batch
+            self._add(name, time.perf_counter() - start)
+            yield batch
+
+    def end_batch(self, num_samples: int) -> None:
+        """Close the current batch of num_samples samples."""
+        if not self.enabled:
+            return
+        for name, elapsed in self._batch.items():
+            self._epoch[name] = self._epoch.get(name, 0.0) + elapsed
+            self._batches.setdefault(name, []).append(elapsed)
+        self._batch = {}
+        self._samples += num_samples
+
+    def end_epoch(self, epoch: int, **losses) -> None:
+        """Write the record of an epoch (0-based), with loss components as keyword arguments."""
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - self._epoch_start
+        record = {'epoch': epoch + 1,
+                  'time': elapsed,
+                  'samples': self._samples,
+                  'samples_per_sec': self._samples/elapsed if elapsed > 0 else None,
+                  'phases': self._epoch,
+                  'losses': {k: v for k, v in losses.items() if v is not None}}
+        self._write(record)
+        self._batch = {}  # time outside of any batch is not carried into the next epoch
+        self._epoch = {}
+        self._samples = 0
+        self._epoch_start = time.perf_counter()
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def summary(self) -> dict:
+        """Per-batch percentiles (ms) and totals (s) of every phase."""
+        summary = {}
+        for name, times in self._batches.items():
+            times = np.array(times)*1e3
+            summary[name] = {'total (s)': times.sum()/1e3,
+                             'p50 (ms)': np.percentile(times, 50),
+                             'p90 (ms)': np.percentile(times, 90),
+                             'p99 (ms)': np.percentile(times, 99),
+                             'batches': len(times)}
+        return summary
+
+    def close(self) -> None:
+        """Write the summary record and close the file."""
+        if not self.enabled:
+            return
+        self._write({'summary': self.summary()})
+        self._file.close()
+
+
+class Profiler:
+    """torch.profiler over a bounded window of steps, saved to a model directory.
+
+    With steps, the profiler skips `wait` steps, warms up for `warmup` steps and records the
+    next `steps` steps of the loop (call step() after every batch). Without steps, everything
+    between start() and stop() is recorded (e.g. a single prediction). CPU ops (and CUDA
+    kernels if available) are recorded with shapes, memory and stacks. The output is a Chrome
+    trace (profile_trace.json, open in chrome://tracing or Perfetto) and the top-N operator
+    tables by time and by memory (profile_ops.txt).
+
+    When disabled, every method is a no-op, so the calls can stay in the scripts.
+
+    Args:
+        out_dir (Path): Directory of the output files.
+        enabled (bool, optional): Run the profiler. Defaults to True.
+        steps (int, optional): Number of steps to record, None to record everything. Defaults to 5.
+        wait (int, optional): Steps to skip before warming up. Defaults to 1.
+        warmup (int, optional): Warm-up steps (not recorded). Defaults to 1.
+        row_limit (int, optional): Number of operators in the tables. Defaults to 30.
+    """
+    def __init__(self, out_dir: Path, enabled=True, steps=5, wait=1, warmup=1, row_limit=30) -> None:
+        self.out_dir = Path(out_dir)
+        self.enabled = enabled
+        self.row_limit = row_limit
+        self._prof = None
+        if not enabled:
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        schedule = None
+        if steps is not None:
+            schedule = torch.profiler.schedule(wait=wait, warmup=warmup, active=steps, repeat=1)
+        self._prof = torch.profiler.profile(activities=activities, schedule=schedule,
+                                            on_trace_ready=self._save if schedule else None,
+                                            record_shapes=True, profile_memory=True, with_stack=True)
+        self._scheduled = schedule is not None
+
+    def _save(self, prof) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        prof.export_chrome_trace(str(self.out_dir/'profile_trace.json'))
+        averages = prof.key_averages()
+        with open(self.out_dir/'profile_ops.txt', 'w') as f:
+            f.write('Top operators by self CPU time\n')
+            f.write(averages.table(sort_by='self_cpu_time_total', row_limit=self.row_limit))
+            f.write('\n\nTop operators by self CPU memory\n')
+            f.write(averages.table(sort_by='self_cpu_memory_usage', row_limit=self.row_limit))
+            f.write('\n')
+        print(f'profile saved to {self.out_dir}')
+
+    def start(self) -> None:
+        if self._prof is not None:
+            self._prof.start()
+
+    def step(self) -> None:
+        """Mark the end of a step (batch)."""
+        if self._prof is not None:
+            self._prof.step()
+
+    def stop(self) -> None:
+        if self._prof is None:
+            return
+        self._prof.stop()
+        if not self._scheduled:
+            self._save(self._prof)
+        self._prof = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+class TensorBatchLoader:
+    """Shuffled mini-batches of in-memory tensors, without per-sample indexing or collate.
+
+    Draws one random permutation per epoch, gathers every tensor once in that order and
+    yields contiguous slices of the permuted tensors. Drop-in replacement for
+    DataLoader(TensorDataset(*tensors), batch_size, shuffle=True).
+
+    Args:
+        *tensors (torch.Tensor): Tensors with the same first dimension (e.g. features, labels).
+        batch_size (int): Number of samples per batch.
+        shuffle (bool, optional): Draw a new permutation every epoch. Defaults to True.
+        drop_last (bool, optional): Drop the last batch if it is smaller than batch_size. Defaults to False.
+        seed (int, optional): Seed of the permutations, for reproducible epochs. Defaults to None.
+    """
+    def __init__(self, *tensors: torch.Tensor, batch_size: int, shuffle=True, drop_last=False, seed=None) -> None:
+        if any(len(t) != len(tensors[0]) for t in tensors):
+            raise Exception('tensors must have the same number of samples')
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = None if seed is None else torch.Generator().manual_seed(seed)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.tensors[0]) // self.batch_size
+        return -(-len(self.tensors[0]) // self.batch_size)  # ceil
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            perm = torch.randperm(len(tensors[0]), generator=self.generator)
+            tensors = [t[perm] for t in tensors]
+        for i in range(len(self)):
+            yield tuple(t[i*self.batch_size:(i+1)*self.batch_size] for t in tensors)
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """Shuffled mini-batches of a dataset on disk, for training on more data than fits in memory.
+
+    Reads the shards written by data_helpers.write_shards in a random order every epoch. A
+    background thread loads the next (memory-mapped) shard while the current one trains.
+    Rows go through a shuffle buffer: every new shard is mixed with up to buffer_size rows
+    left over from the previous ones, and the rows beyond buffer_size are yielded in
+    batches of (features, labels, index). At most buffer_size + 2 shards of rows are in
+    memory. Yields whole batches, so use it directly or with DataLoader(batch_size=None).
+
+    Args:
+        shard_dir (Path): Folder with shards.json.
+        split (str, optional): 'train' or 'val'. Defaults to 'train'.
+        batch_size (int, optional): Number of samples per batch. Defaults to 128.
+        buffer_size (int, optional): Rows kept in the shuffle buffer. Defaults to 2**20.
+        shuffle (bool, optional): Shuffle the shards and rows every epoch. Defaults to True.
+        drop_last (bool, optional): Drop the last batch if it is smaller than batch_size. Defaults to False.
+        seed (int, optional): Seed of the shuffling, for reproducible epochs. Defaults to None.
+    """
+    def __init__(self, shard_dir: Path, split='train', batch_size=128, buffer_size=2**20, shuffle=True,
+                 drop_last=False, seed=None) -> None:
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir/'shards.json', 'r') as f:
+            manifest = json.load(f)
+        self.shards = [name for name, _ in manifest[split]]
+        self.num_rows = sum(rows for _, rows in manifest[split])
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = None if seed is None else torch.Generator().manual_seed(seed)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.num_rows // self.batch_size
+        return -(-self.num_rows // self.batch_size)  # ceil
+
+    def _load(self, name) -> tuple:
+        # copy out of the memory map, so the training thread never waits for the disk
+        return tuple(np.array(np.load(self.shard_dir/f'{name}.{part}.npy', mmap_mode='r'))
+                     for part in ['features', 'labels', 'index'])
+
+    def _prefetch(self, order, loaded: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for n in order:
+                if stop.is_set():
+                    return
+                loaded.put(self._load(self.shards[n]))
+            loaded.put(None)
+        except Exception as e:
+            loaded.put(e)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.shards), generator=self.generator).tolist()
+        else:
+            order = range(len(self.shards))
+        loaded = queue.Queue(maxsize=1)  # the next shard, loaded while the current one trains
+        stop = threading.Event()
+        thread = threading.Thread(target=self._prefetch, args=(order, loaded, stop), daemon=True)
+        thread.start()
+
+        try:
+            buffer = None
+            while True:
+                shard = loaded.get()
+                if isinstance(shard, Exception):
+                    raise Exception('failed to load a shard') from shard
+                final = shard is None
+                if not final:
+                    shard = [torch.from_numpy(part) for part in shard]
+                    buffer = shard if buffer is None else [torch.cat(pair) for pair in zip(buffer, shard)]
+                if buffer is None:
+                    return
+                if self.shuffle:
+                    perm = torch.randperm(len(buffer[0]), generator=self.generator)
+                    buffer = [t[perm] for t in buffer]
+
+                # yield every batch that leaves at least buffer_size rows to mix with the next shard
+                num_rows = len(buffer[0])
+                if final:
+                    num_batches = num_rows // self.batch_size if self.drop_last else -(-num_rows // self.batch_size)
+                else:
+                    num_batches = max(num_rows - self.buffer_size, 0) // self.batch_size
+                for i in range(num_batches):
+                    yield tuple(t[i*self.batch_size:(i+1)*self.batch_size] for t in buffer)
+                if final:
+                    return
+                buffer = [t[num_batches*self.batch_size:] for t in buffer]
+        finally:
+            # unblock the loader thread if the loop stopped early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    loaded.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
+
+
+def dataset_loss(model: torch.nn.Module, criterion, batches) -> float:
+    """Mean loss over a dataset given in batches (e.g. a ShardDataset), weighted by batch size.
+
+    Equal to the loss over the whole dataset at once for mean-reduced criteria. Call it under
+    torch.no_grad() (and autocast()).
+    """
+    total, count = 0.0, 0
+    for inputs, labels, *_ in batches:
+        total += criterion(model(inputs), labels).item()*len(labels)
+        count += len(labels)
+    return total/count if count else float('nan')
+
+
+class Checkpointer:
+    """Periodic training checkpoints, written by a background thread.
+
+    save() takes a snapshot of the model, optimizer, RNG states and loss history on the
+    calling thread, and a writer thread saves it to ckpt_dir/checkpoint_{epoch}.pt, so that
+    the training loop does not wait for the disk. Only the last keep checkpoints are kept.
+    load() restores the latest checkpoint to continue an interrupted run.
+
+    Args:
+        ckpt_dir (Path): Checkpoint directory.
+        keep (int, optional): Number of checkpoints to keep. Defaults to 3.
+    """
+    def __init__(self, ckpt_dir: Path, keep=3) -> None:
+        self.ckpt_dir = Path(ckpt_dir)
+        self.ckpt_dir.mkdir(parents=True, exist_ok=True)
+        self.keep = keep
+        self._queue = queue.Queue(maxsize=2)  # blocks only if the disk falls two checkpoints behind
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    @property
+    def checkpoints(self) -> list:
+        """Checkpoint files, oldest first."""
+        return sorted(self.ckpt_dir.glob('checkpoint_*.pt'))
+
+    def latest(self) -> Path:
+        """Path to the latest checkpoint, None if there is none."""
+        checkpoints = self.checkpoints
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, epoch: int, model: torch.nn.Module, optimizer: torch.optim.Optimizer,
+             history: dict = None, config: dict = None, generator: torch.Generator = None) -> None:
+        """Queue a checkpoint of the state after epoch (0-based).
+
+        Args:
+            epoch (int): Last completed epoch.
+            model (torch.nn.Module): Model being trained.
+            optimizer (torch.optim.Optimizer): Optimizer.
+            history (dict, optional): Loss history (lists of floats). Defaults to None.
+            config (dict, optional): Training config, to resume the run. Defaults to None.
+            generator (torch.Generator, optional): Generator of the batch order. Defaults to None.
+        """
+        if self._error is not None:
+            raise Exception('checkpoint writer failed') from self._error
+
+        state = {'epoch': epoch,
+                 'model': {k: v.detach().cpu().clone() for k, v in model.state_dict().items()},
+                 'optimizer': copy.deepcopy(optimizer.state_dict()),
+                 'rng': {'torch': torch.get_rng_state(),
+                         'numpy': np.random.get_state(),
+                         'python': random.getstate(),
+                         'generator': None if generator is None else generator.get_state()},
+                 'history': copy.deepcopy(history or {}),
+                 'config': copy.deepcopy(config)}
+        self._queue.put(state)
+
+    def _write(self) -> None:
+        while True:
+            state = self._queue.get()
+            if state is None:
+                break
+            try:
+                file = self.ckpt_dir/f"checkpoint_{state['epoch']+1:05d}.pt"
+                tmp_file = file.with_suffix('.tmp')
+                torch.save(state, tmp_file)
+                os.replace(tmp_file, file)  # a killed run never leaves a partial checkpoint
+                for old in self.checkpoints[:-self.keep]:
+                    old.unlink()
+            except Exception as e:
+                self._error = e
+
+    def load(self, model: torch.nn.Module, optimizer: torch.optim.Optimizer = None,
+             generator: torch.Generator = None) -> tuple:
+        """Restore the latest checkpoint.
+
+        Args:
+            model (torch.nn.Module): Model to load the weights into.
+            optimizer (torch.optim.Optimizer, optional): Optimizer to restore. Defaults to None.
+            generator (torch.Generator, optional): Generator of the batch order. Defaults to None.
+
+        Raises:
+            Exception: If there is no checkpoint in ckpt_dir.
+
+        Returns:
+            tuple: Epoch to continue from and the loss history.
+        """
+        file = self.latest()
+        if file is None:
+            raise Exception(f'no checkpoint found in {self.ckpt_dir}')
+        state = torch.load(file, weights_only=False)
+
+        model.load_state_dict(state['model'])
+        if optimizer is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        torch.set_rng_state(state['rng']['torch'])
+        np.random.set_state(state['rng']['numpy'])
+        random.setstate(state['rng']['python'])
+        if generator is not None and state['rng']['generator'] is not None:
+            generator.set_state(state['rng']['generator'])
+        print(f'resuming from {file}')
+        return state['epoch'] + 1, state['history']
+
+    def close(self) -> None:
+        """Wait until every queued checkpoint is written."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise Exception('checkpoint writer failed') from self._error
+
+
+def load_checkpoint_config(ckpt_dir: Path) -> dict:
+    """Training config saved with the latest checkpoint in ckpt_dir."""
+    checkpoints = sorted(Path(ckpt_dir).glob('checkpoint_*.pt'))
+    if not checkpoints:
+        raise Exception(f'no checkpoint found in {ckpt_dir}')
+    return torch.load(checkpoints[-1], weights_only=False)['config']
@@ -17,18 +17,19 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from scipy.spatial import cKDTree
+import scipy.sparse as sp
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import TensorDataset, DataLoader
 
 import data_helpers as data
 import plot
+from mesh import get_mesh
+from scalers import Scaling
+from train_helpers import set_precision, autocast, TensorBatchLoader, Telemetry
 
-torch.set_default_dtype(torch.float64)
 class MLP(nn.Module):
     """Neural network model for grid-wise prediction of 2D-profiles.
 
@@ -81,53 +82,37 @@ class MLP(nn.Module):
 
 
 ####### neighbor regularization #######
-def process_batch(chunk: torch.Tensor, model: MLP, tree:cKDTree, sdf: pd.DataFrame, k=4) -> torch.Tensor: 
+def process_batch(chunk: torch.Tensor, index: torch.Tensor, model: MLP, knn: sp.csr_matrix, 
+                  sdf: pd.DataFrame) -> torch.Tensor: 
     """Batch-wise processing of the input tensor.
 
-    Takes a batch of points as an input, along with the current model, and a DataFrame of 
-    grid coordinates. The cKDTree is also created from this df.
+    Takes a batch of points as an input, along with their mesh node indices, the current model,
+    the mesh's k-NN adjacency and a DataFrame of grid coordinates. Every neighbor of the batch
+    is passed through the model in a single forward pass, and the neighbor means are the
+    product of the adjacency rows with the model outputs.
     Args:
-        chunk (torch.Tensor): batch of input tensors whose neighbor means will be calculated.
+        chunk (torch.Tensor): batch of (V, P, x, y) inputs whose neighbor means will be calculated.
+        index (torch.Tensor): mesh node index of each input.
         model (MLP): model being trained.
-        tree: kd-tree of (unscaled) grid coordinates
+        knn (sp.csr_matrix): row-normalized k-NN adjacency of the mesh (see Mesh.knn_adjacency)
         sdf (pd.DataFrame): DataFrame of scaled nodes (grid points)
-        k: number of nearest neighbors to query. default is 4.
 
     Returns:
         torch.Tensor: Tensor of size (chunk_size, 5) containing neighbor means of the input chunk.
     """
-
-    def neighbor_mean(point: torch.Tensor, k):
-        # get a point's neighbors
-        a, b, v, p = point.numpy() # -> np.ndarray
-        x, y = gridUnscale(a, b, nodes)  # to properly enforce the distance upper bound in tree.query()
-        v = np.atleast_1d(v)  # converts to arrays with at least one dimension
-        p = np.atleast_1d(p)
-        _, ii = tree.query([x, y], k, distance_upper_bound=1e-3)  # get indices of k neighbors of the point (max: 1e-3m)
-        
-        neighbor_xy = [sdf.iloc[i-1].to_numpy() for i in ii]  # size: (k, 5 vars)
-        neighbors = [np.concatenate((xy, v, p)) for xy in neighbor_xy]  # list of input vectors x
-        neighbors = [torch.tensor(neighbor).expand(1, -1) for neighbor in neighbors]  # expand to match sizes (i forgot why)
-
-        # concat neighbors and get the mean for each variable
-        mean_tensors = torch.cat([model(neighbor) for neighbor in neighbors], dim=0)
-        return torch.mean(mean_tensors, dim=0)
-
     with torch.no_grad():
-        results = [neighbor_mean(x, 4) for x in chunk]
-    results = torch.stack(results, dim=0)
-    return results
+        points = chunk.numpy()
+        rows = knn[index.numpy()].tocoo()  # (chunk_size, num_nodes), weights 1/num_neighbors
 
+        # neighbor inputs (V, P, x, y): the point's V and P with the neighbor's grid coordinates
+        neighbors = np.concatenate((points[rows.row, :2], sdf.to_numpy()[rows.col]), axis=1)
+        outputs = model(torch.tensor(neighbors, dtype=chunk.dtype))
 
-def worker(queue, results, model, df, k):
-    # function to be executed by each process
-    # runs in an infinite loop until a batch is added to the queue
-    while True:
-        chunk = queue.get()  # retrieve data if a batch is added
-        if chunk is None:  # worker is active until a None is added to the queue
-            break  # terminate the process
-        output = process_batch(chunk, model, df, k)
-        results.put(output)  # add output to the results queue
+        # sparse product (chunk_size, num_neighbors) @ (num_neighbors, 5)
+        weights = torch.tensor(rows.data, dtype=outputs.dtype).unsqueeze(1)
+        results = torch.zeros(len(chunk), outputs.shape[1], dtype=outputs.dtype)
+        results.index_add_(0, torch.from_numpy(rows.row.astype(np.int64)), weights*outputs)
+    return results
 
 
 def c_e(epoch, c=0.2, r=25, which='sigmoid'):
@@ -179,6 +164,7 @@ def save_metadata(out_dir: Path):
             f.write(f'Number of points: {len(data_used)}\n')
             f.write(f'Target scaling: {minmax_y}\n')
             f.write(f'Parameter exponents: {scale_exp}\n')
+            f.write(f'Precision: {precision}\n')
             f.write(f'Execution time: {(train_end-train_start):.2f} s\n')
             f.write(f'Average time per epoch: {np.array(epoch_times).mean():.2f} s\n')
             f.write(f'\nUser-specified hyperparameters\n')
@@ -194,28 +180,6 @@ def save_metadata(out_dir: Path):
                 f.write(f'Neighbor regularization: none\n')
             f.write('\n***end of file***\n')
 
-def gridUnscale(x, y, df):
-    """Unscale a previously minmax-scaled point (x, y)
-
-    Args:
-        x (float): x-coordinate (scaled) 
-        y (float): y-coordinate (scaled)
-        df (pd.DataFrame): df of unscaled x and y
-
-    Returns:
-        x, y: unscaled x, y
-    """
-    xmin = df['X'].min()
-    xmax = df['X'].max()
-    ymin = df['Y'].min()
-    ymax = df['Y'].max()
-
-    # unscale (assuming minmax)
-    x = x*(xmax-xmin) + xmin
-    y = y*(ymax-ymin) + ymin
-
-    return x, y
-
 if __name__ == '__main__':
     # --------------- Model hyperparameters -----------------
 
@@ -240,7 +204,9 @@ if __name__ == '__main__':
         epochs = config['epochs']
         xy = config['xy']
         vp = config['vp']
-        k = config['k']  # number of neighbors, 0 to disable
+        precision = config.get('precision', 'float32')  # float64, float32 or bfloat16
+        telemetry_on = config.get('telemetry', False)  # per-phase timing in telemetry_stage{1,2}.jsonl
+        k = config['k']  # number of neighbors, 0 to disable (only the first stage is trained)
         c = config['lambda']  # neighbor regularization lambda
         n_epochs = config['n_epochs']  # neighbor regularization epochs
 
@@ -255,6 +221,7 @@ if __name__ == '__main__':
         # -------------------------------------------------------
         
         ########## data prep ##########
+        np_dtype = set_precision(precision)
         if ((name=='test') & (root/'created_models'/'test_dir_torch').exists()):
             out_dir = root/'created_models'/'test_dir_torch'  
         elif ((name=='test') & (not (root/'created_models'/'test_dir_torch').exists())): 
@@ -278,28 +245,34 @@ if __name__ == '__main__':
         # set threshold to make very small values zero
         pd.set_option('display.chop_threshold', 1e-10)
 
-        # scale features and labels 
+        # scale features and labels (the column selections are copies, so they are scaled in place)
         scale_exp = []
-        features = data.scale_all(data_used[feature_names], 'x', scaler_dir).astype('float64')
-        labels = data.data_preproc(data_used[label_names], scale_exp).astype('float64')
+        features = data.scale_all(data_used[feature_names], 'x', scaler_dir, dtype=np_dtype, inplace=True)
+        labels = data.data_preproc(data_used[label_names], scale_exp, dtype=np_dtype, inplace=True)
 
         if minmax_y:  # if applying minmax to target data
-            labels = data.scale_all(labels, 'y', scaler_dir)
+            labels = data.scale_all(labels, 'y', scaler_dir, dtype=np_dtype, inplace=True)
+
+        # all of the scaling in one file, for inference (see scalers.Scaling)
+        Scaling.from_scaler_dir(scaler_dir, scale_exp, minmax_y, lin, feature_names, label_names).save(out_dir)
 
         alldf = pd.concat([features, labels], axis=1)  # TODO: consider removing this
         dataset_size = len(alldf)
 
-        # kD tree for neighbor regularization (converted to tree later)
+        # k-NN adjacency for neighbor regularization (cached per mesh), with the row of every
+        # training point in it (augmentation points are not mesh nodes, see Mesh.knn_rows)
         nodes = data_excluded[['X', 'Y']]
-        tree = cKDTree(np.c_[nodes['X'].to_numpy(), nodes['Y'].to_numpy()])
-        scaledNodes = data.scale_all(data_excluded[['X', 'Y']], 'x') 
+        node_index = np.zeros(len(data_used), dtype=np.int64)
+        if k != 0:
+            knn, node_index = get_mesh(nodes).knn_rows(data_used[['x', 'y']].to_numpy(), k, distance_upper_bound=1e-3)
+        node_index = torch.tensor(node_index)
+        scaledNodes = data.scale_all(data_excluded[['X', 'Y']], 'x', dtype=np_dtype)
 
-        # create dataset object and shuffle it()  # TODO: train/val split
+        # shuffled batches: one permutation per epoch, batches are slices  # TODO: train/val split
         features = torch.tensor(features.to_numpy())
         labels = torch.tensor(labels.to_numpy())
-        dataset = TensorDataset(features, labels)
-
-        trainloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        trainloader = TensorBatchLoader(features, labels, node_index, batch_size=batch_size,
+                                        drop_last=config.get('drop_last', False), seed=config.get('seed'))
 
         model = MLP(name, len(feature_names), len(label_names)) 
         model.share_memory()
@@ -308,7 +281,7 @@ if __name__ == '__main__':
 
         # train the model twice, first regularly and again with the neighbor regularization
         print('begin model training...')
-        for neighbor_regularization in [False, True]:
+        for neighbor_regularization in ([False, True] if k != 0 else [False]):
             print(f'neighbor_regularization = {neighbor_regularization}')
             if neighbor_regularization:
                 print(f'lambda = {c}, k = {k}')
@@ -320,50 +293,49 @@ if __name__ == '__main__':
             train_losses = []
             neighbor_losses = []
 
+            stage = 2 if neighbor_regularization else 1
+            telemetry = Telemetry(out_dir/f'telemetry_stage{stage}.jsonl', enabled=telemetry_on)
+
             model.train()
             # model training loop
-            for epoch in tqdm(range(epochs), desc='Training...', colour='#7dc4e4'):
+            epoch_bar = tqdm(range(epochs), desc='Training...', colour='#7dc4e4')
+            for epoch in epoch_bar:
                 # record time per epoch
                 epoch_start = time.time()
-                loop = tqdm(trainloader, unit='batch', colour='#f5a97f')
-
-                for i, batch_data in enumerate(loop):
-                    # get the inputs; data is a list of [inputs, labels]
-                    inputs, labels = batch_data
 
+                for inputs, labels, index in telemetry.iterate(trainloader):
                     if neighbor_regularization:
                         # means not calculated if regularization is disabled
                         c = c_e(epoch, c=c)
-                        neighbor_means = process_batch(inputs, model, tree, scaledNodes)
+                        with telemetry.phase('regularization'):
+                            neighbor_means = process_batch(inputs, index, model, knn, scaledNodes)
                     else:
                         neighbor_means = 0
                     
                     # zero the parameter gradients
                     optimizer.zero_grad()
 
-                    # record losses
-                    running_loss = 0.0
-
-                    outputs = model(inputs)  # forward pass
-                    train_loss = criterion(outputs, labels)
-                    if neighbor_regularization:
-                        neighbor_loss = criterion(outputs, neighbor_means)
-                        loss = c*neighbor_loss  # c = 0 if no neighbor regularization
-                    else: loss = train_loss
-                    loss.backward()  # compute gradients
-                    optimizer.step()  # apply changes to network
-
-                    # print statistics
-                    running_loss += loss.item()
-                    loop.set_description(f"Epoch {epoch+1}/{epochs}")
-                    loop.set_postfix(loss=running_loss)
-                    running_loss = 0.0
+                    with telemetry.phase('forward'), autocast(precision):  # no-op unless precision is bfloat16
+                        outputs = model(inputs)  # forward pass
+                        train_loss = criterion(outputs, labels)
+                        if neighbor_regularization:
+                            neighbor_loss = criterion(outputs, neighbor_means)
+                            loss = c*neighbor_loss  # c = 0 if no neighbor regularization
+                        else: loss = train_loss
+                    with telemetry.phase('backward'):
+                        loss.backward()  # compute gradients
+                    with telemetry.phase('optimizer'):
+                        optimizer.step()  # apply changes to network
+                    telemetry.end_batch(len(inputs))
 
                 epoch_end = time.time()
                 epoch_times.append(epoch_end - epoch_start)
                 epoch_loss.append(loss.item())
+                epoch_bar.set_postfix(loss=epoch_loss[-1])
                 train_losses.append(train_loss.item())
                 if neighbor_regularization: neighbor_losses.append(neighbor_loss.item()) 
+                telemetry.end_epoch(epoch, loss=epoch_loss[-1], train_loss=train_losses[-1],
+                                    neighbor_loss=neighbor_losses[-1] if neighbor_regularization else None)
 
                 if (epoch+1) % epochs == 0:
                     # save model every 10 epochs (so i dont lose all training progress in case i do something dumb)
@@ -371,6 +343,7 @@ if __name__ == '__main__':
                     plot.save_history_graph(epoch_loss, out_dir)
 
 
+            telemetry.close()
             print('Finished training')
             train_end = time.time()
 
@@ -384,7 +357,8 @@ if __name__ == '__main__':
         metadata = {'name' : name,  # str
                     'scaling' : lin,  # bool
                     'is_target_scaled': minmax_y,  # bool
-                    'parameter_exponents': scale_exp}  # list of float
+                    'parameter_exponents': scale_exp,  # list of float
+                    'precision': precision}  # str
 
         with open(out_dir / 'train_metadata.pkl', 'wb') as f:
             pickle.dump(metadata, f)